@@ -0,0 +1,154 @@
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+
+from bench.load import LoadServer, run_load
+from websocket_frames import build_frame_header
+from websocket_server import WebSocketServer
+
+REQUEST = (b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+           b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss():
+    # Resident memory of this process in bytes, now rather than at its peak
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def flow_control(server, enabled, limit=None):
+    # Without flow control the server behaves as it used to: no watermarks and no memory cap
+    if enabled:
+        server.outbox_memory.limit = limit
+    else:
+        server.outbox_high_water = None
+        server.outbox_memory.limit = None
+
+
+def start(server):
+    server.heartbeat_interval = 3600
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    return server.sock.getsockname()[1]
+
+
+def stalled_client(port):
+    # Completes the upgrade, then never reads again
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(REQUEST)
+    head = b""
+    while b"\r\n\r\n" not in head:
+        head += sock.recv(4096)
+    return sock
+
+
+def watch(server, duration):
+    # Peak bytes queued in outboxes and peak growth of the process RSS over `duration` seconds
+    base = rss()
+    queued = grown = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        queued = max(queued, server.outbox_memory.used)
+        grown = max(grown, rss() - base)
+        time.sleep(0.005)
+    return queued, grown
+
+
+def flood(enabled, size, duration):
+    # One client sends `size` byte messages as fast as it can and never reads the echoes
+    server = WebSocketServer('127.0.0.1', 0)
+    flow_control(server, enabled)
+    sock = stalled_client(start(server))
+    frame = build_frame_header(0x2, size, masking_key=bytes(4)) + b"x" * size
+    sent = [0]
+
+    def send():
+        try:
+            while True:
+                sock.sendall(frame)
+                sent[0] += 1
+        except OSError:
+            pass
+    threading.Thread(target=send, daemon=True).start()
+    try:
+        queued, grown = watch(server, duration)
+        dropped = sum(conn.outbox.dropped for conn in server.connections)
+        return queued, grown, sent[0], dropped
+    finally:
+        sock.close()
+        server.stop()
+
+
+def fan_out(enabled, clients, size, duration, limit):
+    # The server publishes `size` byte messages to `clients` clients that stopped reading
+    server = WebSocketServer('127.0.0.1', 0)
+    flow_control(server, enabled, limit)
+    port = start(server)
+    socks = [stalled_client(port) for _ in range(clients)]
+    while len(server.clients) < clients:
+        time.sleep(0.01)
+    stop = threading.Event()
+
+    def publish():
+        payload = os.urandom(size)  # A new message each time, as a real feed would send
+        while not stop.is_set():
+            server.publish(payload[:-1] + bytes([len(server.clients) & 0xff]))
+    threading.Thread(target=publish, daemon=True).start()
+    try:
+        queued, grown = watch(server, duration)
+        return queued, grown
+    finally:
+        stop.set()
+        for sock in socks:
+            sock.close()
+        server.stop()
+
+
+def echo_rate(enabled, clients, duration):
+    server = LoadServer('127.0.0.1', 0, "echo")
+    flow_control(server, enabled, server.outbox_memory.limit)
+    port = start(server)
+    try:
+        return run_load('127.0.0.1', port, "echo", clients, 64, duration)["messages_per_second"]
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory held for clients that do not read, with and without flow control")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="message size in bytes")
+    parser.add_argument("--clients", type=int, default=10, help="stalled clients in the fan-out")
+    parser.add_argument("--limit", type=int, default=32 * 1024 * 1024, help="server-wide cap for the fan-out")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--rounds", type=int, default=3, help="alternating echo runs with and without")
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    mib = 1024 * 1024
+
+    for enabled in (False, True):
+        name = "with flow control" if enabled else "without"
+        queued, grown, sent, dropped = flood(enabled, args.size, args.duration)
+        print(f"flood, {name:>17}: {queued / mib:7.1f} MiB queued at peak, RSS +{grown / mib:6.1f} MiB, "
+              f"{sent} messages sent, {dropped} echoes dropped")
+    for enabled in (False, True):
+        name = f"with a {args.limit // mib} MiB cap" if enabled else "without"
+        queued, grown = fan_out(enabled, args.clients, args.size, args.duration, args.limit)
+        print(f"fan-out to {args.clients} stalled clients, {name:>15}: {queued / mib:7.1f} MiB queued at peak, "
+              f"RSS +{grown / mib:6.1f} MiB")
+    # Well-behaved clients should not pay for it; runs alternate as the machine's speed drifts
+    rates = {False: [], True: []}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            rates[enabled].append(echo_rate(enabled, 20, args.duration))
+    for enabled in (False, True):
+        print(f"echo, 20 clients, {'with flow control' if enabled else 'without':>17}: "
+              f"{max(rates[enabled]):.0f} msg/s (best of {args.rounds})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import base64
+import os
+import resource
+import selectors
+import socket
+import threading
+import time
+
+from websocket_frames import apply_mask, build_frame_header
+from websocket_server import WebSocketServer
+
+
+class BroadcastServer(WebSocketServer):
+    # Every connection subscribes; a "publish" message fans the payload out to all the others
+    def __init__(self, host, port, payload, mode, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.payload = payload
+        self.mode = mode
+        self.subscribers = []
+
+    def on_open(self, client):
+        self.subscribers.append(client)
+
+    def on_message(self, client, message):
+        if message != "publish":
+            return
+        targets = [subscriber for subscriber in self.subscribers if subscriber is not client]
+        if self.mode == "shared":
+            self.broadcast_to(targets, self.payload)
+        else:
+            # What ChatServer.broadcast used to do: encode and send once per client
+            for target in targets:
+                self.send_message(target, self.payload)
+
+
+def open_connection(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16))
+    sock.sendall(
+        b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: " + key + b"\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    )
+    response = b""
+    while b"\r\n\r\n" not in response:
+        response += sock.recv(1024)
+    return sock
+
+
+def run(engine, mode, subscribers, size):
+    payload = "x" * size
+    server = BroadcastServer('127.0.0.1', 0, payload, mode, engine=engine)
+    server.heartbeat_interval = 3600
+    port = server.sock.getsockname()[1]
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+
+    sockets = [open_connection(port) for _ in range(subscribers)]
+    publisher = open_connection(port)
+    while len(server.subscribers) < subscribers + 1:
+        time.sleep(0.01)
+
+    expected = len(build_frame_header(0x1, size)) + size
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, [0])
+
+    masking_key = os.urandom(4)
+    start = time.perf_counter()
+    publisher.sendall(build_frame_header(0x1, 7, masking_key=masking_key) + apply_mask(b"publish", masking_key))
+    remaining = subscribers
+    first = None
+    while remaining:
+        for key, events in selector.select():
+            received = key.data
+            try:
+                received[0] += len(key.fileobj.recv(65536))
+            except BlockingIOError:
+                continue
+            if received[0] >= expected:
+                if first is None:
+                    first = time.perf_counter() - start
+                selector.unregister(key.fileobj)
+                remaining -= 1
+    last = time.perf_counter() - start
+
+    for sock in sockets + [publisher]:
+        sock.close()
+    server.sock.close()
+    return first, last
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time one message fanned out to many subscribers")
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=256, help="payload size in bytes")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = 2 * args.subscribers + 64
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+    print(f"{args.subscribers} subscribers, {args.size} byte payload, {args.engine} engine")
+    for mode in ("per-client", "shared"):
+        first, last = run(args.engine, mode, args.subscribers, args.size)
+        print(f"{mode:>10}: first delivery {first * 1000:8.2f} ms, last delivery {last * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import gc
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from websocket_server import WebSocketServer
+
+REQUEST = (b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+           b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss(pid="self"):
+    with open(f"/proc/{pid}/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def registered(count):
+    # Memory of the server's own state for `count` idle connections, registered the way the
+    # engines do after a handshake. Stand-in objects take the place of sockets, so the count is
+    # not bounded by file descriptors and the kernel's socket buffers are left out.
+    server = WebSocketServer('127.0.0.1', 0)
+    server.sock.close()
+    socks = [object() for _ in range(count)]
+    gc.collect()
+    base = rss()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for index, sock in enumerate(socks):
+        server.add_client(sock, ("127.0.0.1", index))
+        server.heartbeats.add(sock, server.heartbeat_interval, server.heartbeat_timeout)
+    elapsed = time.perf_counter() - start
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    gc.collect()
+    return traced / count, (rss() - base) / count, count / elapsed
+
+
+def serve(engine):
+    # Subprocess side: report the port, then answer each line on stdin with "<clients> <rss>"
+    logging.disable(logging.ERROR)
+    server = WebSocketServer('127.0.0.1', 0, engine=engine)
+    server.heartbeat_interval = 3600
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    print(server.sock.getsockname()[1], flush=True)
+    for _ in sys.stdin:
+        print(len(server.clients), rss(), flush=True)
+
+
+def sockets(engine, count):
+    # Resident memory of a server process holding `count` real, idle, upgraded connections
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-m", "bench.connections", "--serve", engine], cwd=root,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def ask():
+        process.stdin.write("\n")
+        process.stdin.flush()
+        clients, size = process.stdout.readline().split()
+        return int(clients), int(size)
+    socks = []
+    try:
+        port = int(process.stdout.readline())
+        time.sleep(0.5)  # Let the engine finish starting
+        base = ask()[1]
+        for _ in range(count):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(REQUEST)
+            socks.append(sock)
+        for sock in socks:
+            head = b""
+            while b"\r\n\r\n" not in head:
+                head += sock.recv(4096)
+        while ask()[0] < count:
+            time.sleep(0.1)
+        return (ask()[1] - base) / count
+    finally:
+        for sock in socks:
+            sock.close()
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory per idle connection")
+    parser.add_argument("--count", type=int, default=100000, help="registered connections")
+    parser.add_argument("--sockets", type=int, default=5000, help="real connections to a server process")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    parser.add_argument("--serve", choices=WebSocketServer.ENGINES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve:
+        serve(args.serve)
+        return
+
+    traced, resident, rate = registered(args.count)
+    print(f"{args.count} registered connections: {traced:7.0f} bytes each allocated, {resident:7.0f} bytes each "
+          f"resident, {rate:.0f} registrations/s")
+    # Each connection takes a descriptor on both ends, and the threaded engine a thread
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if args.sockets + 64 > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(args.sockets + 64, hard), hard))
+    if args.sockets:
+        per_connection = sockets(args.engine, args.sockets)
+        print(f"{args.sockets} idle sockets, {args.engine} engine: {per_connection:7.0f} bytes each of server RSS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import base64
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import timeit
+
+from websocket_deflate import DeflateConfig
+from websocket_handshake import split_head
+from websocket_server import WebSocketServer
+
+
+def request(key, extensions=b""):
+    return (b"GET /chat HTTP/1.1\r\nHost: localhost:8765\r\nUser-Agent: bench\r\nUpgrade: websocket\r\n"
+            b"Connection: Upgrade\r\nSec-WebSocket-Key: " + key + b"\r\nSec-WebSocket-Version: 13\r\n" +
+            extensions + b"\r\n")
+
+
+def legacy_handshake(data):
+    # What the server did before: decode and split the first recv, format the whole response
+    lines = data.decode('utf-8').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip()] = value.strip()
+    sha1 = hashlib.sha1((headers['Sec-WebSocket-Key'] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode('utf-8')).digest()
+    accept = base64.b64encode(sha1).decode('utf-8')
+    response = (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Accept: {accept}\r\n"
+        "\r\n"
+    )
+    return response.encode('utf-8')
+
+
+def handshake_cost(server, data):
+    def handshake():
+        head, leftover = split_head(data)
+        server.handshake_response(head, server.parse_request(head))
+    return handshake
+
+
+def storm(engine, threads, duration):
+    # Open and close connections from `threads` threads for `duration` seconds
+    server = WebSocketServer('127.0.0.1', 0, engine=engine)
+    server.heartbeat_interval = 3600
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    port = server.sock.getsockname()[1]
+    data = request(base64.b64encode(os.urandom(16)))
+    counts = [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def connect(index):
+        while time.perf_counter() < deadline:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(data)
+            response = b""
+            while b"\r\n\r\n" not in response:
+                response += sock.recv(4096)
+            sock.close()
+            counts[index] += 1
+    workers = [threading.Thread(target=connect, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    server.stop()
+    return sum(counts) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of the opening handshake")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    parser.add_argument("--threads", type=int, default=8, help="connecting threads in the storm")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    key = base64.b64encode(os.urandom(16))
+    plain = WebSocketServer('127.0.0.1', 0)
+    deflate = WebSocketServer('127.0.0.1', 0, compression=DeflateConfig())
+    count = 50000
+    data = request(key)
+    cases = (("legacy parse and response", lambda: legacy_handshake(data)),
+             ("parse, validate, response", handshake_cost(plain, data)),
+             ("  with permessage-deflate", handshake_cost(deflate, request(
+                 key, b"Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n"))),
+             ("  of which the SHA-1 key", lambda: base64.b64encode(hashlib.sha1(key + b"x" * 36).digest())))
+    for name, case in cases:
+        cost = timeit.timeit(case, number=count) / count
+        print(f"{name:>27}: {cost * 1e6:6.2f} us ({1 / cost:8.0f} handshakes/s on one core)")
+    plain.sock.close()
+    deflate.sock.close()
+
+    rate = storm(args.engine, args.threads, args.duration)
+    print(f"connection storm, {args.engine} engine, {args.threads} threads: {rate:.0f} handshakes/s "
+          f"(client and server share this machine)")
+
+
+if __name__ == "__main__":
+    main()
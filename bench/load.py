@@ -0,0 +1,380 @@
+import argparse
+import base64
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from websocket_frames import FrameParser, build_frame_header
+from websocket_server import WebSocketServer
+
+# Default payload size of each workload
+WORKLOADS = {"echo": 64, "broadcast": 64, "large": 1 << 20}
+
+# Every payload starts with the time it was sent, so latency is measured by whoever receives it
+STAMP = struct.Struct("!d")
+
+# A zero masking key leaves the payload as it is, so the generator spends no CPU masking
+ZERO_KEY = bytes(4)
+
+
+class LoadServer(WebSocketServer):
+    # Echoes binary messages back, or fans them out to every other connection for "broadcast"
+    def __init__(self, host, port, workload, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.workload = workload
+        self.subscribers = set()
+
+    def on_open(self, client):
+        self.subscribers.add(client)
+
+    def on_close(self, client):
+        self.subscribers.discard(client)
+
+    def on_message(self, client, message):
+        if self.workload == "broadcast":
+            self.broadcast_to([subscriber for subscriber in self.subscribers if subscriber is not client], message)
+        else:
+            self.send_binary(client, message)
+
+
+class Connection:
+    # One load generator client, driven by the selector loop in run_load
+    def __init__(self, sock, leftover):
+        self.sock = sock
+        self.parser = FrameParser()
+        if leftover:
+            self.parser.feed(leftover)
+        self.out = bytearray()
+        self.sent = 0
+        self.outstanding = 0  # Messages sent and not answered yet
+        self.open = True
+
+    def queue(self, opcode, payload):
+        self.out += build_frame_header(opcode, len(payload), masking_key=ZERO_KEY)
+        self.out += payload
+
+    def write(self):
+        # Returns True when everything queued has been written
+        try:
+            count = self.sock.send(self.out)
+        except BlockingIOError:
+            return False
+        del self.out[:count]
+        return not self.out
+
+
+def connect(host, port):
+    sock = socket.create_connection((host, port))
+    key = base64.b64encode(os.urandom(16))
+    sock.sendall(
+        b"GET / HTTP/1.1\r\nHost: " + host.encode() + b"\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: " + key + b"\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    )
+    response = b""
+    while b"\r\n\r\n" not in response:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("Server closed the connection during the handshake")
+        response += chunk
+    head, leftover = response.split(b"\r\n\r\n", 1)
+    if b" 101 " not in head.split(b"\r\n", 1)[0]:
+        raise ConnectionError(f"Handshake refused: {head.splitlines()[0]!r}")
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return Connection(sock, leftover)
+
+
+def make_payload(padding):
+    return STAMP.pack(time.perf_counter()) + padding
+
+
+def run_load(host, port, workload, clients, size, duration, messages=None, rate=100):
+    # Drive every connection from one thread. Echo workloads keep one message in flight per
+    # connection; broadcast has the first connection publish `rate` messages a second to the rest.
+    connections = [connect(host, port) for _ in range(clients)]
+    padding = b"x" * max(size - STAMP.size, 0)
+    selector = selectors.DefaultSelector()
+    for conn in connections:
+        selector.register(conn.sock, selectors.EVENT_READ, conn)
+    if workload == "broadcast":
+        # Let the server register every subscriber before the first message
+        time.sleep(0.2)
+        senders = connections[:1]
+    else:
+        senders = connections
+
+    latencies = []
+    received_bytes = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    next_publish = start
+
+    def send(conn):
+        conn.queue(0x2, make_payload(padding))
+        conn.sent += 1
+        if workload != "broadcast":  # Nothing comes back to a broadcast publisher
+            conn.outstanding += 1
+        flush(conn)
+
+    def flush(conn):
+        events = selectors.EVENT_READ if conn.write() else selectors.EVENT_READ | selectors.EVENT_WRITE
+        selector.modify(conn.sock, events, conn)
+
+    def may_send(conn):
+        return time.perf_counter() < deadline and (messages is None or conn.sent < messages)
+
+    if workload != "broadcast":
+        for conn in senders:
+            send(conn)
+
+    # Once nothing is left to send, wait a little for replies still in flight
+    drain_until = None
+    last = None
+    while True:
+        now = time.perf_counter()
+        if workload == "broadcast":
+            publisher = senders[0]
+            while next_publish <= now and may_send(publisher):
+                send(publisher)
+                next_publish += 1 / rate
+            sending = may_send(publisher)
+            timeout = max(next_publish - now, 0) if sending else 0.05
+        else:
+            sending = any(conn.open and may_send(conn) for conn in senders)
+            timeout = 0.05
+        if not sending:
+            if drain_until is None:
+                drain_until = now + (1.0 if workload == "broadcast" else 5.0)
+            waiting = workload == "broadcast" or any(conn.outstanding for conn in senders if conn.open)
+            if now >= drain_until or not waiting:
+                break
+
+        for key, events in selector.select(timeout):
+            conn = key.data
+            if events & selectors.EVENT_WRITE:
+                flush(conn)
+            if not events & selectors.EVENT_READ:
+                continue
+            try:
+                count = conn.parser.recv_into(conn.sock)
+            except BlockingIOError:
+                continue
+            except OSError:
+                count = 0
+            if not count:
+                conn.open = False
+                conn.outstanding = 0
+                selector.unregister(conn.sock)
+                continue
+            arrived = time.perf_counter()
+            while True:
+                frame = conn.parser.next_frame()
+                if frame is None:
+                    break
+                if frame.opcode == 0x9:
+                    conn.queue(0xA, bytes(frame.payload))
+                    flush(conn)
+                    continue
+                if frame.opcode != 0x2 or len(frame.payload) < STAMP.size:
+                    continue
+                latencies.append(arrived - STAMP.unpack_from(frame.payload)[0])
+                last = arrived
+                received_bytes += len(frame.payload)
+                if workload != "broadcast":
+                    conn.outstanding -= 1
+                    if may_send(conn):
+                        send(conn)
+    elapsed = (last if last is not None else time.perf_counter()) - start
+
+    for conn in connections:
+        conn.sock.close()
+    return {
+        "messages": len(latencies),
+        "elapsed_seconds": elapsed,
+        "messages_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "mb_per_second": received_bytes / elapsed / 1e6 if elapsed else 0.0,
+        "latency_ms": summarize(latencies),
+    }
+
+
+def percentile(values, fraction):
+    # Nearest rank on sorted values
+    return values[max(math.ceil(fraction * len(values)), 1) - 1]
+
+
+def summarize(latencies):
+    latencies = sorted(latency * 1000 for latency in latencies)
+    if not latencies:
+        return None
+    return {
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "p999": percentile(latencies, 0.999),
+        "max": latencies[-1],
+    }
+
+
+def process_stats(pid):
+    # CPU seconds and resident memory of a process, read from /proc where it exists
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        if pid != os.getpid():
+            return None
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        scale = 1 if sys.platform == "darwin" else 1024
+        peak = usage.ru_maxrss * scale / 1e6
+        return {"cpu_seconds": usage.ru_utime + usage.ru_stime, "rss_mb": peak, "peak_rss_mb": peak}
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_mb": int(status["VmRSS"].split()[0]) * 1024 / 1e6,
+        "peak_rss_mb": int(status["VmHWM"].split()[0]) * 1024 / 1e6,
+    }
+
+
+def usage_between(before, after, elapsed):
+    if before is None or after is None:
+        return None
+    cpu = after["cpu_seconds"] - before["cpu_seconds"]
+    return {
+        "cpu_seconds": cpu,
+        "cpu_percent": 100 * cpu / elapsed if elapsed else 0.0,
+        "rss_mb": after["rss_mb"],
+        "peak_rss_mb": after["peak_rss_mb"],
+    }
+
+
+def start_server(mode, engine, workload):
+    # Returns (port, pid, stop callable)
+    if mode == "thread":
+        server = LoadServer('127.0.0.1', 0, workload, engine=engine)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        return server.sock.getsockname()[1], os.getpid(), server.sock.close
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.load", "--serve", "--engine", engine, "--workload", workload],
+        cwd=root, stdout=subprocess.PIPE, text=True,
+    )
+    port = int(process.stdout.readline())
+
+    def stop():
+        process.terminate()
+        process.wait()
+    return port, process.pid, stop
+
+
+def serve(engine, workload):
+    # Subprocess side of --server subprocess: report the port, then serve until terminated
+    server = LoadServer('127.0.0.1', 0, workload, engine=engine)
+    print(server.sock.getsockname()[1], flush=True)
+    server.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the WebSocket server")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="echo")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent connections")
+    parser.add_argument("--size", type=int, help="payload size in bytes (default depends on the workload)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send for")
+    parser.add_argument("--messages", type=int, help="stop each connection after this many messages")
+    parser.add_argument("--rate", type=float, default=100.0, help="broadcast messages per second")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="threaded")
+    parser.add_argument("--server", choices=("thread", "subprocess", "external"), default="subprocess",
+                        help="run the server in this process, in a child process, or use one already running")
+    parser.add_argument("--host", default="127.0.0.1", help="host of an external server")
+    parser.add_argument("--port", type=int, default=8765, help="port of an external server")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON to PATH ('-' for stdout)")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # Per-connection log lines would dominate the measurements
+    logging.disable(logging.INFO)
+
+    if args.serve:
+        serve(args.engine, args.workload)
+        return
+    if args.workload == "broadcast" and args.clients < 2:
+        parser.error("broadcast needs at least two clients")
+    size = args.size if args.size is not None else WORKLOADS[args.workload]
+    if size < STAMP.size:
+        parser.error(f"--size must be at least {STAMP.size} bytes")
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = 2 * args.clients + 64
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+    host, server_pid, stop = args.host, None, None
+    port = args.port
+    if args.server != "external":
+        host = '127.0.0.1'
+        port, server_pid, stop = start_server(args.server, args.engine, args.workload)
+
+    generator_before = process_stats(os.getpid())
+    server_before = process_stats(server_pid) if server_pid not in (None, os.getpid()) else None
+    try:
+        result = run_load(host, port, args.workload, args.clients, size, args.duration, args.messages, args.rate)
+        processes = {"generator": usage_between(generator_before, process_stats(os.getpid()), result["elapsed_seconds"])}
+        if server_before is not None:
+            processes["server"] = usage_between(server_before, process_stats(server_pid), result["elapsed_seconds"])
+        elif args.server == "thread" and processes["generator"]:
+            processes["generator"]["includes_server"] = True
+    finally:
+        if stop is not None:
+            stop()
+
+    report = {
+        "workload": args.workload,
+        "engine": args.engine if args.server != "external" else None,
+        "server": args.server,
+        "clients": args.clients,
+        "size": size,
+        "duration": args.duration,
+        "rate": args.rate if args.workload == "broadcast" else None,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": result,
+        "processes": processes,
+    }
+
+    latency = result["latency_ms"]
+    print(f"{args.workload}: {args.clients} clients, {size} byte payload, server {args.server}"
+          + (f" ({args.engine} engine)" if args.server != "external" else ""))
+    print(f"  {result['messages']} messages in {result['elapsed_seconds']:.2f} s, "
+          f"{result['messages_per_second']:.0f} msg/s, {result['mb_per_second']:.2f} MB/s")
+    if latency:
+        print(f"  latency ms: p50 {latency['p50']:.3f}  p99 {latency['p99']:.3f}  "
+              f"p999 {latency['p999']:.3f}  max {latency['max']:.3f}")
+    for name, stats in processes.items():
+        if stats:
+            print(f"  {name}: {stats['cpu_percent']:.0f}% CPU, RSS {stats['rss_mb']:.1f} MB "
+                  f"(peak {stats['peak_rss_mb']:.1f} MB)")
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import logging
+import os
+import tempfile
+import threading
+
+from bench.load import LoadServer, run_load
+from websocket_logging import FORMAT, configure_logging, log_frames
+from websocket_server import WebSocketServer
+
+
+def reset_logging():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(logging.WARNING)
+    log_frames(False)
+
+
+def inline(filename):
+    # The setup the server used to install on import: every record formatted and written to the
+    # file by the thread that logs it
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT, filename=filename, filemode='a')
+    log_frames(True)
+
+
+# name: (description, set up logging given a file name, returns a listener or None)
+MODES = {
+    "off": ("no handlers (what importing the modules now does)", lambda filename: None),
+    "quiet": ("file at DEBUG through the queue, frame logging off",
+              lambda filename: configure_logging(filename, console_level=logging.CRITICAL)),
+    "sampled": ("file at DEBUG through the queue, 1 frame in 100 logged",
+                lambda filename: configure_logging(filename, console_level=logging.CRITICAL, frames=True, every=100)),
+    "queued": ("file at DEBUG through the queue, every frame logged",
+               lambda filename: configure_logging(filename, console_level=logging.CRITICAL, frames=True)),
+    "inline": ("file at DEBUG written inline, every frame logged (the old import-time setup)", inline),
+}
+
+
+def echo_rate(mode, engine, clients, duration, directory):
+    filename = os.path.join(directory, f"{mode}.log")
+    listener = MODES[mode][1](filename)
+    server = LoadServer('127.0.0.1', 0, "echo", engine=engine)
+    server.heartbeat_interval = 3600
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    try:
+        return run_load('127.0.0.1', server.sock.getsockname()[1], "echo", clients, 64, duration)["messages_per_second"]
+    finally:
+        server.stop()
+        if listener is not None:
+            listener.stop()
+        reset_logging()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo throughput with logging on and off")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--rounds", type=int, default=2, help="runs of each mode, the best one counts")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    rates = {mode: [] for mode in args.modes}
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(args.rounds):
+            for mode in args.modes:
+                rates[mode].append(echo_rate(mode, args.engine, args.clients, args.duration, directory))
+    baseline = max(rates[args.modes[0]])
+    for mode in args.modes:
+        best = max(rates[mode])
+        print(f"{mode:>8}: {best:8.0f} msg/s ({(best - baseline) / baseline * 100:+6.1f}%)  {MODES[mode][0]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import os
+import time
+
+import websocket_frames
+from websocket_frames import apply_mask
+
+SIZES = [10, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+
+
+def generator_mask(data, masking_key):
+    # The per-byte masking the server and client used before apply_mask
+    return bytes(b ^ masking_key[i % 4] for i, b in enumerate(data))
+
+
+def measure(func, data, masking_key, min_time):
+    # Repeat until min_time has elapsed and return seconds per call
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        func(data, masking_key)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / runs
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size}{unit}"
+        size //= 1024
+    return f"{size}GB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare payload masking implementations")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend per measurement")
+    parser.add_argument("--max-generator-size", type=int, default=64 * 1024 * 1024,
+                        help="skip the generator for payloads larger than this")
+    args = parser.parse_args()
+
+    masking_key = os.urandom(4)
+    print(f"NumPy path: {'enabled' if websocket_frames.numpy is not None else 'not installed'}")
+    print(f"{'size':>8} {'generator MB/s':>16} {'apply_mask MB/s':>16} {'speedup':>9}")
+    for size in SIZES:
+        data = os.urandom(size)
+        fast = measure(apply_mask, data, masking_key, args.min_time)
+        fast_rate = size / fast / 1e6
+        if size <= args.max_generator_size:
+            assert apply_mask(data, masking_key) == generator_mask(data, masking_key)
+            slow = measure(generator_mask, data, masking_key, args.min_time)
+            slow_rate = size / slow / 1e6
+            print(f"{format_size(size):>8} {slow_rate:>16.1f} {fast_rate:>16.1f} {slow / fast:>8.1f}x")
+        else:
+            print(f"{format_size(size):>8} {'skipped':>16} {fast_rate:>16.1f} {'-':>9}")
+
+
+if __name__ == "__main__":
+    main()
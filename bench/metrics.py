@@ -0,0 +1,93 @@
+import argparse
+import logging
+import threading
+import time
+import timeit
+
+from bench.load import LoadServer, run_load
+from websocket_metrics import Counter, Histogram, ServerMetrics
+
+
+class Off:
+    # Stands in for ServerMetrics with recording that does nothing
+    sample_every = 2 ** 62  # Never time anything
+    messages = flushes = 0
+
+    def __init__(self, metrics):
+        self.snapshot = metrics.snapshot
+
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def echo_rate(enabled, clients, duration):
+    server = LoadServer('127.0.0.1', 0, "echo", engine="asyncio")
+    server.heartbeat_interval = 3600
+    if not enabled:
+        server.metrics = Off(server.metrics)
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    try:
+        return run_load('127.0.0.1', server.sock.getsockname()[1], "echo", clients, 64, duration)["messages_per_second"]
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of recording metrics")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--rounds", type=int, default=3, help="alternating runs with metrics on and off")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    counter = Counter()
+    histogram = Histogram()
+    metrics = ServerMetrics(LoadServer.__new__(LoadServer))
+
+    def echo():
+        # What the server records for one echoed message, timing included one time in sample_every
+        metrics.frame_received(0x2, 64)
+        metrics.end_receive(metrics.start_receive())
+        metrics.messages += 1
+        if not metrics.messages % metrics.sample_every:
+            start = time.perf_counter()
+            metrics.handler_seconds.observe(time.perf_counter() - start)
+        metrics.frame_sent(0x2, 64)
+        metrics.flushes += 1
+        if not metrics.flushes % metrics.sample_every:
+            start = time.perf_counter()
+            metrics.send_seconds.observe(time.perf_counter() - start)
+
+    count = 200000
+    costs = {}
+    for name, statement in (("Counter.inc", counter.inc), ("Histogram.observe", lambda: histogram.observe(0.0003)),
+                            ("one echo", echo)):
+        costs[name] = timeit.timeit(statement, number=count) / count
+        print(f"{name:>18}: {costs[name] * 1e9:6.0f} ns")
+
+    # Server and load generator share this process, so any recording cost shows in the rate;
+    # on a busy machine the run to run noise can be larger than the cost itself
+    rates = {True: [], False: []}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            rates[enabled].append(echo_rate(enabled, args.clients, args.duration))
+    off, on = max(rates[False]), max(rates[True])
+    print(f"echo, {args.clients} clients: {off:.0f} msg/s without metrics, {on:.0f} msg/s with "
+          f"({(off - on) / off * 100:+.1f}%, best of {args.rounds})")
+    # Each echo costs the server about 1 / off seconds of the shared CPU
+    print(f"recording adds {costs['one echo'] * 1e6:.2f} us to each echo, "
+          f"{costs['one echo'] * off * 100:.1f}% of the time one takes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from bench.load import run_load, summarize
+from websocket_frames import FrameParser, build_frame_header
+from websocket_server import WebSocketServer
+
+REQUEST = (b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+           b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+
+ROUNDS = 500
+MODES = ("inline", "thread", "process")
+
+
+def work(message):
+    # Stands in for parsing or validating a message: pure Python that holds the GIL throughout.
+    # Returns the message, so the load generator can time the round trip from its stamp.
+    total = 0
+    for _ in range(ROUNDS):
+        for byte in message:
+            total = (total * 31 + byte) & 0xffffffff
+    return message
+
+
+class InlineServer(WebSocketServer):
+    # The work done in on_message, on the I/O thread or the event loop
+    def on_message(self, client, message):
+        self.send_binary(client, work(message))
+
+
+def serve(mode, engine, workers):
+    # Subprocess side: report the port, then serve until terminated
+    logging.disable(logging.ERROR)
+    server = InlineServer('127.0.0.1', 0, engine=engine)
+    server.heartbeat_interval = 3600
+    if mode != "inline":
+        offload = server.enable_offload(work, mode, workers)
+        # Start every worker before the clients connect
+        list(offload.executor.map(work, [b""] * workers * 4))
+    # Stopping the server also shuts the pool down, which spawned workers need in order to exit
+    signal.signal(signal.SIGTERM, lambda *args: server.stop())
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    print(server.sock.getsockname()[1], flush=True)
+    while not server.stopping:
+        time.sleep(0.1)
+
+
+def ping_times(port, interval, duration):
+    # Round trips of pings, which the server answers from its read loop without running the handler
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(REQUEST)
+    parser = FrameParser()
+    head = b""
+    while b"\r\n\r\n" not in head:
+        head += sock.recv(4096)
+    parser.feed(head.split(b"\r\n\r\n", 1)[1])
+    ping = build_frame_header(0x9, 0, masking_key=bytes(4))
+    times = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        sock.sendall(ping)
+        while True:
+            frame = parser.next_frame()
+            if frame is None:
+                parser.recv_into(sock)
+            elif frame.opcode == 0xA:
+                break
+        times.append(time.perf_counter() - start)
+        time.sleep(interval)
+    sock.close()
+    return times
+
+
+def run(mode, engine, workers, clients, duration):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.offload", "--serve", mode, "--engine", engine, "--workers", str(workers)],
+        cwd=root, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        port = int(process.stdout.readline())
+        pings = []
+        prober = threading.Thread(target=lambda: pings.extend(ping_times(port, 0.01, duration)))
+        prober.start()
+        load = run_load('127.0.0.1', port, "echo", clients, 64, duration)
+        prober.join()
+        return load, summarize(pings)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU-heavy handlers inline and on thread or process pools")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4, help="pool size")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--serve", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve:
+        serve(args.serve, args.engine, args.workers)
+        return
+
+    cost = timeit.timeit(lambda: work(bytes(64)), number=200) / 200
+    print(f"handler: {cost * 1e3:.2f} ms of pure Python per message, {os.cpu_count()} CPU(s), "
+          f"{args.engine} engine, {args.clients} clients, {args.workers} workers")
+    for mode in MODES:
+        load, pings = run(mode, args.engine, args.workers, args.clients, args.duration)
+        latency = load["latency_ms"]
+        print(f"{mode:>8}: {load['messages_per_second']:6.0f} msg/s, reply p50 {latency['p50']:7.1f} ms; "
+              f"ping p50 {pings['p50']:6.2f} ms, p99 {pings['p99']:6.2f} ms, max {pings['max']:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
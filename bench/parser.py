@@ -0,0 +1,109 @@
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+from websocket_frames import FrameParser, apply_mask
+
+
+class CountingSocket:
+    # Wraps a socket and counts the receive calls made on it
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+def build_frame(payload):
+    # A masked client-to-server text frame
+    masking_key = os.urandom(4)
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('!BB', 0x81, length | 0x80)
+    elif length <= 65535:
+        header = struct.pack('!BBH', 0x81, 126 | 0x80, length)
+    else:
+        header = struct.pack('!BBQ', 0x81, 127 | 0x80, length)
+    return header + masking_key + apply_mask(payload, masking_key)
+
+
+def recv_exactly(sock, size):
+    # The old reader issued one recv per field; loop so short reads don't desync it
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def read_legacy(sock, count):
+    for _ in range(count):
+        header = recv_exactly(sock, 2)
+        payload_length = header[1] & 0x7F
+        if payload_length == 126:
+            payload_length = struct.unpack('>H', recv_exactly(sock, 2))[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack('>Q', recv_exactly(sock, 8))[0]
+        masking_key = recv_exactly(sock, 4)
+        apply_mask(recv_exactly(sock, payload_length), masking_key)
+
+
+def read_parser(sock, count):
+    parser = FrameParser()
+    received = 0
+    while received < count:
+        frame = parser.next_frame()
+        if frame is None:
+            if not parser.recv_into(sock):
+                raise ConnectionError("Connection closed")
+            continue
+        received += 1
+
+
+def run(reader, frame, count):
+    server_sock, client_sock = socket.socketpair()
+    counting = CountingSocket(server_sock)
+    data = frame * count
+
+    def write():
+        client_sock.sendall(data)
+
+    writer = threading.Thread(target=write)
+    start = time.perf_counter()
+    writer.start()
+    reader(counting, count)
+    elapsed = time.perf_counter() - start
+    writer.join()
+    server_sock.close()
+    client_sock.close()
+    return counting.calls, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count receive syscalls and frames per second")
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 512, 4096, 65536])
+    args = parser.parse_args()
+
+    print(f"{'size':>7} {'reader':>8} {'syscalls':>10} {'per frame':>10} {'frames/s':>12}")
+    for size in args.sizes:
+        frame = build_frame(os.urandom(size))
+        count = max(1, min(args.frames, 256 * 1024 * 1024 // len(frame)))
+        for name, reader in (("legacy", read_legacy), ("parser", read_parser)):
+            calls, elapsed = run(reader, frame, count)
+            print(f"{size:>7} {name:>8} {calls:>10} {calls / count:>10.3f} {count / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from bench.load import STAMP, process_stats, start_server, summarize, usage_between
+from websocket_async_client import WebSocketPool
+from websocket_server import WebSocketServer
+
+
+async def run(port, tasks, connections, requests, size):
+    # `tasks` coroutines share `connections` pooled sockets, each sending `requests` echoes
+    pool = await WebSocketPool('127.0.0.1', port, size=connections, ping_interval=None).start()
+    padding = b"x" * max(size - STAMP.size, 0)
+    latencies = []
+
+    async def worker():
+        for _ in range(requests):
+            async with pool.connection() as client:
+                await client.send(STAMP.pack(time.perf_counter()) + padding)
+                reply = await client.recv()
+                latencies.append(time.perf_counter() - STAMP.unpack_from(reply)[0])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(tasks)))
+    elapsed = time.perf_counter() - start
+    stats = pool.stats()
+    await pool.close()
+    return elapsed, latencies, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Echo requests from many tasks over a WebSocketPool")
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=50, help="pool size")
+    parser.add_argument("--requests", type=int, default=20, help="requests per task")
+    parser.add_argument("--size", type=int, default=64, help="payload size in bytes")
+    parser.add_argument("--engine", choices=WebSocketServer.ENGINES, default="asyncio")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    port, pid, stop = start_server("subprocess", args.engine, "echo")
+    before = process_stats(os.getpid())
+    try:
+        elapsed, latencies, stats = asyncio.run(run(port, args.tasks, args.connections, args.requests, args.size))
+    finally:
+        stop()
+    usage = usage_between(before, process_stats(os.getpid()), elapsed)
+    latency = summarize(latencies)
+    print(f"{args.tasks} tasks over {args.connections} connections, {args.engine} engine")
+    print(f"  {len(latencies)} requests in {elapsed:.2f} s, {len(latencies) / elapsed:.0f} req/s, "
+          f"{stats['created']} connections opened, {stats['reused']} reuses")
+    print(f"  latency ms: p50 {latency['p50']:.3f}  p99 {latency['p99']:.3f}  max {latency['max']:.3f}")
+    if usage:
+        print(f"  client: {usage['cpu_percent']:.0f}% CPU, RSS {usage['rss_mb']:.1f} MB, 1 thread")
+
+
+if __name__ == "__main__":
+    main()
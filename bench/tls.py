@@ -0,0 +1,127 @@
+import argparse
+import base64
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from websocket_handshake import read_head
+from websocket_server import WebSocketServer
+from websocket_tls import client_context
+
+REQUEST = (b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+           b"Sec-WebSocket-Key: " + base64.b64encode(os.urandom(16)) + b"\r\nSec-WebSocket-Version: 13\r\n\r\n")
+
+
+class LegacyListener:
+    # A listening socket wrapped in TLS, which also skips connections whose handshake fails
+    # (the old server let such an error end its accept loop)
+    def __init__(self, sock):
+        self.sock = sock
+
+    def accept(self):
+        while True:
+            try:
+                return self.sock.accept()
+            except (ssl.SSLError, ConnectionError, TimeoutError):
+                continue
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class LegacyServer(WebSocketServer):
+    # TLS the way the server used to do it: the listening socket is wrapped, so accept() runs
+    # each handshake itself, one connection at a time
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ssl_context = None  # Connections arrive already wrapped
+
+    def create_socket(self, reuse_port=False):
+        return LegacyListener(self.ssl_context.wrap_socket(super().create_socket(reuse_port), server_side=True))
+
+
+def make_certificate(directory):
+    certfile, keyfile = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                    "-keyout", keyfile, "-out", certfile, "-days", "1", "-nodes", "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def setup_rate(port, cafile, threads, duration, reuse, stalled=0):
+    # Connections set up (TLS and upgrade) per second from `threads` threads. Without reuse every
+    # connection builds its own context and does a full handshake, as the client used to;
+    # `stalled` connections are opened first and never start their TLS handshake.
+    idle = [socket.create_connection(('127.0.0.1', port)) for _ in range(stalled)]
+    shared = client_context(cafile)
+    counts = [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def connect(index):
+        session = None
+        while time.perf_counter() < deadline:
+            context = shared if reuse else client_context(cafile)
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=max(deadline - time.perf_counter(), 0.01))
+                tls = context.wrap_socket(sock, server_hostname='127.0.0.1', session=session)
+                tls.sendall(REQUEST)
+                read_head(tls)
+            except OSError:
+                continue
+            if reuse:
+                session = tls.session
+            tls.close()
+            counts[index] += 1
+
+    workers = [threading.Thread(target=connect, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    for sock in idle:
+        sock.close()
+    return sum(counts) / duration
+
+
+def run(server_class, engine, certfile, keyfile, *args, **kwargs):
+    server = server_class('127.0.0.1', 0, use_ssl=True, certfile=certfile, keyfile=keyfile, engine=engine)
+    server.heartbeat_interval = 3600
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    try:
+        return setup_rate(server.sock.getsockname()[1], certfile, *args, **kwargs)
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS connection setup rate")
+    parser.add_argument("--threads", type=int, default=4, help="connecting threads")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)  # Connections cut off when a run ends are not news
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = make_certificate(directory)
+        cases = (
+            ("before: handshake in accept(), new client context each time", LegacyServer, "threaded", False),
+            ("after: threaded, shared contexts, full handshakes", WebSocketServer, "threaded", False),
+            ("after: threaded, shared contexts, resumed sessions", WebSocketServer, "threaded", True),
+            ("after: asyncio, shared contexts, resumed sessions", WebSocketServer, "asyncio", True),
+        )
+        for name, server_class, engine, reuse in cases:
+            rate = run(server_class, engine, certfile, keyfile, args.threads, args.duration, reuse)
+            print(f"{name:>58}: {rate:7.0f} connections/s")
+        # One client that connects and sends nothing
+        for name, server_class in (("before", LegacyServer), ("after", WebSocketServer)):
+            rate = run(server_class, "threaded", certfile, keyfile, args.threads, args.duration, True, stalled=1)
+            print(f"{name + ', with one stalled client':>58}: {rate:7.0f} connections/s")
+
+
+if __name__ == "__main__":
+    main()
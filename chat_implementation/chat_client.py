@@ -1,27 +1,37 @@
 import logging
-import threading
-from websocket_client import WebSocketClient
+from websocket_reconnect import ReconnectingClient
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class ChatClient(WebSocketClient):
-    def __init__(self, host, port):
-        super().__init__(host, port)
+class ChatClient(ReconnectingClient):
+    # Reconnects on its own: each new connection logs in again and asks for the messages it missed
+    def __init__(self, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
         self.username = None
+        self.last_seq = None  # Newest numbered message received; the server replays what came after it
 
     def connect(self):
-        super().connect()
         self.username = input("Enter your username: ")
+        super().connect()
+
+    def open(self):
+        # Until a numbered message has arrived there is nothing to catch up on: ask for numbering only
+        self.path = f"/?last_seq={'latest' if self.last_seq is None else self.last_seq}"
+        super().open()
+
+    def on_connected(self):
+        # The first message of a connection is the username, ahead of anything queued meanwhile
         self.send_message(self.username)
-        threading.Thread(target=self.receive_messages, daemon=True).start()
+
+    def on_disconnected(self):
+        print("Connection lost, reconnecting...")
 
     def receive_messages(self):
         while True:
             try:
                 message = self.receive_message()
-                if message:
-                    print(message)
+                if message is not None:
+                    print(self.read_sequence(message))
                 else:
                     logger.info("Connection closed by server")
                     break
@@ -29,10 +39,19 @@ class ChatClient(WebSocketClient):
                 logger.error(f"Error receiving message: {e}", exc_info=True)
                 break
 
+    def read_sequence(self, message):
+        # Strip the "<seq>|" prefix of room messages, remembering the newest sequence seen
+        sequence, separator, text = message.partition("|")
+        if not separator or not sequence.isdigit():
+            return message
+        self.last_seq = max(self.last_seq or 0, int(sequence))
+        return text
+
     def send_chat_message(self, message):
         self.send_message(message)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     client = ChatClient('localhost', 8765)
     client.connect()
 
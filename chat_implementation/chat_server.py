@@ -1,61 +1,230 @@
 import logging
+from urllib.parse import parse_qs, urlsplit
+from websocket_connection import Connection
 from websocket_server import WebSocketServer
+from chat_implementation.history import MessageHistory
+from chat_implementation.topic_router import TopicRouter
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+LOBBY = "lobby"
+
+class ChatConnection(Connection):
+    __slots__ = ("username", "room", "last_seen")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.username = None  # Set by the first message
+        self.room = None  # The room the user talks in
+        self.last_seen = None  # Last sequence the client had seen when it connected, if it asked for history
+
 class ChatServer(WebSocketServer):
-    def __init__(self, host, port):
-        super().__init__(host, port)
-        self.clients = {}  # {client_socket: username}
+    # Users talk in rooms (topics). Everyone starts in the lobby; commands:
+    #   /join <room or pattern>   subscribe, and talk in the room from now on
+    #   /leave <room or pattern>  unsubscribe
+    #   /to <room> <message>      say something in a room without switching to it
+    # Patterns use "*" for one segment and a trailing "#" for any number, e.g. "sports.*"
+    #
+    # Room messages are numbered and kept in a MessageHistory (history=False turns it off). A client
+    # that connects with "?last_seq=N" (or an X-Last-Seq header) receives "<seq>|<message>" and,
+    # for the lobby and every room it joins, the messages after N it missed; "?last_seq=latest"
+    # asks for numbered messages without a replay. Sequences are local to a process, so there is
+    # no replay behind workers or on a bus, where a client may come back to another numbering.
+    connection_class = ChatConnection
 
-    def handle_client(self, client, address):
-        logger.info(f"New connection from {address}")
-        try:
-            self.handshake(client)
-            self.register_client(client)
-            self.handle_messages(client)
-        except Exception as e:
-            logger.error(f"Error handling client {address}: {e}", exc_info=True)
-        finally:
-            self.unregister_client(client)
-            client.close()
-            logger.info(f"Connection closed for {address}")
-
-    def register_client(self, client):
+    def __init__(self, host, port, history=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.router = TopicRouter()
+        if history is None:
+            history = MessageHistory()
+        self.history = history or None
+        self.sequenced = 0  # Connected clients that asked for history, and get numbered messages
+
+    def on_open(self, client):
+        last_seen = self.last_seen(client)
+        if last_seen is not None:
+            if self.can_replay():
+                self.get_state(client).last_seen = last_seen
+                self.sequenced += 1
+            else:
+                self.send_message(client, "Message history is not available on this server")
         self.send_message(client, "Welcome! Please enter your username:")
-        username = self.receive_message(client).strip()
-        self.clients[client] = username
+
+    def can_replay(self):
+        # Only a lone process numbers every message a client can receive
+        return self.history is not None and self.channel is None and self.worker_id is None
+
+    def last_seen(self, client):
+        # The last_seq a client sent in its upgrade request, None if it did not ask for history
+        request = self.get_request(client)
+        if request is None or self.history is None:
+            return None
+        path, headers = request
+        value = parse_qs(urlsplit(path).query).get("last_seq", [headers.get("x-last-seq")])[0]
+        if value == "latest":
+            return self.history.sequence
+        try:
+            return int(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def on_message(self, client, message):
+        if isinstance(message, bytes):
+            return  # The chat only carries text
+        # The first message of a connection is its username
+        conn = self.get_state(client)
+        if conn.username is None:
+            self.register_client(client, message.strip())
+        elif message.startswith("/"):
+            self.handle_command(client, conn.username, message)
+        else:
+            self.broadcast(f"{conn.username}: {message}", conn.room)
+
+    def on_close(self, client):
+        self.unregister_client(client)
+
+    def register_client(self, client, username):
+        conn = self.get_state(client)
+        conn.username = username
+        conn.room = LOBBY
+        self.router.subscribe(client, LOBBY)
+        self.replay(client, LOBBY)
         self.broadcast(f"{username} has joined the chat!")
 
     def unregister_client(self, client):
-        if client in self.clients:
-            username = self.clients[client]
-            del self.clients[client]
+        conn = self.clients.get(client)
+        if conn is None:
+            return
+        if conn.last_seen is not None:
+            conn.last_seen = None
+            self.sequenced -= 1
+        if conn.username is not None:
+            username, conn.username, conn.room = conn.username, None, None
+            self.router.unsubscribe_all(client)
             self.broadcast(f"{username} has left the chat.")
 
-    def handle_messages(self, client):
-        while True:
-            try:
-                message = self.receive_message(client)
-                if message:
-                    username = self.clients[client]
-                    self.broadcast(f"{username}: {message}")
+    def handle_command(self, client, username, message):
+        conn = self.get_state(client)
+        command, _, argument = message.partition(" ")
+        argument = argument.strip()
+        try:
+            if command == "/join" and argument:
+                self.router.subscribe(client, argument)
+                if "*" in argument or "#" in argument:
+                    self.send_message(client, f"Subscribed to {argument}")
                 else:
-                    break
-            except Exception as e:
-                logger.error(f"Error handling message: {e}", exc_info=True)
-                break
-
-    def broadcast(self, message):
-        logger.info(f"Broadcasting: {message}")
-        for client in self.clients:
-            try:
-                self.send_message(client, message)
-            except Exception as e:
-                logger.error(f"Error sending message to client: {e}", exc_info=True)
+                    conn.room = argument
+                    self.replay(client, argument)
+                    self.broadcast(f"{username} joined {argument}", argument)
+            elif command == "/leave" and argument:
+                if self.router.unsubscribe(client, argument) and conn.room == argument:
+                    conn.room = LOBBY
+                self.send_message(client, f"Left {argument}")
+            elif command == "/to" and " " in argument:
+                room, text = argument.split(" ", 1)
+                self.broadcast(f"[{room}] {username}: {text}", room)
+            else:
+                self.send_message(client, "Commands: /join <room>, /leave <room>, /to <room> <message>")
+        except ValueError as e:
+            self.send_message(client, str(e))
+
+    def replay(self, client, room):
+        # Send a sequenced client what it missed in a room, corked so the batch goes out in few writes
+        last_seen = self.get_state(client).last_seen
+        if last_seen is None:
+            return
+        messages, missed = self.history.since(room, last_seen)
+        if not messages and not missed:
+            return
+        with self.corked(client):
+            if missed:
+                self.send_message(client, f"Some older messages in {room} are no longer available")
+            for sequence, message in messages:
+                self.send_message(client, f"{sequence}|{message}")
+
+    def broadcast(self, message, room=LOBBY):
+        logger.info(f"Broadcasting to {room}: {message}")
+        self.deliver(room, message)
+        if self.channel is not None:
+            # Users connected to other worker processes
+            self.channel.publish(f"{room}\n{message}")
+
+    def deliver(self, room, message):
+        # Only the room's subscribers are visited, and each frame is encoded once for all of them
+        subscribers = self.router.route(room)
+        if self.history is None:
+            self.broadcast_to(subscribers, message)
+            return
+        sequence = self.history.append(room, message)
+        if not self.sequenced:
+            self.broadcast_to(subscribers, message)
+            return
+        plain, numbered = [], []
+        for client in subscribers:
+            conn = self.clients.get(client)
+            if conn is not None and conn.last_seen is not None:
+                numbered.append(client)
+            else:
+                plain.append(client)
+        if plain:
+            self.broadcast_to(plain, message)
+        if numbered:
+            self.broadcast_to(numbered, f"{sequence}|{message}")
+
+    def publish(self, message):
+        # Every client of every node, like WebSocketServer.publish(); on the channel an empty room
+        # tells it apart from a room broadcast
+        self.broadcast_to(list(self.clients), message)
+        if self.channel is not None:
+            self.channel.publish(f"\n{message}" if isinstance(message, str) else message)
+
+    def on_channel_message(self, message):
+        # Other nodes number their messages themselves; this node keeps its own sequence, which is
+        # why can_replay() is off here
+        room, separator, text = message.partition("\n") if isinstance(message, str) else ("", "", "")
+        if not room or not separator:
+            # publish() on another node (an empty room), or a bare message
+            super().on_channel_message(text if separator else message)
+            return
+        self.deliver(room, text)
+
+    def get_topic_stats(self, room=None):
+        # Messages, deliveries and fan-out per room
+        return self.router.stats(room)
+
+    def get_history_stats(self):
+        return self.history.stats() if self.history is not None else None
 
 if __name__ == "__main__":
-    server = ChatServer('localhost', 8765)
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    def address(value):
+        host, port = value.rsplit(":", 1)
+        return host, int(port)
+
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("engine", nargs="?", default="threaded", choices=ChatServer.ENGINES)
+    parser.add_argument("workers", nargs="?", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--bus", type=address, metavar="HOST:PORT",
+                        help="join a cluster of chat nodes, listening for the other nodes here")
+    parser.add_argument("--peer", type=address, action="append", default=[], metavar="HOST:PORT",
+                        help="bus address of another node (repeat for each)")
+    parser.add_argument("--history-dir", metavar="DIR",
+                        help="also keep room history in memory-mapped files here, to survive restarts")
+    args = parser.parse_args()
+
+    history = None
+    if args.history_dir:
+        if args.workers > 1 or args.bus:
+            parser.error("--history-dir needs a single worker and no --bus; each process keeps its own history")
+        from chat_implementation.history import SegmentLog
+        history = MessageHistory(log=SegmentLog(args.history_dir))
+    server = ChatServer('localhost', args.port, engine=args.engine, history=history)
+    if args.bus:
+        from websocket_bus import TcpMeshBus
+        server.attach_bus(TcpMeshBus(args.bus, args.peer))
     logger.info("Chat server starting...")
-    server.start()
\ No newline at end of file
+    server.serve(workers=args.workers)
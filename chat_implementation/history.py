@@ -0,0 +1,184 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections import deque
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+
+class RoomHistory:
+    # The most recent messages of one room, capped by count and by memory
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = deque()  # (sequence, message), oldest first
+        self.size = 0  # Memory held by the messages
+        self.evicted = 0  # Sequence of the newest message dropped to stay under the caps
+
+    def append(self, sequence, message):
+        self.messages.append((sequence, message))
+        self.size += sys.getsizeof(message)
+        while len(self.messages) > self.max_messages or (self.size > self.max_bytes and len(self.messages) > 1):
+            self.evicted, dropped = self.messages.popleft()
+            self.size -= sys.getsizeof(dropped)
+
+    def since(self, last_seen):
+        # Messages after last_seen, and whether some of them were already dropped
+        missed = last_seen < self.evicted
+        if not self.messages or self.messages[-1][0] <= last_seen:
+            return [], missed
+        # Sequences are shared by every room, so they increase here but have gaps; the gap a
+        # reconnecting client asks for is usually short, so search from the newest end
+        start = len(self.messages)
+        while start > 0 and self.messages[start - 1][0] > last_seen:
+            start -= 1
+        return list(islice(self.messages, start, None)), missed
+
+
+class MessageHistory:
+    # Recent messages of every room, numbered with one increasing sequence for the whole server.
+    # With a SegmentLog, messages are also written to disk and reloaded after a restart.
+    def __init__(self, max_messages=1000, max_bytes=1024 * 1024, log=None):
+        self.max_messages = max_messages  # Per room
+        self.max_bytes = max_bytes  # Per room
+        self.rooms = {}  # {room: RoomHistory}
+        self.sequence = 0
+        self.log = log
+        self.lock = threading.Lock()
+        if log is not None:
+            for sequence, room, message in log.replay():
+                self._store(sequence, room, message)
+                self.sequence = max(self.sequence, sequence)
+
+    def append(self, room, message):
+        with self.lock:
+            self.sequence += 1
+            self._store(self.sequence, room, message)
+            if self.log is not None:
+                self.log.append(self.sequence, room, message)
+            return self.sequence
+
+    def _store(self, sequence, room, message):
+        history = self.rooms.get(room)
+        if history is None:
+            history = self.rooms[room] = RoomHistory(self.max_messages, self.max_bytes)
+        history.append(sequence, message)
+
+    def since(self, room, last_seen):
+        # ([(sequence, message), ...] after last_seen, True if some of the gap is no longer kept)
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None:
+                return [], False
+            return history.since(last_seen)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sequence": self.sequence,
+                "rooms": len(self.rooms),
+                "messages": sum(len(history.messages) for history in self.rooms.values()),
+                "bytes": sum(history.size for history in self.rooms.values()),
+            }
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+class SegmentLog:
+    # Append-only log of (sequence, room, message) records in fixed size, memory-mapped segment
+    # files. Appends are memory writes; the kernel writes the pages back, so the log survives a
+    # crash of the process. Old segments are deleted beyond max_segments.
+    RECORD = struct.Struct('!QHI')  # Sequence (0 marks the end of a segment), room and message lengths
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_segments=8):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(name for name in os.listdir(directory)
+                               if name.startswith("history-") and name.endswith(".log"))
+        self.map = None
+        self.position = 0
+        if self.segments:
+            self.open(self.segments[-1])
+            self.position = self.end_of(self.map)
+        else:
+            self.roll()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def open(self, name):
+        with open(self.path(name), "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+
+    def roll(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        index = int(self.segments[-1][8:-4]) + 1 if self.segments else 0
+        name = f"history-{index:08d}.log"
+        with open(self.path(name), "wb") as f:
+            f.truncate(self.segment_size)
+        self.segments.append(name)
+        self.open(name)
+        self.position = 0
+        while len(self.segments) > self.max_segments:
+            os.remove(self.path(self.segments.pop(0)))
+
+    def append(self, sequence, room, message):
+        room = room.encode('utf-8')
+        message = message.encode('utf-8')
+        size = self.RECORD.size + len(room) + len(message)
+        if size + self.RECORD.size > self.segment_size:
+            logger.warning(f"Message {sequence} is larger than a history segment, not logged")
+            return
+        # Keep room for the zero header that marks the end of the segment
+        if self.position + size + self.RECORD.size > self.segment_size:
+            self.roll()
+        end = self.position + size
+        self.map[self.position + self.RECORD.size:end] = room + message
+        self.RECORD.pack_into(self.map, self.position, sequence, len(room), len(message))
+        self.position = end
+
+    def records(self, data):
+        position = 0
+        while position + self.RECORD.size <= len(data):
+            sequence, room_length, message_length = self.RECORD.unpack_from(data, position)
+            if sequence == 0:
+                return
+            start = position + self.RECORD.size
+            end = start + room_length + message_length
+            if end > len(data):
+                return
+            yield position, end, sequence, data[start:start + room_length], data[start + room_length:end]
+            position = end
+
+    def end_of(self, data):
+        end = 0
+        for start, end, sequence, room, message in self.records(data):
+            pass
+        return end
+
+    def replay(self):
+        # Every logged record, oldest first
+        for name in self.segments:
+            with open(self.path(name), "rb") as f:
+                data = f.read()
+            for start, end, sequence, room, message in self.records(data):
+                yield sequence, room.decode('utf-8'), message.decode('utf-8')
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
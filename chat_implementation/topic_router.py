@@ -0,0 +1,154 @@
+import threading
+
+# Topics are dot separated names like "sports.football". In a subscription pattern "*" matches
+# exactly one segment and "#", only allowed last, matches any number of trailing segments (or none).
+SEPARATOR = "."
+ONE = "*"
+REST = "#"
+
+
+class _Node:
+    # One segment of the wildcard trie
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+
+class TopicRouter:
+    # Maps topics to their subscribers. Plain topics are looked up in a dict and wildcard patterns
+    # in a trie, so routing a message costs O(its subscribers), not O(every client).
+    def __init__(self):
+        self.exact = {}  # {topic: set of subscribers}
+        self.patterns = _Node()  # Trie of the subscriptions that use wildcards
+        self.wildcards = 0  # Number of wildcard subscriptions in the trie
+        self.subscriptions = {}  # {subscriber: set of topics and patterns}
+        self.fanout = {}  # {topic: [messages routed, deliveries, largest fan-out]}
+        self.lock = threading.Lock()
+
+    def subscribe(self, subscriber, pattern):
+        segments = split_pattern(pattern)
+        with self.lock:
+            topics = self.subscriptions.setdefault(subscriber, set())
+            if pattern in topics:
+                return False
+            topics.add(pattern)
+            if ONE in segments or REST in segments:
+                node = self.patterns
+                for segment in segments:
+                    node = node.children.setdefault(segment, _Node())
+                node.subscribers.add(subscriber)
+                self.wildcards += 1
+            else:
+                self.exact.setdefault(pattern, set()).add(subscriber)
+            return True
+
+    def unsubscribe(self, subscriber, pattern):
+        with self.lock:
+            return self._unsubscribe(subscriber, pattern)
+
+    def unsubscribe_all(self, subscriber):
+        # Drop every subscription of a subscriber, e.g. when its connection closes
+        with self.lock:
+            for pattern in list(self.subscriptions.get(subscriber, ())):
+                self._unsubscribe(subscriber, pattern)
+
+    def _unsubscribe(self, subscriber, pattern):
+        topics = self.subscriptions.get(subscriber)
+        if not topics or pattern not in topics:
+            return False
+        topics.discard(pattern)
+        if not topics:
+            del self.subscriptions[subscriber]
+        segments = pattern.split(SEPARATOR)
+        if ONE in segments or REST in segments:
+            # Remove the subscriber, then prune the branch nodes it leaves empty
+            path = [self.patterns]
+            for segment in segments:
+                path.append(path[-1].children[segment])
+            path[-1].subscribers.discard(subscriber)
+            self.wildcards -= 1
+            for parent, segment, node in zip(reversed(path[:-1]), reversed(segments), reversed(path[1:])):
+                if node.subscribers or node.children:
+                    break
+                del parent.children[segment]
+        else:
+            subscribers = self.exact[pattern]
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.exact[pattern]
+        return True
+
+    def topics(self, subscriber):
+        with self.lock:
+            return set(self.subscriptions.get(subscriber, ()))
+
+    def match(self, topic):
+        # Every subscriber of a topic, through its name or a matching pattern
+        segments = split_topic(topic)
+        with self.lock:
+            subscribers = self.exact.get(topic)
+            if not self.wildcards:
+                return list(subscribers) if subscribers else []
+            found = set(subscribers) if subscribers else set()
+            _collect(self.patterns, segments, 0, found)
+            return list(found)
+
+    def route(self, topic):
+        # Like match(), and counts the fan-out for stats()
+        subscribers = self.match(topic)
+        with self.lock:
+            counts = self.fanout.setdefault(topic, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += len(subscribers)
+            counts[2] = max(counts[2], len(subscribers))
+        return subscribers
+
+    def stats(self, topic=None):
+        # Fan-out per routed topic: messages, deliveries, and the mean and largest fan-out
+        with self.lock:
+            if topic is None:
+                items = list(self.fanout.items())
+            else:
+                items = [(topic, self.fanout[topic])] if topic in self.fanout else []
+            return {
+                name: {
+                    "messages": messages,
+                    "deliveries": deliveries,
+                    "mean_fanout": deliveries / messages if messages else 0.0,
+                    "max_fanout": largest,
+                }
+                for name, (messages, deliveries, largest) in items
+            }
+
+
+def _collect(node, segments, index, found):
+    rest = node.children.get(REST)
+    if rest is not None:
+        found.update(rest.subscribers)
+    if index == len(segments):
+        found.update(node.subscribers)
+        return
+    child = node.children.get(segments[index])
+    if child is not None:
+        _collect(child, segments, index + 1, found)
+    child = node.children.get(ONE)
+    if child is not None:
+        _collect(child, segments, index + 1, found)
+
+
+def split_topic(topic):
+    segments = topic.split(SEPARATOR)
+    if not all(segments) or ONE in segments or REST in segments or "\n" in topic:
+        raise ValueError(f"Invalid topic {topic!r}")
+    return segments
+
+
+def split_pattern(pattern):
+    segments = pattern.split(SEPARATOR)
+    if not all(segments) or "\n" in pattern:
+        raise ValueError(f"Invalid topic pattern {pattern!r}")
+    if REST in segments[:-1]:
+        raise ValueError(f"'{REST}' must be the last segment of {pattern!r}")
+    if any(segment != ONE and segment != REST and (ONE in segment or REST in segment) for segment in segments):
+        raise ValueError(f"Wildcards must fill a whole segment in {pattern!r}")
+    return segments
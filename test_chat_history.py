@@ -0,0 +1,159 @@
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from chat_implementation.chat_client import ChatClient
+from chat_implementation.chat_server import ChatServer
+from chat_implementation.history import MessageHistory, RoomHistory, SegmentLog
+
+
+class TestMessageHistory(unittest.TestCase):
+    def test_sequence_is_shared_by_rooms(self):
+        history = MessageHistory()
+        self.assertEqual(history.append("lobby", "a"), 1)
+        self.assertEqual(history.append("games", "b"), 2)
+        self.assertEqual(history.append("lobby", "c"), 3)
+        self.assertEqual(history.since("lobby", 0), ([(1, "a"), (3, "c")], False))
+        self.assertEqual(history.since("lobby", 1), ([(3, "c")], False))
+        self.assertEqual(history.since("lobby", 3), ([], False))
+        self.assertEqual(history.since("missing", 0), ([], False))
+
+    def test_count_cap_reports_missed_messages(self):
+        history = MessageHistory(max_messages=3)
+        for i in range(10):
+            history.append("lobby", str(i))
+        self.assertEqual(history.since("lobby", 5), ([(8, "7"), (9, "8"), (10, "9")], True))
+        self.assertEqual(history.since("lobby", 7), ([(8, "7"), (9, "8"), (10, "9")], False))
+
+    def test_memory_cap(self):
+        room = RoomHistory(max_messages=1000, max_bytes=10000)
+        for i in range(100):
+            room.append(i + 1, "x" * 1000)
+        self.assertLessEqual(room.size, 10000)
+        self.assertLess(len(room.messages), 100)
+        self.assertEqual(room.messages[-1][0], 100)
+        # A single message larger than the cap is still kept
+        room.append(101, "y" * 20000)
+        self.assertEqual(list(room.messages), [(101, "y" * 20000)])
+
+
+class TestSegmentLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_history_survives_a_restart(self):
+        history = MessageHistory(log=SegmentLog(self.directory))
+        history.append("lobby", "hello")
+        history.append("games", "héllo")
+        history.close()
+
+        history = MessageHistory(log=SegmentLog(self.directory))
+        self.assertEqual(history.since("lobby", 0), ([(1, "hello")], False))
+        self.assertEqual(history.since("games", 0), ([(2, "héllo")], False))
+        self.assertEqual(history.append("lobby", "again"), 3)
+        history.close()
+        self.assertEqual([record[0] for record in SegmentLog(self.directory).replay()], [1, 2, 3])
+
+    def test_segments_roll_and_expire(self):
+        log = SegmentLog(self.directory, segment_size=256, max_segments=2)
+        for sequence in range(1, 51):
+            log.append(sequence, "lobby", f"message {sequence}")
+        log.close()
+        self.assertEqual(len(log.segments), 2)
+        sequences = [record[0] for record in SegmentLog(self.directory, segment_size=256).replay()]
+        self.assertEqual(sequences, list(range(sequences[0], 51)))
+        self.assertGreater(sequences[0], 1)
+
+
+class TestChatReplay(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer('127.0.0.1', 0)
+        self.server.broadcast_to = Mock()
+        self.server.send_message = Mock()
+        self.requests = {}
+        self.server.get_request = lambda client: self.requests.get(client)
+
+    def join(self, name, path="/"):
+        client = Mock()
+        self.requests[client] = (path, {})
+        self.server.on_open(client)
+        self.server.on_message(client, name)
+        return client
+
+    def sent(self, client):
+        return [c[0][1] for c in self.server.send_message.call_args_list if c[0][0] is client]
+
+    def test_plain_clients_get_plain_messages(self):
+        alice = self.join("alice")
+        self.server.on_message(alice, "hi")
+        self.server.broadcast_to.assert_called_with([alice], "alice: hi")
+
+    def test_reconnect_replays_the_gap(self):
+        alice = self.join("alice")
+        self.server.on_message(alice, "one")
+        self.server.on_message(alice, "two")
+        bob = self.join("bob", "/?last_seq=2")
+        self.assertEqual(self.sent(bob)[1:], ["3|alice: two"])
+        # Bob's copy of new messages is numbered, Alice's is not
+        self.server.on_message(alice, "three")
+        calls = {tuple(c[0][0]): c[0][1] for c in self.server.broadcast_to.call_args_list[-2:]}
+        self.assertEqual(calls, {(alice,): "alice: three", (bob,): "5|alice: three"})
+
+    def test_header_and_joined_rooms(self):
+        alice = self.join("alice")
+        self.server.on_message(alice, "/join games")
+        self.server.on_message(alice, "move")
+        client = Mock()
+        self.requests[client] = ("/", {"x-last-seq": "0"})
+        self.server.on_open(client)
+        self.server.on_message(client, "bob")
+        self.server.on_message(client, "/join games")
+        self.assertIn("3|alice: move", self.sent(client))
+
+    def test_latest_numbers_without_replay(self):
+        alice = self.join("alice")
+        self.server.on_message(alice, "one")
+        bob = self.join("bob", "/?last_seq=latest")
+        self.assertEqual(self.sent(bob), ["Welcome! Please enter your username:"])
+        self.server.on_message(alice, "two")
+        self.assertEqual(self.server.broadcast_to.call_args_list[-1][0], ([bob], "4|alice: two"))
+
+    def test_no_replay_behind_workers_or_a_bus(self):
+        alice = self.join("alice")
+        self.server.on_message(alice, "one")
+        for setting in ("worker_id", "channel"):
+            setattr(self.server, setting, Mock())
+            bob = self.join("bob", "/?last_seq=0")
+            self.assertEqual(self.sent(bob)[0], "Message history is not available on this server")
+            self.assertNotIn("2|alice: one", self.sent(bob))
+            self.assertEqual(self.server.sequenced, 0)
+            setattr(self.server, setting, None)
+
+    def test_history_can_be_turned_off(self):
+        server = ChatServer('127.0.0.1', 0, history=False)
+        server.broadcast_to = Mock()
+        server.send_message = Mock()
+        server.get_request = lambda client: ("/?last_seq=0", {})
+        client = Mock()
+        server.on_open(client)
+        server.on_message(client, "alice")
+        server.broadcast_to.assert_called_with([client], "alice has joined the chat!")
+        self.assertIsNone(server.get_history_stats())
+
+
+class TestChatClient(unittest.TestCase):
+    @patch('websocket_client.WebSocketClient.open')
+    def test_asks_for_a_replay_only_after_a_numbered_message(self, open):
+        client = ChatClient('127.0.0.1', 1)
+        client.open()
+        self.assertEqual(client.path, "/?last_seq=latest")
+        self.assertEqual(client.read_sequence("Welcome!"), "Welcome!")
+        self.assertEqual(client.read_sequence("7|alice: hi"), "alice: hi")
+        client.open()
+        self.assertEqual(client.path, "/?last_seq=7")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+# Fakes shared by the test modules; nothing here is collected as a test
+
+
+def feed_recv_into(mock_sock, *chunks):
+    # Serve each chunk from one recv_into call, then EOF
+    chunks = list(chunks)
+    def recv_into(buffer):
+        if not chunks:
+            return 0
+        chunk = chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    mock_sock.recv_into.side_effect = recv_into
+    # Registered connections write through their outbox, which needs real byte counts
+    mock_sock.send.side_effect = lambda data, flags=0: len(data)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import Mock
+
+from chat_implementation.chat_server import ChatServer
+from chat_implementation.topic_router import TopicRouter
+
+
+class TestTopicRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = TopicRouter()
+
+    def test_exact_topics(self):
+        self.router.subscribe("a", "lobby")
+        self.router.subscribe("b", "lobby")
+        self.router.subscribe("c", "games")
+        self.assertEqual(sorted(self.router.match("lobby")), ["a", "b"])
+        self.assertEqual(self.router.match("games"), ["c"])
+        self.assertEqual(self.router.match("empty"), [])
+
+    def test_wildcards(self):
+        self.router.subscribe("one", "sports.*")
+        self.router.subscribe("rest", "sports.#")
+        self.router.subscribe("all", "#")
+        self.router.subscribe("exact", "sports.football")
+        self.assertEqual(sorted(self.router.match("sports.football")), ["all", "exact", "one", "rest"])
+        self.assertEqual(sorted(self.router.match("sports")), ["all", "rest"])
+        self.assertEqual(sorted(self.router.match("sports.football.scores")), ["all", "rest"])
+        self.assertEqual(self.router.match("news"), ["all"])
+
+    def test_subscriber_matched_twice_is_delivered_once(self):
+        self.router.subscribe("a", "sports.*")
+        self.router.subscribe("a", "sports.football")
+        self.assertEqual(self.router.match("sports.football"), ["a"])
+
+    def test_unsubscribe_prunes_the_trie(self):
+        self.router.subscribe("a", "sports.*.scores")
+        self.assertTrue(self.router.unsubscribe("a", "sports.*.scores"))
+        self.assertFalse(self.router.unsubscribe("a", "sports.*.scores"))
+        self.assertEqual(self.router.patterns.children, {})
+        self.assertEqual(self.router.wildcards, 0)
+
+    def test_unsubscribe_all(self):
+        self.router.subscribe("a", "lobby")
+        self.router.subscribe("a", "sports.#")
+        self.router.subscribe("b", "lobby")
+        self.router.unsubscribe_all("a")
+        self.assertEqual(self.router.match("lobby"), ["b"])
+        self.assertEqual(self.router.match("sports.football"), [])
+        self.assertEqual(self.router.topics("a"), set())
+
+    def test_invalid_names(self):
+        for pattern in ("", "a..b", "#.a", "a*"):
+            with self.assertRaises(ValueError):
+                self.router.subscribe("a", pattern)
+        with self.assertRaises(ValueError):
+            self.router.match("sports.*")
+
+    def test_stats(self):
+        for name in ("a", "b", "c"):
+            self.router.subscribe(name, "lobby")
+        self.router.route("lobby")
+        self.router.unsubscribe("c", "lobby")
+        self.router.route("lobby")
+        self.assertEqual(self.router.stats("lobby"), {
+            "lobby": {"messages": 2, "deliveries": 5, "mean_fanout": 2.5, "max_fanout": 3}
+        })
+        self.assertEqual(self.router.stats("missing"), {})
+
+
+class TestChatRooms(unittest.TestCase):
+    def setUp(self):
+        self.server = ChatServer('127.0.0.1', 0)
+        self.server.broadcast_to = Mock()
+
+    def join(self, name):
+        client = Mock()
+        self.server.send_message = Mock()
+        self.server.on_message(client, name)
+        return client
+
+    def recipients(self):
+        clients, message = self.server.broadcast_to.call_args[0]
+        return set(clients), message
+
+    def test_messages_reach_only_the_room(self):
+        alice, bob, carol = self.join("alice"), self.join("bob"), self.join("carol")
+        self.server.on_message(alice, "/join games")
+        self.server.on_message(bob, "/join games")
+        self.server.on_message(alice, "hello")
+        self.assertEqual(self.recipients(), ({alice, bob}, "alice: hello"))
+        self.server.on_message(carol, "hi")
+        self.assertEqual(self.recipients(), ({alice, bob, carol}, "carol: hi"))
+
+    def test_wildcard_subscription(self):
+        alice, bob = self.join("alice"), self.join("bob")
+        self.server.on_message(alice, "/join games.*")
+        self.server.on_message(bob, "/to games.chess check")
+        self.assertEqual(self.recipients(), ({alice}, "[games.chess] bob: check"))
+
+    def test_leaving_and_closing(self):
+        alice, bob = self.join("alice"), self.join("bob")
+        self.server.on_message(alice, "/join games")
+        self.server.on_message(alice, "/leave games")
+        self.server.on_message(alice, "back")
+        self.assertEqual(self.recipients(), ({alice, bob}, "alice: back"))
+        self.server.on_close(alice)
+        self.assertEqual(self.recipients(), ({bob}, "alice has left the chat."))
+        self.assertEqual(self.server.router.topics(alice), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
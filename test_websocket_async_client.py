@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import unittest
+
+from websocket_async_client import AsyncWebSocketClient, WebSocketPool
+from websocket_deflate import DeflateConfig
+from websocket_handshake import accept_key
+from websocket_server import WebSocketServer
+
+
+class EchoServer(WebSocketServer):
+    def on_open(self, client):
+        # Sent right behind the handshake response
+        self.send_message(client, "welcome")
+
+    def on_message(self, client, message):
+        if message == "bye":
+            self.close_client(client)
+        elif isinstance(message, bytes):
+            self.send_binary(client, message)
+        else:
+            self.send_message(client, message)
+
+
+class ServerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = EchoServer('127.0.0.1', 0, compression=DeflateConfig(threshold=16))
+        cls.port = cls.server.sock.getsockname()[1]
+        threading.Thread(target=cls.server.start, daemon=True).start()
+        cls.server.listening.wait()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+class TestAsyncWebSocketClient(ServerTestCase):
+    def test_send_and_recv(self):
+        async def exchange():
+            async with AsyncWebSocketClient('127.0.0.1', self.port) as client:
+                received = [await client.recv()]
+                await client.send("hello")
+                await client.send(b"\x00\x01")
+                await client.send(memoryview(b"view"))
+                received += [await client.recv() for _ in range(3)]
+                return received
+        self.assertEqual(self.run_async(exchange()), ["welcome", "hello", b"\x00\x01", b"view"])
+
+    def test_iteration_ends_when_the_server_closes(self):
+        async def exchange():
+            client = await AsyncWebSocketClient('127.0.0.1', self.port).connect()
+            await client.send("one")
+            await client.send("bye")
+            messages = [message async for message in client]
+            return messages, client.closed
+        self.assertEqual(self.run_async(exchange()), (["welcome", "one"], True))
+
+    def test_compression(self):
+        async def exchange():
+            client = AsyncWebSocketClient('127.0.0.1', self.port, compression=DeflateConfig())
+            async with client:
+                await client.recv()
+                await client.send("x" * 10000)
+                await client.send_fragments(["ab", "cd"])
+                return await client.recv(), await client.recv(), client.get_compression_stats()
+        long, fragmented, stats = self.run_async(exchange())
+        self.assertEqual((long, fragmented), ("x" * 10000, "abcd"))
+        self.assertIsNotNone(stats)
+
+
+class TestKeepalive(ServerTestCase):
+    def timeouts(self):
+        return AsyncWebSocketClient.metrics.snapshot()["websocket_client_heartbeat_timeouts_total"]
+
+    def test_send_only_client_is_not_dropped(self):
+        async def send_only():
+            client = AsyncWebSocketClient('127.0.0.1', self.port, ping_interval=0.2, ping_timeout=0.2)
+            async with client:
+                for index in range(10):
+                    await client.send(f"message {index}")
+                    await asyncio.sleep(0.1)
+                return client.closed, await client.recv()
+        before = self.timeouts()
+        self.assertEqual(self.run_async(send_only()), (False, "welcome"))
+        self.assertEqual(self.timeouts(), before)
+
+    def test_silent_peer_times_out_while_reading(self):
+        async def silent(reader, writer):
+            # Completes the handshake, then never answers a ping
+            request = await reader.readuntil(b"\r\n\r\n")
+            key = [line.split(b":", 1)[1].strip() for line in request.split(b"\r\n")
+                   if line.lower().startswith(b"sec-websocket-key:")][0]
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                         b"Sec-WebSocket-Accept: " + accept_key(key.decode()) + b"\r\n\r\n")
+            await reader.read()
+
+        async def wait_for_timeout():
+            server = await asyncio.start_server(silent, '127.0.0.1', 0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                client = AsyncWebSocketClient('127.0.0.1', port, ping_interval=0.2, ping_timeout=0.2)
+                await client.connect()
+                return await client.recv(), client.closed
+        before = self.timeouts()
+        self.assertEqual(self.run_async(wait_for_timeout()), (None, True))
+        self.assertEqual(self.timeouts(), before + 1)
+
+
+class TestWebSocketPool(ServerTestCase):
+    def test_connections_are_reused(self):
+        async def requests():
+            pool = await WebSocketPool('127.0.0.1', self.port, size=2).start()
+
+            async def request(i):
+                async with pool.connection() as client:
+                    await client.send(f"request {i}")
+                    reply = await client.recv()
+                    if reply == "welcome":
+                        reply = await client.recv()
+                    return reply
+            replies = await asyncio.gather(*(request(i) for i in range(20)))
+            stats = pool.stats()
+            await pool.close()
+            return replies, stats
+        replies, stats = self.run_async(requests())
+        self.assertEqual(replies, [f"request {i}" for i in range(20)])
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["open"], 2)
+        self.assertEqual(stats["reused"], 20)
+
+    def test_failed_block_closes_the_connection(self):
+        async def fail():
+            pool = WebSocketPool('127.0.0.1', self.port, size=1)
+            with self.assertRaises(RuntimeError):
+                async with pool.connection() as client:
+                    raise RuntimeError
+            async with pool.connection() as second:
+                pass
+            stats = pool.stats()
+            await pool.close()
+            return client, second, stats
+        client, second, stats = self.run_async(fail())
+        self.assertTrue(client.closed)
+        self.assertIsNot(client, second)
+        self.assertEqual(stats["created"], 2)
+
+    def test_idle_connections_answer_the_keepalive(self):
+        async def idle():
+            pool = await WebSocketPool('127.0.0.1', self.port, size=1, ping_interval=0.2, ping_timeout=0.2).start(1)
+            await asyncio.sleep(1)  # Several ping intervals with nobody calling recv()
+            async with pool.connection() as client:
+                await client.send("still here")
+                replies = [await client.recv(), await client.recv()]
+            stats = pool.stats()
+            await pool.close()
+            return client, replies, stats
+        client, replies, stats = self.run_async(idle())
+        # The greeting that arrived while the connection sat in the pool is kept for recv()
+        self.assertEqual(replies, ["welcome", "still here"])
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["reused"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
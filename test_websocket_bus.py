@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from chat_implementation.chat_server import ChatServer
+from websocket_bus import ENVELOPE, InMemoryBus, TcpMeshBus
+from websocket_workers import encode_record
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestInMemoryBus(unittest.TestCase):
+    def test_delivers_to_the_other_nodes(self):
+        group = []
+        nodes = [InMemoryBus(group) for _ in range(3)]
+        received = [[] for _ in nodes]
+        for node, inbox in zip(nodes, received):
+            node.attach(inbox.append)
+        nodes[0].publish("hello")
+        self.assertEqual(received, [[], ["hello"], ["hello"]])
+
+    def test_drops_duplicates(self):
+        node = InMemoryBus([])
+        received = []
+        node.attach(received.append)
+        node.receive(b'a' * 8, 1, "one")
+        node.receive(b'a' * 8, 1, "one")
+        node.receive(b'a' * 8, 2, "two")
+        node.receive(b'b' * 8, 1, "other origin")
+        self.assertEqual(received, ["one", "two", "other origin"])
+        self.assertEqual(node.duplicates, 1)
+
+    def test_chat_servers_share_rooms(self):
+        group = []
+        servers = []
+        for _ in range(2):
+            server = ChatServer('127.0.0.1', 0)
+            server.broadcast_to = Mock()
+            server.send_message = Mock()
+            server.attach_bus(InMemoryBus(group))
+            servers.append(server)
+        alice, bob = Mock(), Mock()
+        servers[0].on_message(alice, "alice")
+        servers[1].on_message(bob, "bob")
+        servers[0].on_message(alice, "hi bob")
+        self.assertEqual(servers[1].broadcast_to.call_args[0], ([bob], "alice: hi bob"))
+
+    def test_chat_servers_relay_publish(self):
+        group = []
+        servers = []
+        for _ in range(2):
+            server = ChatServer('127.0.0.1', 0)
+            server.broadcast_to = Mock()
+            server.attach_bus(InMemoryBus(group))
+            servers.append(server)
+        servers[0].publish("maintenance at noon\nplease log off")
+        self.assertEqual(servers[1].broadcast_to.call_args[0], ([], "maintenance at noon\nplease log off"))
+        # A bare message from a node that does not tag rooms reaches everyone too
+        servers[1].on_channel_message("no room")
+        self.assertEqual(servers[1].broadcast_to.call_args[0], ([], "no room"))
+
+
+class TestTcpMeshBus(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [TcpMeshBus(('127.0.0.1', 0), []) for _ in range(3)]
+        for node in self.nodes:
+            for other in self.nodes:
+                if other is not node:
+                    node.add_peer(other.address)
+        self.received = [[] for _ in self.nodes]
+        for node, inbox in zip(self.nodes, self.received):
+            node.attach(inbox.append)
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.close()
+
+    def test_mesh_delivers_to_every_other_node(self):
+        self.nodes[0].publish("hello")
+        self.nodes[1].publish(b"\x00bytes")
+        self.assertTrue(wait_for(lambda: len(self.received[2]) == 2))
+        self.assertEqual(sorted(self.received[2], key=str), [b"\x00bytes", "hello"])
+        self.assertEqual(self.received[0], [b"\x00bytes"])
+        self.assertEqual(self.received[1], ["hello"])
+
+    def test_bursts_are_batched_in_order(self):
+        for index in range(2000):
+            self.nodes[0].publish(f"message {index}")
+        self.assertTrue(wait_for(lambda: len(self.received[1]) == 2000))
+        self.assertEqual(self.received[1], [f"message {index}" for index in range(2000)])
+        link = self.nodes[0].links[self.nodes[1].address]
+        self.assertEqual(link.messages, 2000)
+        self.assertLess(link.batches, 2000)
+
+    def test_concurrent_publishers_lose_nothing(self):
+        # 8000 messages fit in a link's queue (max_pending), so none are dropped however slow the link
+        def publish(thread):
+            for index in range(1000):
+                self.nodes[0].publish(f"{thread} {index}")
+        threads = [threading.Thread(target=publish, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(wait_for(lambda: len(self.received[1]) == 8000, timeout=10))
+        self.assertEqual(self.nodes[1].duplicates, 0)
+        self.assertEqual(len(set(self.received[1])), 8000)
+
+    def test_resent_batch_is_not_delivered_twice(self):
+        body = ENVELOPE.pack(b'x' * 8, 1) + encode_record("once")
+        self.nodes[0].read_batch(memoryview(body))
+        self.nodes[0].read_batch(memoryview(body))
+        self.assertEqual(self.received[0], ["once"])
+        self.assertEqual(self.nodes[0].duplicates, 1)
+
+    def test_queues_until_a_peer_is_up(self):
+        late = TcpMeshBus(('127.0.0.1', 0), [])
+        address = late.address
+        late.close()
+        self.nodes[0].add_peer(address)
+        self.nodes[0].publish("while down")
+        time.sleep(0.2)
+        revived = TcpMeshBus(address, [])
+        inbox = []
+        revived.attach(inbox.append)
+        try:
+            self.assertTrue(wait_for(lambda: inbox == ["while down"], timeout=10))
+        finally:
+            revived.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@ import unittest
 import socket
 from unittest.mock import Mock, patch
 from websocket_client import WebSocketClient
+from websocket_heartbeat import HeartbeatScheduler
+from test_helpers import FakeClock, feed_recv_into
 import time
-from threading import Event
+from threading import Event, Thread
 
 class TestWebSocketClient(unittest.TestCase):
     def setUp(self):
@@ -37,27 +39,72 @@ class TestWebSocketClient(unittest.TestCase):
 
     def test_receive_message(self):
         self.client.sock = Mock()
-        self.client.sock.recv.side_effect = [
+        feed_recv_into(self.client.sock, 
             b'\x81\x05',  # Frame header (text frame, 5 bytes payload)
             b'Hello'      # Payload
-        ]
+        )
         message = self.client.receive_message()
         self.assertEqual(message, "Hello")
 
     def test_send_message(self):
         self.client.sock = Mock()
         self.client.send_message("Hello")
-        self.client.sock.send.assert_called_once()
-        sent_data = self.client.sock.send.call_args[0][0]
+        self.client.sock.sendall.assert_called_once()
+        sent_data = self.client.sock.sendall.call_args[0][0]
         self.assertEqual(len(sent_data), 11)  # 2 bytes header, 4 bytes mask, 5 bytes payload
         self.assertEqual(sent_data[0], 0x81)  # Text frame
         self.assertEqual(sent_data[1], 0x85)  # Masked, 5 bytes payload
 
+    def test_send_fragments(self):
+        self.client.sock = Mock()
+        self.client.send_fragments([b'ab', b'cd'], opcode=0x2)
+        first, last = [call[0][0] for call in self.client.sock.sendall.call_args_list]
+        self.assertEqual(first[:2], b'\x02\x82')
+        self.assertEqual(last[:2], b'\x80\x82')
+
+    def test_receive_stream(self):
+        self.client.sock = Mock()
+        feed_recv_into(self.client.sock, b'\x02\x02ab\x80\x02cd')
+        self.assertEqual(list(self.client.receive_stream()), [b'ab', b'cd'])
+
+    def test_send_binary(self):
+        self.client.sock = Mock()
+        self.client.send_binary(bytearray(b'\x00\x01\x02'))
+        sent_data = self.client.sock.sendall.call_args[0][0]
+        self.assertEqual(sent_data[0], 0x82)  # Binary frame
+        self.assertEqual(sent_data[1], 0x83)  # Masked, 3 bytes payload
+
+    def test_receive_binary_message(self):
+        self.client.sock = Mock()
+        feed_recv_into(self.client.sock, b'\x82\x02\xc3\x28')  # Not valid UTF-8
+        self.assertEqual(self.client.receive_message(), b'\xc3\x28')
+
     def test_send_ping(self):
         self.client.sock = Mock()
         self.client.send_ping()
         self.client.sock.send.assert_called_once_with(b'\x89\x00')
 
+    def test_ping_waits_for_the_frame_being_written(self):
+        # The heartbeat thread must not put a ping in the middle of a data frame
+        self.client.sock = Mock()
+        writing, release = Event(), Event()
+        def slow_send_buffers(sock, buffers):
+            writing.set()
+            release.wait(5)
+            sock.sendall(b''.join(buffers))
+        with patch('websocket_client.send_buffers', slow_send_buffers):
+            sender = Thread(target=self.client.send_message, args=("Hello",))
+            sender.start()
+            writing.wait(5)
+            pinger = Thread(target=self.client.send_ping)
+            pinger.start()
+            pinger.join(0.1)
+            self.client.sock.send.assert_not_called()
+            release.set()
+            sender.join(5)
+            pinger.join(5)
+        self.assertEqual([name for name, args, kwargs in self.client.sock.mock_calls], ['sendall', 'send'])
+
     def test_handle_pong(self):
         initial_time = self.client.last_pong
         time.sleep(0.1)
@@ -67,22 +114,35 @@ class TestWebSocketClient(unittest.TestCase):
     @patch('threading.Thread')
     def test_heartbeat(self, mock_thread):
         self.client.sock = Mock()
-        
-        def side_effect(*args, **kwargs):
-            self.client.heartbeat()
-        mock_thread.side_effect = side_effect
-
-        self.client.connect()
-        mock_thread.assert_called()
-
-        # Simulate a successful heartbeat
-        time.sleep(self.client.heartbeat_interval + 1)
-        self.assertTrue(self.client.sock.send.called)
-
-        # Simulate a failed heartbeat
-        self.client.last_pong = 0
-        time.sleep(self.client.heartbeat_interval + self.client.heartbeat_timeout + 1)
-        self.client.sock.close.assert_called()
+        self.client.sock.recv.return_value = (
+            b"HTTP/1.1 101 Switching Protocols\r\n"
+            b"Sec-WebSocket-Accept: ICX+Yqv66kxgM0FcWaLWlFLwTAI=\r\n\r\n"
+        )
+        clock = FakeClock()
+        scheduler = HeartbeatScheduler(lambda client: client.send_ping(),
+                                       lambda client: client.heartbeat_expired(), clock=clock)
+
+        with patch('random.randint', return_value=0), patch.object(WebSocketClient, 'heartbeats', scheduler):
+            self.client.connect()
+            mock_thread.assert_called()
+            self.client.sock.send.reset_mock()
+
+            # Simulate a successful heartbeat
+            clock.now += self.client.heartbeat_interval + 1
+            scheduler.advance()
+            self.client.sock.send.assert_called_once_with(b'\x89\x00')
+            self.client.handle_pong()
+            clock.now += self.client.heartbeat_timeout + 1
+            scheduler.advance()
+            self.client.sock.close.assert_not_called()
+
+            # Simulate a failed heartbeat
+            clock.now += self.client.heartbeat_interval
+            scheduler.advance()
+            clock.now += self.client.heartbeat_timeout + 1
+            scheduler.advance()
+            self.client.sock.close.assert_called()
+            self.assertEqual(len(scheduler), 0)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from websocket_client import WebSocketClient
+from websocket_connection import Connection, ConnectionRegistry
+from websocket_server import WebSocketServer
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    def test_ids_and_lookups(self):
+        registry = ConnectionRegistry()
+        first = registry.add(Connection("a", None, None, None, None))
+        second = registry.add(Connection("b", None, None, None, None))
+        self.assertEqual((first.id, second.id), (1, 2))
+        self.assertIs(registry.get(2), second)
+        self.assertIs(registry.by_socket["a"], first)
+        self.assertIs(registry.remove("a"), first)
+        self.assertIsNone(registry.remove("a"))
+        self.assertIsNone(registry.get(1))
+        self.assertEqual(list(registry), [second])
+        # Ids are never reused
+        self.assertEqual(registry.add(Connection("a", None, None, None, None)).id, 3)
+
+    def test_no_instance_dict(self):
+        conn = Connection("a", None, None, None, None)
+        with self.assertRaises(AttributeError):
+            conn.anything = 1
+
+
+class CountingConnection(Connection):
+    __slots__ = ("echoes",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.echoes = 0
+
+
+class CountingServer(WebSocketServer):
+    connection_class = CountingConnection
+
+    def on_message(self, client, message):
+        self.clients[client].echoes += 1
+        super().on_message(client, message)
+
+
+class TestServerConnections(unittest.TestCase):
+    def test_add_and_remove_client(self):
+        server = WebSocketServer('127.0.0.1', 0)
+        self.addCleanup(server.sock.close)
+        client = Mock()
+        conn = server.add_client(client, ("127.0.0.1", 1234))
+        self.assertIs(server.clients[client], conn)
+        self.assertIs(server.get_connection(conn.id), conn)
+        self.assertEqual(conn.address, ("127.0.0.1", 1234))
+        server.remove_client(client)
+        self.assertNotIn(client, server.clients)
+        self.assertIsNone(server.get_connection(conn.id))
+        self.assertTrue(conn.outbox.closed)
+
+
+class ConnectionEngineTests:
+    engine = None
+
+    def test_subclass_and_counters(self):
+        server = CountingServer('127.0.0.1', 0, engine=self.engine)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        self.addCleanup(server.stop)
+        client = WebSocketClient('127.0.0.1', server.sock.getsockname()[1])
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        for index in range(3):
+            client.send_message(f"m{index}")
+            self.assertEqual(client.receive_message(), f"Echo: m{index}")
+        conn = next(iter(server.connections))
+        self.assertIsInstance(conn, CountingConnection)
+        self.assertEqual((conn.echoes, conn.messages_received, conn.messages_sent), (3, 3, 3))
+        self.assertGreaterEqual(conn.connected_at, time.time() - 5)
+
+
+class TestThreadedConnections(ConnectionEngineTests, unittest.TestCase):
+    engine = "threaded"
+
+
+class TestAsyncioConnections(ConnectionEngineTests, unittest.TestCase):
+    engine = "asyncio"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import json
+import socket
+import threading
+import unittest
+from unittest.mock import Mock
+
+from websocket_deflate import DeflateConfig, PerMessageDeflate, parse_extensions
+from websocket_frames import Frame, FrameParser, MessageAssembler, MessageTooBigError
+from websocket_server import WebSocketServer
+
+
+def negotiate(server_config, client_config):
+    response, server_side = server_config.accept(client_config.offer())
+    return response, server_side, client_config.confirm(response)
+
+class TestNegotiation(unittest.TestCase):
+    def test_parse_extensions(self):
+        self.assertEqual(
+            parse_extensions('permessage-deflate; client_max_window_bits, x-foo; a="1"'),
+            [("permessage-deflate", {"client_max_window_bits": None}), ("x-foo", {"a": "1"})],
+        )
+
+    def test_defaults(self):
+        response, server_side, client_side = negotiate(DeflateConfig(), DeflateConfig())
+        self.assertEqual(response, "permessage-deflate")
+        self.assertTrue(server_side.compress_context_takeover)
+        self.assertEqual(client_side.compress_window_bits, 15)
+
+    def test_window_bits_and_context_takeover(self):
+        server_config = DeflateConfig(client_max_window_bits=10, server_no_context_takeover=True)
+        response, server_side, client_side = negotiate(server_config, DeflateConfig(server_max_window_bits=12))
+        self.assertIn("server_no_context_takeover", response)
+        self.assertIn("server_max_window_bits=12", response)
+        self.assertIn("client_max_window_bits=10", response)
+        self.assertEqual(server_side.compress_window_bits, 12)
+        self.assertEqual(client_side.compress_window_bits, 10)
+        self.assertFalse(server_side.compress_context_takeover)
+        self.assertFalse(client_side.decompress_context_takeover)
+
+    def test_unsupported_offers_are_skipped(self):
+        self.assertIsNone(DeflateConfig().accept("x-webkit-deflate-frame"))
+        self.assertIsNone(DeflateConfig().accept("permessage-deflate; server_max_window_bits=8"))
+
+    def test_invalid_config(self):
+        with self.assertRaises(ValueError):
+            DeflateConfig(server_max_window_bits=8)
+
+class TestPerMessageDeflate(unittest.TestCase):
+    def setUp(self):
+        self.message = json.dumps([{"user": "alice", "text": "hello", "room": "general"}] * 20).encode()
+
+    def test_round_trip_with_context_takeover(self):
+        sender, receiver = PerMessageDeflate(), PerMessageDeflate()
+        first = sender.compress(self.message)
+        second = sender.compress(self.message)
+        self.assertLess(len(second), len(first))
+        self.assertEqual(receiver.decompress(first), self.message)
+        self.assertEqual(receiver.decompress(second), self.message)
+        self.assertGreater(sender.stats()["compression_ratio"], 1)
+
+    def test_no_context_takeover(self):
+        sender = PerMessageDeflate(compress_context_takeover=False)
+        receiver = PerMessageDeflate(decompress_context_takeover=False)
+        first = sender.compress(self.message)
+        self.assertEqual(sender.compress(self.message), first)
+        self.assertEqual(receiver.decompress(first), self.message)
+        self.assertEqual(receiver.decompress(first), self.message)
+
+    def test_fragments(self):
+        sender, receiver = PerMessageDeflate(), PerMessageDeflate()
+        parts = [sender.compress(self.message[:100], final=False), sender.compress(self.message[100:])]
+        inflated = receiver.decompress(parts[0], final=False) + receiver.decompress(parts[1])
+        self.assertEqual(inflated, self.message)
+
+    def test_threshold(self):
+        deflate = PerMessageDeflate(threshold=10)
+        self.assertFalse(deflate.should_compress(9))
+        self.assertTrue(deflate.should_compress(10))
+        self.assertEqual(deflate.stats()["messages_skipped"], 1)
+
+    def test_decompression_bomb(self):
+        sender, receiver = PerMessageDeflate(), PerMessageDeflate()
+        with self.assertRaises(MessageTooBigError):
+            receiver.decompress(sender.compress(b'\x00' * 100000), max_size=1000)
+
+    def test_assembler_inflates_rsv1_messages(self):
+        sender = PerMessageDeflate()
+        assembler = MessageAssembler(deflate=PerMessageDeflate())
+        compressed = sender.compress(self.message)
+        self.assertEqual(assembler.add(Frame(True, True, 0x1, compressed)), (0x1, self.message))
+
+    def test_rsv1_without_extension(self):
+        with self.assertRaises(ValueError):
+            MessageAssembler().add(Frame(True, True, 0x1, b'x'))
+
+class TestServerCompression(unittest.TestCase):
+    def test_handshake_negotiates_and_sends_compressed(self):
+        server = WebSocketServer('localhost', 0, compression=DeflateConfig(threshold=0))
+        response, deflate = server.handshake_response(
+            b"GET / HTTP/1.1\r\n"
+            b"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+            b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            b"Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n\r\n"
+        )
+        self.assertIn(b"Sec-WebSocket-Extensions: permessage-deflate\r\n", response)
+        self.assertTrue(response.endswith(b"\r\n\r\n"))
+
+        client = Mock()
+        client.send.side_effect = lambda data, flags=0: len(data)
+        server.add_client(client, "test", deflate)
+        server.send_message(client, "Hello Hello Hello")
+        frame = bytes(client.send.call_args[0][0])
+        self.assertEqual(frame[0], 0xC1)  # FIN, RSV1, text
+        self.assertEqual(PerMessageDeflate().decompress(frame[2:]), b"Hello Hello Hello")
+        server.sock.close()
+
+    def test_concurrent_senders_keep_the_compressed_stream_valid(self):
+        # Each compressed frame depends on the previous ones, so frames must be queued in the
+        # order they were compressed, whichever thread sends them
+        server = WebSocketServer('localhost', 0, compression=DeflateConfig(threshold=0))
+        server.sock.close()
+        _, server_side, client_side = negotiate(server.compression, DeflateConfig())
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        server.add_client(left, "test", server_side)
+        received = []
+
+        def read():
+            parser = FrameParser()
+            assembler = MessageAssembler(deflate=client_side)
+            while len(received) < 2000:
+                frame = parser.next_frame()
+                if frame is None:
+                    parser.recv_into(right)
+                    continue
+                received.append(str(assembler.add(frame)[1], 'utf-8'))
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        def send(index):
+            for count in range(500):
+                server.send_message(left, f"sender {index} message {count} " * 3)
+        senders = [threading.Thread(target=send, args=(index,)) for index in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        reader.join(10)
+        self.assertEqual(len(received), 2000)
+        self.assertEqual(sorted(received), sorted(f"sender {i} message {c} " * 3 for i in range(4) for c in range(500)))
+
+    def test_handshake_without_compression(self):
+        server = WebSocketServer('localhost', 0)
+        response, deflate = server.handshake_response(
+            b"GET / HTTP/1.1\r\n"
+            b"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+            b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            b"Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n"
+        )
+        self.assertIsNone(deflate)
+        self.assertNotIn(b"Sec-WebSocket-Extensions", response)
+        server.sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
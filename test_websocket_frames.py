@@ -0,0 +1,179 @@
+import os
+import unittest
+from unittest.mock import Mock, patch
+
+import websocket_frames
+from websocket_frames import (CLOSED, Frame, FrameParser, MessageAssembler, MessageTooBigError, apply_mask,
+                              build_frame_header, encode_fragments, next_message, stream_message)
+
+
+def reference_mask(data, masking_key):
+    return bytes(b ^ masking_key[i % 4] for i, b in enumerate(data))
+
+class TestApplyMask(unittest.TestCase):
+    def test_matches_per_byte_masking(self):
+        masking_key = b'\x37\xfa\x21\x3d'
+        for size in (0, 1, 3, 4, 5, 125, 126, 65536, 100003):
+            data = os.urandom(size)
+            self.assertEqual(apply_mask(data, masking_key), reference_mask(data, masking_key))
+
+    def test_round_trip(self):
+        masking_key = os.urandom(4)
+        data = os.urandom(1000)
+        self.assertEqual(apply_mask(apply_mask(data, masking_key), masking_key), data)
+
+    def test_accepts_memoryview(self):
+        masking_key = memoryview(b'\x01\x02\x03\x04')
+        data = memoryview(b'Hello')
+        self.assertEqual(apply_mask(data, masking_key), reference_mask(b'Hello', b'\x01\x02\x03\x04'))
+
+    def test_pure_python_path_without_numpy(self):
+        masking_key = os.urandom(4)
+        data = os.urandom(websocket_frames.NUMPY_MASK_THRESHOLD + 7)
+        with patch.object(websocket_frames, 'numpy', None):
+            self.assertEqual(apply_mask(data, masking_key), reference_mask(data, masking_key))
+
+class TestFrameParser(unittest.TestCase):
+    def test_incomplete_frame(self):
+        parser = FrameParser()
+        parser.feed(b'\x81\x05He')
+        self.assertIsNone(parser.next_frame())
+        parser.feed(b'llo')
+        frame = parser.next_frame()
+        self.assertTrue(frame.fin)
+        self.assertEqual(frame.opcode, 0x1)
+        self.assertEqual(bytes(frame.payload), b'Hello')
+
+    def test_masked_frame(self):
+        masking_key = b'\x01\x02\x03\x04'
+        parser = FrameParser()
+        parser.feed(b'\x82\x83' + masking_key + apply_mask(b'abc', masking_key))
+        frame = parser.next_frame()
+        self.assertEqual(frame.opcode, 0x2)
+        self.assertEqual(bytes(frame.payload), b'abc')
+
+    def test_extended_lengths(self):
+        parser = FrameParser(buffer_size=1024)
+        medium = b'm' * 300
+        large = b'l' * 70000
+        parser.feed(b'\x81\x7e' + len(medium).to_bytes(2, 'big') + medium)
+        parser.feed(b'\x01\x7f' + len(large).to_bytes(8, 'big') + large)
+        self.assertEqual(bytes(parser.next_frame().payload), medium)
+        frame = parser.next_frame()
+        self.assertFalse(frame.fin)
+        self.assertEqual(bytes(frame.payload), large)
+        self.assertIsNone(parser.next_frame())
+
+    def test_payload_is_a_view(self):
+        parser = FrameParser()
+        parser.feed(b'\x81\x02hi')
+        self.assertIsInstance(parser.next_frame().payload, memoryview)
+
+    def test_many_small_frames_with_compaction(self):
+        parser = FrameParser(buffer_size=64)
+        received = []
+        for i in range(100):
+            payload = str(i).encode()
+            parser.feed(b'\x81' + bytes([len(payload)]) + payload)
+            frame = parser.next_frame()
+            received.append(bytes(frame.payload))
+        self.assertEqual(received, [str(i).encode() for i in range(100)])
+        self.assertLessEqual(len(parser.buffer), 64)
+
+    def test_feed_counts_pending_bytes(self):
+        parser = FrameParser(buffer_size=64)
+        parser.feed(b'\x81\x02hi' * 16)
+        while parser.next_frame():
+            pass
+        parser.feed(b'\x81\x02hi' + b'\x82\x28' + b'x' * 18)
+        frame = parser.next_frame()
+        self.assertIsNone(parser.next_frame())
+        # The rest of the frame and more: the buffer must not be extended under the view of "hi"
+        parser.feed(b'x' * 22 + b'\x81\x02ok' * 7)
+        self.assertEqual(bytes(frame.payload), b'hi')
+        self.assertEqual(bytes(parser.next_frame().payload), b'x' * 40)
+
+    def test_buffer_is_allocated_on_demand(self):
+        parser = FrameParser()
+        self.assertEqual(len(parser.buffer), 0)
+        parser.feed(b'\x81\x05He')
+        parser.release()  # Half a frame is still pending
+        parser.feed(b'llo')
+        self.assertEqual(bytes(parser.next_frame().payload), b'Hello')
+        parser.release()
+        self.assertEqual(len(parser.buffer), 0)
+        sock = Mock()
+        sock.recv_into.side_effect = lambda buffer: 0
+        parser.recv_into(sock)
+        self.assertEqual(len(parser.buffer), parser.buffer_size)
+
+    def test_max_frame_size(self):
+        parser = FrameParser(max_frame_size=10)
+        parser.feed(b'\x82\x7f' + (2 ** 40).to_bytes(8, 'big'))
+        with self.assertRaises(MessageTooBigError):
+            parser.next_frame()
+
+class TestBuildFrameHeader(unittest.TestCase):
+    def test_lengths(self):
+        self.assertEqual(build_frame_header(0x1, 5), b'\x81\x05')
+        self.assertEqual(build_frame_header(0x2, 300), b'\x82\x7e\x01\x2c')
+        self.assertEqual(build_frame_header(0x1, 70000), b'\x81\x7f' + (70000).to_bytes(8, 'big'))
+
+    def test_flags_and_mask(self):
+        self.assertEqual(build_frame_header(0x0, 1, fin=False), b'\x00\x01')
+        self.assertEqual(build_frame_header(0x1, 1, rsv1=True), b'\xc1\x01')
+        self.assertEqual(build_frame_header(0x1, 1, masking_key=b'abcd'), b'\x81\x81abcd')
+
+class TestMessageAssembler(unittest.TestCase):
+    def test_unfragmented_message_is_not_copied(self):
+        payload = memoryview(b'Hello')
+        self.assertIs(MessageAssembler().add(Frame(True, False, 0x1, payload))[1], payload)
+
+    def test_reassembly(self):
+        assembler = MessageAssembler()
+        self.assertIsNone(assembler.add(Frame(False, False, 0x2, b'ab')))
+        self.assertIsNone(assembler.add(Frame(False, False, 0x0, b'cd')))
+        self.assertEqual(assembler.add(Frame(True, False, 0x0, b'ef')), (0x2, bytearray(b'abcdef')))
+
+    def test_protocol_errors(self):
+        with self.assertRaises(ValueError):
+            MessageAssembler().add(Frame(True, False, 0x0, b''))
+        assembler = MessageAssembler()
+        assembler.add(Frame(False, False, 0x1, b'a'))
+        with self.assertRaises(ValueError):
+            assembler.add(Frame(True, False, 0x1, b'b'))
+
+class TestStreaming(unittest.TestCase):
+    def test_stream_message_decodes_split_characters(self):
+        frames = iter([Frame(False, False, 0x1, b'caf\xc3'), Frame(True, False, 0x0, b'\xa9!')])
+        self.assertEqual(list(stream_message(lambda: next(frames))), ['caf', '\xe9!'])
+
+    def test_stream_message_limit_and_eof(self):
+        frames = iter([Frame(False, False, 0x2, b'abc'), Frame(True, False, 0x0, b'def')])
+        with self.assertRaises(MessageTooBigError):
+            list(stream_message(lambda: next(frames), max_message_size=5))
+        frames = iter([Frame(False, False, 0x2, b'abc'), None])
+        with self.assertRaises(ConnectionError):
+            list(stream_message(lambda: next(frames)))
+
+    def test_next_message_across_reads(self):
+        # A buffered reader: None means the buffer ran out, and the mark survives until the end
+        frames = iter([Frame(False, False, 0x1, b'ab'), None, Frame(True, False, 0x9, b''),
+                       Frame(True, False, 0x0, b'cd'), Frame(True, False, 0x2, b'\x00'), Frame(True, False, 0x8, b'')])
+        assembler = MessageAssembler()
+        control = Mock()
+        marks = iter(["first", "second"])
+        step = lambda: next_message(lambda: next(frames), assembler, control, started=lambda: next(marks))
+        self.assertIsNone(step())
+        self.assertEqual(step(), ("abcd", 4, "first"))
+        self.assertEqual(step(), (b'\x00', 1, "second"))
+        self.assertIs(step(), CLOSED)
+        self.assertEqual([call[0][0].opcode for call in control.call_args_list], [0x9, 0x8])
+
+    def test_encode_fragments(self):
+        self.assertEqual(list(encode_fragments(iter(["ab", b"cd"]), 0x2)),
+                         [(0x2, b'ab', False, False), (0x0, b'cd', True, False)])
+        self.assertEqual(list(encode_fragments([])), [(0x1, b'', True, False)])
+
+if __name__ == '__main__':
+    unittest.main()
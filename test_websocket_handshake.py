@@ -0,0 +1,122 @@
+import socket
+import threading
+import time
+import unittest
+
+from websocket_client import WebSocketClient
+from websocket_handshake import HandshakeError, HeadReader, parse_upgrade_request, upgrade_response
+from websocket_server import WebSocketServer
+
+REQUEST = (
+    b"GET /chat?room=1 HTTP/1.1\r\n"
+    b"Host: localhost\r\n"
+    b"upgrade: WebSocket\r\n"
+    b"CONNECTION: keep-alive, Upgrade\r\n"
+    b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+    b"Sec-WebSocket-Version: 13\r\n\r\n"
+)
+
+# A masked text frame carrying "Hello"
+HELLO = b'\x81\x85\x01\x02\x03\x04' + bytes(b ^ k for b, k in zip(b'Hello', b'\x01\x02\x03\x04\x01'))
+
+
+class TestHandshakeParsing(unittest.TestCase):
+    def test_head_split_across_reads_keeps_leftover(self):
+        reader = HeadReader()
+        data = REQUEST + HELLO
+        self.assertFalse(reader.feed(data[:30]))
+        self.assertFalse(reader.feed(data[30:len(REQUEST) - 2]))
+        self.assertTrue(reader.feed(data[len(REQUEST) - 2:]))
+        self.assertEqual((reader.head, reader.leftover), (REQUEST, HELLO))
+
+    def test_head_size_is_bounded(self):
+        reader = HeadReader(max_size=64)
+        with self.assertRaises(HandshakeError) as raised:
+            reader.feed(b"GET / HTTP/1.1\r\nX-Padding: " + b"x" * 100)
+        self.assertEqual(raised.exception.status, 431)
+
+    def test_header_names_in_any_case(self):
+        path, headers = parse_upgrade_request(REQUEST)
+        self.assertEqual(path, "/chat?room=1")
+        self.assertEqual(headers["sec-websocket-key"], "dGhlIHNhbXBsZSBub25jZQ==")
+        self.assertEqual(headers["connection"], "keep-alive, Upgrade")
+
+    def test_invalid_requests(self):
+        for old, new, status in ((b"upgrade: WebSocket\r\n", b"", 426),
+                                 (b"Version: 13", b"Version: 8", 426),
+                                 (b"keep-alive, Upgrade", b"keep-alive", 400),
+                                 (b"GET ", b"POST ", 400)):
+            with self.assertRaises(HandshakeError) as raised:
+                parse_upgrade_request(REQUEST.replace(old, new))
+            self.assertEqual(raised.exception.status, status, new)
+        self.assertIn(b"Sec-WebSocket-Version: 13\r\n", HandshakeError("old", 426).response())
+
+    def test_response_template(self):
+        response = upgrade_response("dGhlIHNhbXBsZSBub25jZQ==", "permessage-deflate")
+        self.assertTrue(response.startswith(b"HTTP/1.1 101 Switching Protocols\r\n"))
+        self.assertIn(b"\r\nSec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n", response)
+        self.assertTrue(response.endswith(b"\r\nSec-WebSocket-Extensions: permessage-deflate\r\n\r\n"))
+
+
+class Greeter(WebSocketServer):
+    def on_open(self, client):
+        self.send_message(client, "welcome")
+
+
+class HandshakeTests:
+    engine = None
+
+    def setUp(self):
+        self.server = Greeter('127.0.0.1', 0, engine=self.engine)
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.server.listening.wait()
+        self.addCleanup(self.server.stop)
+        self.port = self.server.sock.getsockname()[1]
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def read_until(self, sock, expected):
+        data = b""
+        while expected not in data:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_split_large_request_with_pipelined_frame(self):
+        sock = self.connect()
+        request = REQUEST.replace(b"Host:", b"X-Padding: " + b"x" * 3000 + b"\r\nHost:")
+        sock.sendall(request[:100])
+        time.sleep(0.05)
+        sock.sendall(request[100:] + HELLO)
+        data = self.read_until(sock, b"Echo: Hello")
+        self.assertIn(b"101 Switching Protocols", data)
+        self.assertIn(b"\x81\x0bEcho: Hello", data)
+
+    def test_bad_request_is_answered(self):
+        sock = self.connect()
+        sock.sendall(REQUEST.replace(b"Version: 13", b"Version: 8"))
+        self.assertTrue(self.read_until(sock, b"\r\n\r\n").startswith(b"HTTP/1.1 426 Upgrade Required\r\n"))
+
+    def test_client_keeps_frames_sent_with_the_response(self):
+        client = WebSocketClient('127.0.0.1', self.port)
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        self.assertEqual(client.receive_message(), "welcome")
+
+
+class TestHandshakeThreaded(HandshakeTests, unittest.TestCase):
+    engine = "threaded"
+
+
+class TestHandshakeAsyncio(HandshakeTests, unittest.TestCase):
+    engine = "asyncio"
+
+
+if __name__ == '__main__':
+    unittest.main()
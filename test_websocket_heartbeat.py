@@ -0,0 +1,84 @@
+import unittest
+
+from websocket_heartbeat import HeartbeatScheduler
+from test_helpers import FakeClock
+
+
+class TestHeartbeatScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.pings = []
+        self.expired = []
+        self.scheduler = HeartbeatScheduler(self.pings.append, self.expired.append,
+                                            interval=30, timeout=10, clock=self.clock)
+
+    def step(self, seconds):
+        self.clock.now += seconds
+        self.scheduler.advance()
+
+    def test_idle_connection_is_pinged(self):
+        self.scheduler.add("a")
+        self.step(29)
+        self.assertEqual(self.pings, [])
+        self.step(2)
+        self.assertEqual(self.pings, ["a"])
+
+    def test_pong_keeps_connection(self):
+        self.scheduler.add("a")
+        self.step(31)
+        self.step(1)
+        self.scheduler.touch("a")
+        self.step(15)
+        self.assertEqual(self.expired, [])
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_missing_pong_expires_connection(self):
+        self.scheduler.add("a")
+        self.step(31)
+        self.step(11)
+        self.assertEqual(self.expired, ["a"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_traffic_skips_ping(self):
+        self.scheduler.add("a")
+        for _ in range(10):
+            self.step(20)
+            self.scheduler.touch("a")
+        self.assertEqual(self.pings, [])
+
+    def test_remove(self):
+        self.scheduler.add("a")
+        self.scheduler.remove("a")
+        self.step(60)
+        self.assertEqual(self.pings, [])
+        self.assertEqual(self.expired, [])
+
+    def test_per_connection_interval(self):
+        self.scheduler.add("fast", interval=5, timeout=2)
+        self.scheduler.add("slow")
+        self.step(6)
+        self.assertEqual(self.pings, ["fast"])
+
+    def test_interval_longer_than_the_wheel(self):
+        # Entries more than one revolution away must wait for their own turn
+        self.scheduler.add("a", interval=100)
+        for _ in range(9):
+            self.step(10)
+        self.assertEqual(self.pings, [])
+        self.step(11)
+        self.assertEqual(self.pings, ["a"])
+
+    def test_many_connections(self):
+        for key in range(1000):
+            self.scheduler.add(key)
+        self.scheduler.touch(0)
+        self.step(31)
+        self.assertEqual(len(self.pings), 1000)
+        for key in range(500):
+            self.scheduler.touch(key)
+        self.step(11)
+        self.assertEqual(sorted(self.expired), list(range(500, 1000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
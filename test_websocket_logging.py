@@ -0,0 +1,55 @@
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from websocket_logging import FrameLog, configure_logging
+
+
+class TestLogging(unittest.TestCase):
+    def test_import_sets_up_no_handlers(self):
+        code = ("import logging, websocket_server, websocket_client, chat_implementation.chat_server; "
+                "print(len(logging.getLogger().handlers), logging.getLogger().level)")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.split(), ["0", str(logging.WARNING)])
+
+    def test_frame_log_is_lazy_and_sampled(self):
+        logger = logging.getLogger("test_frame_log")
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        log = FrameLog(logger)
+        log.every = 3
+        for i in range(7):
+            log("frame %d", i)
+        self.assertEqual([record.getMessage() for record in records], ["frame 2", "frame 5"])
+        self.assertEqual(records[0].args, (2,))  # Not formatted by the call
+
+    def test_file_writes_go_through_the_queue(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        self.addCleanup(root.setLevel, level)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "server.log")
+            listener = configure_logging(filename, console_level=logging.CRITICAL)
+            try:
+                logging.getLogger("test_queue").debug("written by %s", "the listener")
+            finally:
+                listener.stop()
+                for handler in root.handlers[len(handlers):]:
+                    root.removeHandler(handler)
+                    handler.close()
+                for handler in listener.handlers:
+                    handler.close()
+            with open(filename) as f:
+                self.assertIn("DEBUG - written by the listener", f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import threading
+import time
+import unittest
+import urllib.request
+
+from websocket_client import WebSocketClient
+from websocket_metrics import Counter, Histogram, MetricsRegistry, ServerMetrics
+from websocket_server import WebSocketServer
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_loses_no_updates_across_threads(self):
+        counter = Counter()
+
+        def work():
+            for _ in range(10000):
+                counter.inc()
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(), 80000)
+
+    def test_histogram_buckets(self):
+        histogram = Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.value(), {"count": 4, "sum": 14.5, "buckets": {1: 2, 5: 3}})
+
+    def test_render_and_snapshot(self):
+        registry = MetricsRegistry()
+        frames = registry.counter("frames_total", "Frames", ["opcode"])
+        frames.labels("text").inc(3)
+        registry.gauge("open", "Open things", lambda: 7)
+        registry.histogram("latency_seconds", "Latency", buckets=(0.1,)).observe(0.05)
+        text = registry.render()
+        self.assertIn('# TYPE frames_total counter\nframes_total{opcode="text"} 3\n', text)
+        self.assertIn("open 7\n", text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 1\n', text)
+        self.assertIn("latency_seconds_count 1\n", text)
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["frames_total"], {"opcode=text": 3})
+        self.assertEqual(snapshot["open"], 7)
+        with self.assertRaises(ValueError):
+            registry.counter("open", "Again")
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_receive_is_timed_once_in_sample_every(self):
+        metrics = ServerMetrics(WebSocketServer.__new__(WebSocketServer))
+        metrics.sample_every = 4
+        for _ in range(8):
+            metrics.end_receive(metrics.start_receive())
+        self.assertEqual(metrics.snapshot()["websocket_server_receive_seconds"]["count"], 2)
+
+    def test_exchange_is_counted_and_served(self):
+        server = WebSocketServer('127.0.0.1', 0)
+        server.metrics.sample_every = 1  # Time every message
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        self.addCleanup(server.stop)
+        httpd = server.start_metrics_server(port=0)
+        self.addCleanup(httpd.shutdown)
+
+        client = WebSocketClient('127.0.0.1', server.sock.getsockname()[1])
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        client.send_message("hello")
+        self.assertEqual(client.receive_message(), "Echo: hello")
+
+        deadline = time.monotonic() + 5
+        while server.get_metrics()["websocket_server_handler_seconds"]["count"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        metrics = server.get_metrics()
+        self.assertEqual(metrics["websocket_server_connections_total"], 1)
+        self.assertEqual(metrics["websocket_server_connections"], 1)
+        self.assertEqual(metrics["websocket_server_frames_received_total"]["opcode=text"], 1)
+        self.assertEqual(metrics["websocket_server_payload_bytes_received_total"]["opcode=text"], 5)
+        self.assertEqual(metrics["websocket_server_frames_sent_total"]["opcode=text"], 1)
+        self.assertEqual(metrics["websocket_server_handler_seconds"]["count"], 1)
+        self.assertEqual(metrics["websocket_server_receive_seconds"]["count"], 1)
+
+        port = httpd.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            body = response.read().decode()
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn('websocket_server_frames_received_total{opcode="text"} 1', body)
+
+    def test_receive_is_sampled_on_the_asyncio_engine(self):
+        server = WebSocketServer('127.0.0.1', 0, engine="asyncio")
+        server.metrics.sample_every = 2  # Time every other message
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        self.addCleanup(server.stop)
+
+        client = WebSocketClient('127.0.0.1', server.sock.getsockname()[1])
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        for i in range(4):
+            client.send_message(f"hello {i}")
+            self.assertEqual(client.receive_message(), f"Echo: hello {i}")
+        self.assertEqual(server.get_metrics()["websocket_server_receive_seconds"]["count"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
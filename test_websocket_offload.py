@@ -0,0 +1,137 @@
+import threading
+import time
+import unittest
+
+from websocket_client import WebSocketClient
+from websocket_offload import Offload
+from websocket_server import WebSocketServer
+
+
+def shout(message):
+    # Module level, so process pools can import it
+    if message == "fail":
+        raise ValueError("refused")
+    if message == "quiet":
+        return None
+    return message.upper()
+
+
+class TestOffload(unittest.TestCase):
+    def test_results_keep_message_order(self):
+        offload = Offload(lambda delay: time.sleep(delay) or delay, workers=4)
+        self.addCleanup(offload.shutdown)
+        delivered = []
+        done = threading.Event()
+
+        def deliver(client, future):
+            delivered.append((client, future.result()))
+            if len(delivered) == 6:
+                done.set()
+        offload.deliver = deliver
+        for delay in (0.05, 0.01, 0.03):
+            offload.submit("a", delay)
+            offload.submit("b", delay / 2)
+        self.assertTrue(done.wait(5))
+        self.assertEqual([delay for client, delay in delivered if client == "a"], [0.05, 0.01, 0.03])
+        self.assertEqual([delay for client, delay in delivered if client == "b"], [0.025, 0.005, 0.015])
+        self.assertEqual((offload.pending, offload.queues), (0, {}))
+
+    def test_submit_waits_for_room(self):
+        release = threading.Event()
+        offload = Offload(lambda message: release.wait(5), workers=2, max_pending=2)
+        self.addCleanup(offload.shutdown)
+        offload.deliver = lambda client, future: None
+        offload.submit("a", 1)
+        offload.submit("a", 2)
+        self.assertTrue(offload.full())
+        third = threading.Thread(target=offload.submit, args=("a", 3))
+        third.start()
+        third.join(0.1)
+        self.assertTrue(third.is_alive())
+        self.assertFalse(offload.submit("a", 4, wait=False))
+        release.set()
+        third.join(5)
+        self.assertFalse(third.is_alive())
+
+    def test_unknown_pool(self):
+        with self.assertRaises(ValueError):
+            Offload(shout, pool="fiber")
+
+
+class OffloadServerTests:
+    engine = None
+    pool = None
+
+    def setUp(self):
+        self.server = WebSocketServer('127.0.0.1', 0, engine=self.engine)
+        self.server.enable_offload(shout, self.pool, workers=2)
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.server.listening.wait()
+        self.addCleanup(self.server.stop)
+
+    def test_replies_in_order(self):
+        client = WebSocketClient('127.0.0.1', self.server.sock.getsockname()[1])
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        messages = [f"message {index}" for index in range(20)]
+        for message in messages[:10] + ["fail", "quiet"] + messages[10:]:
+            client.send_message(message)
+        # A failed or silent handler call sends nothing, and the connection carries on
+        self.assertEqual([client.receive_message() for _ in messages], [message.upper() for message in messages])
+
+
+class TestOffloadThreadPool(OffloadServerTests, unittest.TestCase):
+    engine = "threaded"
+    pool = "thread"
+
+
+class TestOffloadProcessPool(OffloadServerTests, unittest.TestCase):
+    engine = "threaded"
+    pool = "process"
+
+
+class TestOffloadAsyncioThreadPool(OffloadServerTests, unittest.TestCase):
+    engine = "asyncio"
+    pool = "thread"
+
+
+class TestOffloadAsyncioProcessPool(OffloadServerTests, unittest.TestCase):
+    engine = "asyncio"
+    pool = "process"
+
+
+class TestOffloadAsyncioFullPool(unittest.TestCase):
+    def test_loop_never_waits_to_submit(self):
+        server = WebSocketServer('127.0.0.1', 0, engine="asyncio")
+        offload = server.enable_offload(lambda message: time.sleep(0.01) or message, workers=1, max_pending=1)
+        blocking = []
+        submit = offload.submit
+
+        def checked_submit(client, message, wait=True):
+            if wait:
+                blocking.append(message)
+            return submit(client, message, wait)
+        offload.submit = checked_submit
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        self.addCleanup(server.stop)
+
+        clients = []
+        for _ in range(4):
+            client = WebSocketClient('127.0.0.1', server.sock.getsockname()[1])
+            client.receive_messages = lambda: None
+            client.connect()
+            self.addCleanup(client.close)
+            clients.append(client)
+        for index in range(5):
+            for client in clients:
+                client.send_message(f"message {index}")
+        # Every connection competes for the one slot, and each still gets all its replies
+        for client in clients:
+            self.assertEqual([client.receive_message() for _ in range(5)], [f"message {index}" for index in range(5)])
+        self.assertEqual(blocking, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,318 @@
+import asyncio
+import socket
+import ssl
+import threading
+import time
+import unittest
+
+from websocket_frames import build_frame_header
+from websocket_outbox import MemoryBudget, Outbox, OutboxWriter, SlowConsumerError, MSG_DONTWAIT, send_buffers, vectored
+from websocket_server import WebSocketServer
+
+
+class ChunkedSocket:
+    # Accepts at most `limit` bytes per send, then refuses until more room is granted
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def send(self, data, flags=0):
+        if self.limit == 0:
+            raise BlockingIOError
+        count = min(len(data), self.limit)
+        self.data += data[:count]
+        self.limit -= count
+        return count
+
+class VectoredSocket(ChunkedSocket):
+    # Same limit, but gathers buffers like sendmsg and counts the calls
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.calls = 0
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        self.calls += 1
+        return self.send(b"".join(buffers), flags)
+
+class TestOutbox(unittest.TestCase):
+    def test_partial_writes_keep_frame_order(self):
+        outbox = Outbox()
+        outbox.put((b'\x81\x03', b'abc'))
+        outbox.put((b'\x81\x02de',))
+        sock = ChunkedSocket(3)
+        self.assertFalse(outbox.flush(sock))
+        sock.limit = 100
+        self.assertTrue(outbox.flush(sock))
+        self.assertEqual(bytes(sock.data), b'\x81\x03abc\x81\x02de')
+
+    def test_drop_oldest(self):
+        outbox = Outbox(max_frames=2)
+        for frame in (b'1', b'2', b'3'):
+            outbox.put((frame,))
+        self.assertEqual(list(outbox.frames), [(b'2',), (b'3',)])
+        self.assertEqual(outbox.dropped, 1)
+
+    def test_drop_oldest_never_drops_a_partly_written_frame(self):
+        outbox = Outbox(max_frames=2)
+        outbox.put((b'first',))
+        outbox.put((b'second',))
+        outbox.flush(ChunkedSocket(2))
+        outbox.put((b'third',))
+        self.assertEqual(list(outbox.frames), [(b'first',), (b'third',)])
+        sock = ChunkedSocket(100)
+        outbox.flush(sock)
+        self.assertEqual(bytes(sock.data), b'rstthird')
+
+    def test_drop_oldest_keeps_a_frame_an_ssl_write_must_retry(self):
+        # SSL writes all or nothing, and one that had to wait is retried with the same bytes
+        class WaitingSocket(ChunkedSocket):
+            def send(self, data, flags=0):
+                if self.limit == 0:
+                    raise ssl.SSLWantWriteError
+                return super().send(data, flags)
+        outbox = Outbox(max_frames=2)
+        outbox.put((b'first',))
+        outbox.put((b'second',))
+        self.assertFalse(outbox.flush(WaitingSocket(0)))
+        outbox.put((b'third',))
+        self.assertEqual(list(outbox.frames), [(b'first',), (b'third',)])
+
+    def test_disconnect_policy(self):
+        outbox = Outbox(max_frames=1, policy="disconnect")
+        outbox.put((b'1',))
+        with self.assertRaises(SlowConsumerError):
+            outbox.put((b'2',))
+
+    def test_block_policy_waits_for_room(self):
+        outbox = Outbox(max_frames=1, policy="block", block_timeout=5)
+        outbox.put((b'1',))
+        threading.Timer(0.05, outbox.flush, args=(ChunkedSocket(10),)).start()
+        outbox.put((b'2',))
+        self.assertEqual(list(outbox.frames), [(b'2',)])
+
+    def test_block_policy_times_out(self):
+        outbox = Outbox(max_frames=1, policy="block", block_timeout=0.01)
+        outbox.put((b'1',))
+        with self.assertRaises(SlowConsumerError):
+            outbox.put((b'2',))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Outbox(policy="ignore")
+
+    def test_watermarks(self):
+        outbox = Outbox(high_water=10, low_water=2)
+        outbox.put((b'\x81\x0a', b'0123456789'))
+        self.assertTrue(outbox.above_high_water())
+        self.assertFalse(outbox.wait_drained(0))
+        outbox.flush(ChunkedSocket(9))
+        self.assertEqual((outbox.size, outbox.written), (3, 9))
+        self.assertFalse(outbox.above_high_water())
+        self.assertFalse(outbox.wait_drained(0))
+        outbox.flush(ChunkedSocket(1))
+        self.assertTrue(outbox.wait_drained(0))
+
+    def test_close_wakes_waiters(self):
+        budget = MemoryBudget()
+        outbox = Outbox(high_water=4, budget=budget)
+        outbox.put((b'queued',))
+        threading.Timer(0.05, outbox.close).start()
+        self.assertTrue(outbox.wait_drained(5))
+        self.assertTrue(outbox.closed)
+        self.assertEqual((outbox.size, budget.used), (0, 0))
+
+    def test_memory_cap_spares_small_outboxes(self):
+        budget = MemoryBudget(10)
+        hog = Outbox(policy="disconnect", high_water=8, low_water=2, budget=budget)
+        polite = Outbox(policy="disconnect", high_water=8, low_water=2, budget=budget)
+        hog.put((b'x' * 12,))
+        polite.put((b'ok',))
+        self.assertEqual(budget.used, 14)
+        with self.assertRaises(SlowConsumerError):
+            hog.put((b'more',))
+        hog.close()
+        self.assertEqual(budget.used, 2)
+
+    def test_memory_cap_drops_oldest(self):
+        budget = MemoryBudget(10)
+        outbox = Outbox(high_water=8, low_water=2, budget=budget)
+        outbox.put((b'first!',))
+        outbox.put((b'second',))
+        outbox.put((b'3',))
+        self.assertEqual(list(outbox.frames), [(b'second',), (b'3',)])
+        self.assertEqual((outbox.size, budget.used, outbox.dropped), (7, 7, 1))
+
+class TestVectoredFlush(unittest.TestCase):
+    def test_many_frames_in_one_call(self):
+        outbox = Outbox()
+        for index in range(100):
+            outbox.put((b'\x81\x01', str(index % 10).encode()))
+        sock = VectoredSocket(1000)
+        self.assertTrue(outbox.flush(sock))
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(len(sock.data), 300)
+
+    def test_partial_writes_resume_mid_buffer(self):
+        outbox = Outbox()
+        outbox.put((b'\x81\x03', b'abc'))
+        outbox.put((b'\x81\x02', b'de'))
+        outbox.put((b'\x81\x00', b''))
+        sock = VectoredSocket(3)
+        self.assertFalse(outbox.flush(sock))
+        sock.limit = 3
+        self.assertFalse(outbox.flush(sock))
+        self.assertEqual(len(outbox), 2)
+        sock.limit = 100
+        self.assertTrue(outbox.flush(sock))
+        self.assertEqual(bytes(sock.data), b'\x81\x03abc\x81\x02de\x81\x00')
+        self.assertEqual(len(outbox), 0)
+
+    def test_real_socket(self):
+        left, right = socket.socketpair()
+        self.assertTrue(vectored(left))
+        outbox = Outbox()
+        for index in range(1000):
+            outbox.put((b'\x81\x02', b'%02d' % (index % 100)))
+        self.assertTrue(outbox.flush(left, MSG_DONTWAIT))
+        received = b""
+        while len(received) < 4000:
+            received += right.recv(65536)
+        self.assertEqual(received[:8], b'\x81\x0200\x81\x0201')
+        left.close()
+        right.close()
+
+    def test_send_buffers_handles_partial_writes(self):
+        left, right = socket.socketpair()
+        payload = b'x' * (4 << 20)
+        received = []
+        reader = threading.Thread(target=lambda: received.append(b"".join(iter(lambda: right.recv(1 << 20), b""))))
+        reader.start()
+        send_buffers(left, (b'head', payload, b'tail'))
+        left.close()
+        reader.join()
+        self.assertEqual(received[0], b'head' + payload + b'tail')
+        right.close()
+
+class TestOutboxWriter(unittest.TestCase):
+    def test_finishes_writes_when_the_reader_catches_up(self):
+        writer_sock, reader_sock = socket.socketpair()
+        payload = b'x' * (4 * 1024 * 1024)  # More than the socket buffers hold
+        outbox = Outbox()
+        outbox.put((payload,))
+        self.assertFalse(outbox.flush(writer_sock, MSG_DONTWAIT))
+        OutboxWriter().schedule(writer_sock, outbox)
+
+        received = 0
+        reader_sock.settimeout(5)
+        while received < len(payload):
+            received += len(reader_sock.recv(1024 * 1024))
+        self.assertEqual(received, len(payload))
+        deadline = time.time() + 5
+        while len(outbox) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(outbox), 0)
+        writer_sock.close()
+        reader_sock.close()
+
+class FlowControlTests:
+    # A client that sends large messages and does not read the echoes
+    engine = None
+    size = 64 * 1024
+    count = 300
+    pauses = True  # Whether the server has to pause reading, rather than the transport holding it back
+
+    def setUp(self):
+        self.server = WebSocketServer('127.0.0.1', 0, engine=self.engine)
+        self.server.outbox_high_water = 256 * 1024
+        self.server.outbox_low_water = 64 * 1024
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.server.listening.wait()
+        self.addCleanup(self.server.stop)
+        self.sock = socket.create_connection(('127.0.0.1', self.server.sock.getsockname()[1]), timeout=10)
+        self.addCleanup(self.sock.close)
+        self.sock.sendall(b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+        self.head = b""
+        while b"\r\n\r\n" not in self.head:
+            self.head += self.sock.recv(4096)
+
+    def test_reading_pauses_until_replies_drain(self):
+        frame = build_frame_header(0x2, self.size, masking_key=bytes(4)) + b"x" * self.size
+        def send():
+            try:
+                for _ in range(self.count):
+                    self.sock.sendall(frame)
+            except OSError:
+                pass
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        peak = 0
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            peak = max(peak, self.server.outbox_memory.used)
+            time.sleep(0.005)
+        # The sender is held back instead of the server queueing every echo
+        self.assertTrue(sender.is_alive())
+        if self.pauses:
+            self.assertGreater(self.server.metrics.paused_reads.value(), 0)
+        self.assertLess(peak, self.server.outbox_high_water + 2 * len(frame))
+
+        expected = len(self.head.split(b"\r\n\r\n", 1)[1])
+        expected = self.count * (len(frame) - 4) - expected
+        received = 0
+        while received < expected:
+            received += len(self.sock.recv(1024 * 1024))
+        sender.join(5)
+        self.assertEqual(received, expected)
+
+    def test_producer_keeps_pace_with_drain(self):
+        while not self.server.clients:
+            time.sleep(0.01)
+        client = next(iter(self.server.clients))
+        self.assertTrue(self.server.drain(client, timeout=1))
+        payload = b"y" * self.size
+        peaks = []
+        done = threading.Event()
+        self.produce(client, payload, peaks, done)
+        deadline = time.time() + 1
+        while time.time() < deadline and not done.is_set():
+            time.sleep(0.01)
+        self.assertFalse(done.is_set())  # Held back by a client that is not reading
+        self.assertLessEqual(max(peaks), self.server.outbox_low_water + self.size + 10)
+
+        expected = self.count * (self.size + 10) - len(self.head.split(b"\r\n\r\n", 1)[1])
+        received = 0
+        while received < expected:
+            received += len(self.sock.recv(1024 * 1024))
+        self.assertTrue(done.wait(5))
+
+
+class TestFlowControlThreaded(FlowControlTests, unittest.TestCase):
+    engine = "threaded"
+
+    def produce(self, client, payload, peaks, done):
+        def run():
+            for _ in range(self.count):
+                self.server.send_binary(client, payload)
+                peaks.append(self.server.outbox_memory.used)
+                self.server.drain(client)
+            done.set()
+        threading.Thread(target=run, daemon=True).start()
+
+
+class TestFlowControlAsyncio(FlowControlTests, unittest.TestCase):
+    engine = "asyncio"
+    pauses = False  # Each echo already waits for the transport to drain
+
+    def produce(self, client, payload, peaks, done):
+        async def run():
+            for _ in range(self.count):
+                self.server.send_binary(client, payload)
+                peaks.append(self.server.outbox_memory.used)
+                await self.server.drain_async(client)
+            done.set()
+        asyncio.run_coroutine_threadsafe(run(), self.server.asyncio_engine.loop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import socket
+import threading
+import time
+import unittest
+
+from websocket_reconnect import ReconnectingClient
+from websocket_server import WebSocketServer
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class RecordingServer(WebSocketServer):
+    def __init__(self, host, port):
+        super().__init__(host, port)
+        self.received = []
+
+    def on_message(self, client, message):
+        self.received.append(message)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Client(ReconnectingClient):
+    def __init__(self, port, **kwargs):
+        super().__init__('127.0.0.1', port, min_delay=0.05, max_delay=0.2, **kwargs)
+        self.events = []
+
+    def on_connected(self):
+        self.events.append("connected")
+        self.send_message("hello")
+
+    def on_disconnected(self):
+        self.events.append("disconnected")
+
+
+class TestReconnectingClient(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def start_server(self):
+        server = RecordingServer('127.0.0.1', self.port)
+        self.servers.append(server)
+        threading.Thread(target=server.start, daemon=True).start()
+        return server
+
+    def test_queues_until_the_server_is_up(self):
+        client = Client(self.port)
+        self.addCleanup(client.close)
+        client.connect()
+        client.send_message("one")
+        client.send_message("two")
+        self.assertTrue(wait_for(lambda: client.failures > 0))
+        server = self.start_server()
+        self.assertTrue(client.wait_connected(5))
+        # The on_connected message goes first, then the queue in order
+        self.assertTrue(wait_for(lambda: len(server.received) == 3))
+        self.assertEqual(server.received, ["hello", "one", "two"])
+
+    def test_reconnects_after_a_restart(self):
+        server = self.start_server()
+        client = Client(self.port)
+        self.addCleanup(client.close)
+        client.connect()
+        self.assertTrue(wait_for(lambda: server.received == ["hello"]))
+        server.stop()
+        self.servers.remove(server)
+        self.assertTrue(wait_for(lambda: "disconnected" in client.events))
+        client.send_message("while down")
+        server = self.start_server()
+        self.assertTrue(wait_for(lambda: server.received == ["hello", "while down"]))
+        self.assertEqual(client.events, ["connected", "disconnected", "connected"])
+        self.assertEqual(client.stats()["connections"], 2)
+
+    def test_queue_is_bounded(self):
+        client = Client(self.port, max_queue=2)
+        for message in ("a", "b", "c"):
+            client.send_message(message)
+        self.assertEqual([payload for opcode, payload in client.queue], [b"b", b"c"])
+        self.assertEqual(client.dropped, 1)
+
+    def test_backoff_is_jittered_and_capped(self):
+        client = ReconnectingClient('127.0.0.1', self.port, min_delay=1, max_delay=8)
+        for failures in (0, 1):
+            # 0 is the retry after a lost connection
+            client.failures = failures
+            delays = [client.next_delay() for _ in range(200)]
+            self.assertTrue(all(1 <= delay <= 2 for delay in delays))
+            self.assertGreater(len(set(delays)), 100)
+        client.failures = 100
+        self.assertTrue(all(1 <= client.next_delay() <= 8 for _ in range(200)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import threading
+import time
+import unittest
+
+from websocket_rpc import RpcClient, RpcError, RpcServer
+
+
+def start_server(engine):
+    server = RpcServer('127.0.0.1', 0, max_workers=8, engine=engine)
+    server.register("add", lambda a, b: a + b)
+    server.register("echo", lambda value: value, inline=True)
+    server.register("sleep", lambda seconds, value: time.sleep(seconds) or value)
+
+    @server.register("fail")
+    def fail(message):
+        raise ValueError(message)
+
+    threading.Thread(target=server.start, daemon=True).start()
+    server.listening.wait()
+    return server
+
+
+class RpcTests:
+    engine = None
+
+    def setUp(self):
+        self.server = start_server(self.engine)
+        self.client = RpcClient('127.0.0.1', self.server.sock.getsockname()[1], default_timeout=5)
+        self.client.connect()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_many_calls_in_flight(self):
+        futures = [self.client.call("add", [i, 1]) for i in range(200)]
+        self.assertEqual([future.result(5) for future in futures], [i + 1 for i in range(200)])
+
+    def test_replies_arrive_out_of_order(self):
+        slow = self.client.call("sleep", {"seconds": 0.3, "value": "slow"})
+        fast = self.client.call("sleep", {"seconds": 0, "value": "fast"})
+        self.assertEqual(fast.result(5), "fast")
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(5), "slow")
+
+    def test_inline_handler(self):
+        self.assertEqual(self.client.request("echo", {"value": [1, "two"]}), [1, "two"])
+
+    def test_errors(self):
+        with self.assertRaises(RpcError) as raised:
+            self.client.request("fail", ["broken"])
+        self.assertEqual((raised.exception.type, str(raised.exception)), ("ValueError", "broken"))
+        with self.assertRaises(RpcError) as raised:
+            self.client.request("missing")
+        self.assertEqual(raised.exception.type, "MethodNotFound")
+
+    def test_timeout(self):
+        future = self.client.call("sleep", [1, None], timeout=0.1)
+        with self.assertRaises(TimeoutError):
+            future.result(5)
+        # The connection keeps working, and the late reply is ignored
+        self.assertEqual(self.client.request("add", [2, 2]), 4)
+
+    def test_answered_calls_do_not_pile_up_deadlines(self):
+        futures = [self.client.call("add", [i, 1], timeout=30) for i in range(1000)]
+        self.assertEqual([future.result(5) for future in futures], [i + 1 for i in range(1000)])
+        self.client.call("add", [0, 0], timeout=30).result(5)
+        self.assertLess(len(self.client.deadlines), 200)
+
+    def test_close_fails_calls_and_stops_the_timer(self):
+        future = self.client.call("sleep", [1, None], timeout=30)
+        timer = self.client.timer
+        self.client.close()
+        with self.assertRaises(ConnectionError):
+            future.result(5)
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+
+    def test_pending_calls_fail_when_the_connection_closes(self):
+        future = self.client.call("sleep", [1, None], timeout=0)
+        time.sleep(0.1)
+        self.server.stop()
+        with self.assertRaises(ConnectionError):
+            future.result(5)
+
+
+class TestRpcThreaded(RpcTests, unittest.TestCase):
+    engine = "threaded"
+
+
+class TestRpcAsyncio(RpcTests, unittest.TestCase):
+    engine = "asyncio"
+
+
+if __name__ == '__main__':
+    unittest.main()
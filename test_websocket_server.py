@@ -3,9 +3,22 @@ import socket
 import threading
 from unittest.mock import Mock, patch
 from websocket_server import WebSocketServer
+from websocket_frames import MessageTooBigError
+from websocket_handshake import HandshakeError
+from websocket_heartbeat import HeartbeatScheduler
+from test_helpers import FakeClock, feed_recv_into
 import time
 from threading import Event
 
+def registered_client(server):
+    mock_client = Mock()
+    mock_client.send.side_effect = lambda data, flags=0: len(data)
+    server.add_client(mock_client, "test")
+    return mock_client
+
+def sent_frames(mock_sock):
+    return [bytes(args[0]) for name, args, kwargs in mock_sock.mock_calls if name in ('send', 'sendall')]
+
 class TestWebSocketServer(unittest.TestCase):
     def setUp(self):
         self.server = WebSocketServer('localhost', 8765)
@@ -32,59 +45,264 @@ class TestWebSocketServer(unittest.TestCase):
             b"Sec-WebSocket-Version: 13\r\n\r\n"
         )
         self.server.handshake(mock_client)
-        mock_client.send.assert_called_once()
-        sent_data = mock_client.send.call_args[0][0].decode('utf-8')
+        mock_client.sendall.assert_called_once()
+        sent_data = mock_client.sendall.call_args[0][0].decode('utf-8')
         self.assertIn("HTTP/1.1 101 Switching Protocols", sent_data)
         self.assertIn("Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", sent_data)
 
+    def test_rejected_handshake_sends_the_whole_error_response(self):
+        mock_client = Mock()
+        mock_client.recv.return_value = b"GET / HTTP/1.1\r\nHost: localhost:8765\r\n\r\n"
+        with self.assertRaises(HandshakeError):
+            self.server.handshake(mock_client)
+        mock_client.send.assert_not_called()
+        self.assertTrue(mock_client.sendall.call_args[0][0].startswith(b"HTTP/1.1 426 Upgrade Required"))
+
     def test_receive_message(self):
         mock_client = Mock()
-        mock_client.recv.side_effect = [
+        feed_recv_into(mock_client, 
             b'\x81\x05',  # Frame header (text frame, 5 bytes payload)
             b'Hello'      # Payload
-        ]
+        )
         message = self.server.receive_message(mock_client)
         self.assertEqual(message, "Hello")
 
+    def test_receive_message_split_payload(self):
+        mock_client = Mock()
+        feed_recv_into(mock_client, b'\x81\x0bHel', b'lo ', b'world')
+        self.assertEqual(self.server.receive_message(mock_client), "Hello world")
+
+    def test_receive_messages_from_one_read(self):
+        mock_client = Mock()
+        feed_recv_into(mock_client, b'\x81\x03one\x81\x03two')
+        self.assertEqual(self.server.receive_message(mock_client), "one")
+        self.assertEqual(self.server.receive_message(mock_client), "two")
+        self.assertEqual(mock_client.recv_into.call_count, 1)
+
+    def test_receive_message_answers_ping(self):
+        mock_client = Mock()
+        feed_recv_into(mock_client, b'\x89\x00\x81\x05Hello')
+        self.assertEqual(self.server.receive_message(mock_client), "Hello")
+        self.assertEqual(sent_frames(mock_client), [b'\x8a\x00'])
+
+    def test_receive_fragmented_message(self):
+        mock_client = Mock()
+        feed_recv_into(mock_client, b'\x01\x03Hel', b'\x89\x00', b'\x00\x01l', b'\x80\x01o')
+        self.assertEqual(self.server.receive_message(mock_client), "Hello")
+        self.assertEqual(sent_frames(mock_client), [b'\x8a\x00'])
+
+    def test_receive_message_too_big(self):
+        mock_client = Mock()
+        self.server.max_message_size = 4
+        feed_recv_into(mock_client, b'\x01\x03Hel', b'\x80\x02lo')
+        with self.assertRaises(MessageTooBigError):
+            self.server.receive_message(mock_client)
+
+    def test_receive_stream(self):
+        mock_client = Mock()
+        # The two bytes of 'é' are split across fragments
+        feed_recv_into(mock_client, b'\x01\x02ab', b'\x00\x01\xc3', b'\x80\x02\xa9c')
+        chunks = list(self.server.receive_stream(mock_client))
+        self.assertEqual(chunks, ["ab", "", "éc"])
+
+    def test_send_fragments(self):
+        mock_client = registered_client(self.server)
+        self.server.send_fragments(mock_client, iter(["Hel", "lo"]))
+        self.assertEqual(sent_frames(mock_client), [b'\x01\x03Hel', b'\x80\x02lo'])
+
+    def test_send_large_message_without_concatenating(self):
+        mock_client = registered_client(self.server)
+        self.server.send_message(mock_client, "x" * 70000)
+        header, payload = sent_frames(mock_client)
+        self.assertEqual(header, b'\x81\x7f' + (70000).to_bytes(8, 'big'))
+        self.assertEqual(len(payload), 70000)
+
+    def test_receive_binary_message(self):
+        mock_client = Mock()
+        feed_recv_into(mock_client, b'\x82\x03\x00\xff\x10')
+        message = self.server.receive_message(mock_client)
+        self.assertIsInstance(message, bytes)
+        self.assertEqual(message, b'\x00\xff\x10')
+
+    def test_send_binary(self):
+        mock_client = registered_client(self.server)
+        self.server.send_binary(mock_client, memoryview(b'\x00\x01'))
+        self.assertEqual(sent_frames(mock_client), [b'\x82\x02\x00\x01'])
+
+    def test_binary_echo(self):
+        mock_client = registered_client(self.server)
+        self.server.on_message(mock_client, b'\xde\xad')
+        self.assertEqual(sent_frames(mock_client), [b'\x82\x02\xde\xad'])
+
+    def test_broadcast_to_shares_one_frame(self):
+        mock_clients = [Mock(), Mock()]
+        for mock_client in mock_clients:
+            mock_client.send.side_effect = lambda data, flags=0: len(data)
+            self.server.add_client(mock_client, "test")
+        with patch.object(self.server, 'prepare_frame', wraps=self.server.prepare_frame) as prepare:
+            self.server.broadcast_to(mock_clients, "Hi")
+        prepare.assert_called_once()
+        for mock_client in mock_clients:
+            self.assertEqual(sent_frames(mock_client), [b'\x81\x02', b'Hi'])
+
+    def test_broadcast_disconnects_slow_consumer(self):
+        mock_client = Mock()
+        mock_client.send.side_effect = BlockingIOError
+        self.server.slow_consumer_policy = "disconnect"
+        self.server.outbox_size = 1
+        self.server.add_client(mock_client, "test")
+        self.server.flusher = Mock()
+        self.server.broadcast_to([mock_client], "one")
+        mock_client.shutdown.assert_not_called()
+        self.server.broadcast_to([mock_client], "two")
+        mock_client.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+    def test_cork_batches_frames(self):
+        left, right = socket.socketpair()
+        self.server.add_client(left, "test")
+        with self.server.corked(left):
+            for index in range(50):
+                self.server.send_message(left, "m%02d" % index)
+            self.assertEqual(len(self.server.clients[left].outbox), 50)
+        self.assertEqual(len(self.server.clients[left].outbox), 0)
+        received = b""
+        while len(received) < 250:
+            received += right.recv(4096)
+        self.assertEqual(received[:10], b'\x81\x03m00\x81\x03m01')
+        left.close()
+        right.close()
+
     def test_send_message(self):
+        mock_client = registered_client(self.server)
+        self.server.send_message(mock_client, "Hello")
+        self.assertEqual(sent_frames(mock_client), [b'\x81\x05Hello'])
+
+    def test_send_to_a_disconnected_client_is_dropped(self):
         mock_client = Mock()
         self.server.send_message(mock_client, "Hello")
-        mock_client.send.assert_called_once()
-        sent_data = mock_client.send.call_args[0][0]
-        self.assertEqual(sent_data, b'\x81\x05Hello')
+        self.assertEqual(sent_frames(mock_client), [])
 
     def test_send_ping(self):
         mock_client = Mock()
-        self.server.clients[mock_client] = {"address": "test", "last_pong": time.time()}
+        mock_client.send.side_effect = lambda data, flags=0: len(data)
+        self.server.add_client(mock_client, "test")
         self.server.send_ping(mock_client)
-        mock_client.send.assert_called_once_with(b'\x89\x00')
+        self.assertEqual(sent_frames(mock_client), [b'\x89\x00'])
+
+    def test_ping_never_waits_for_a_full_outbox(self):
+        mock_client = Mock()
+        mock_client.send.side_effect = BlockingIOError
+        self.server.slow_consumer_policy = "block"
+        self.server.outbox_size = 1
+        self.server.flusher = Mock()
+        self.server.add_client(mock_client, "test")
+        self.server.send_message(mock_client, "fills the queue")
+        ping = threading.Thread(target=self.server.send_ping, args=(mock_client,))
+        ping.start()
+        ping.join(2)
+        self.assertFalse(ping.is_alive())
+        mock_client.shutdown.assert_called_once_with(socket.SHUT_RDWR)
 
     def test_handle_pong(self):
         mock_client = Mock()
-        self.server.clients[mock_client] = {"address": "test", "last_pong": 0}
+        conn = self.server.add_client(mock_client, "test")
+        conn.last_pong = 0
         self.server.handle_pong(mock_client)
-        self.assertAlmostEqual(self.server.clients[mock_client]["last_pong"], time.time(), delta=0.1)
+        self.assertAlmostEqual(conn.last_pong, time.time(), delta=0.1)
 
-    @patch('threading.Thread')
-    def test_heartbeat(self, mock_thread):
+    def test_heartbeat(self):
         mock_client = Mock()
-        self.server.clients[mock_client] = {"address": "test", "last_pong": time.time()}
-        
-        def side_effect(*args, **kwargs):
-            self.server.heartbeat(mock_client)
-        mock_thread.side_effect = side_effect
-
-        self.server.handle_client(mock_client, "test")
-        mock_thread.assert_called()
+        mock_client.send.side_effect = lambda data, flags=0: len(data)
+        clock = FakeClock()
+        self.server.heartbeats = HeartbeatScheduler(self.server.send_ping, self.server.expire_client, clock=clock)
+        self.server.add_client(mock_client, "test")
+        self.server.heartbeats.add(mock_client, self.server.heartbeat_interval, self.server.heartbeat_timeout)
 
         # Simulate a successful heartbeat
-        time.sleep(self.server.heartbeat_interval + 1)
-        self.assertIn(mock_client, self.server.clients)
+        clock.now += self.server.heartbeat_interval + 1
+        self.server.heartbeats.advance()
+        self.assertEqual(sent_frames(mock_client), [b'\x89\x00'])
+        clock.now += 1
+        self.server.handle_pong(mock_client)
+        clock.now += self.server.heartbeat_timeout
+        self.server.heartbeats.advance()
+        mock_client.shutdown.assert_not_called()
 
         # Simulate a failed heartbeat
-        self.server.clients[mock_client]["last_pong"] = 0
-        time.sleep(self.server.heartbeat_interval + self.server.heartbeat_timeout + 1)
-        self.assertNotIn(mock_client, self.server.clients)
+        clock.now += self.server.heartbeat_interval + self.server.heartbeat_timeout + 1
+        self.server.heartbeats.advance()
+        self.assertEqual(len(sent_frames(mock_client)), 2)
+        clock.now += self.server.heartbeat_timeout + 1
+        self.server.heartbeats.advance()
+        mock_client.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+    def test_no_ping_while_traffic_flows(self):
+        mock_client = Mock()
+        clock = FakeClock()
+        self.server.heartbeats = HeartbeatScheduler(self.server.send_ping, self.server.expire_client, clock=clock)
+        self.server.add_client(mock_client, "test")
+        self.server.heartbeats.add(mock_client, self.server.heartbeat_interval, self.server.heartbeat_timeout)
+        for _ in range(5):
+            clock.now += self.server.heartbeat_interval - 1
+            feed_recv_into(mock_client, b'\x81\x02hi')
+            self.assertEqual(self.server.receive_message(mock_client), "hi")
+            self.server.heartbeats.advance()
+        mock_client.send.assert_not_called()
+
+class TestAsyncioEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = WebSocketServer('127.0.0.1', 0, engine='asyncio')
+        self.port = self.server.sock.getsockname()[1]
+        threading.Thread(target=self.server.start, daemon=True).start()
+        # Stopping before the loop is up would close the socket under start()
+        self.assertTrue(self.server.listening.wait(5))
+        self.addCleanup(self.server.stop)
+
+    def connect(self):
+        self.assertTrue(self.server.listening.wait(5))
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        sock.sendall(
+            b"GET / HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Upgrade: websocket\r\n"
+            b"Connection: Upgrade\r\n"
+            b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            b"Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        response = b""
+        while b"\r\n\r\n" not in response:
+            response += sock.recv(1024)
+        self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", response)
+        return sock
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            WebSocketServer('localhost', 0, engine='gevent')
+
+    def test_silent_client_is_dropped_after_the_handshake_timeout(self):
+        self.server.handshake_timeout = 0.2
+        self.assertTrue(self.server.listening.wait(5))
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.recv(1024), b"")
+
+    def test_echo(self):
+        sock = self.connect()
+        key = b'\x01\x02\x03\x04'
+        masked = bytes(b ^ key[i % 4] for i, b in enumerate(b'Hello'))
+        sock.sendall(b'\x81\x85' + key + masked)
+        expected = b'\x81\x0bEcho: Hello'
+        data = b""
+        while len(data) < len(expected):
+            data += sock.recv(1024)
+        self.assertEqual(data, expected)
+        sock.close()
+
+    def test_ping_is_answered(self):
+        sock = self.connect()
+        sock.sendall(b'\x89\x80\x00\x00\x00\x00')
+        self.assertEqual(sock.recv(2), b'\x8a\x00')
+        sock.close()
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from websocket_client import WebSocketClient
+from websocket_server import WebSocketServer
+from websocket_tls import client_context, sessions
+
+directory = None
+
+
+def setUpModule():
+    # A throwaway self-signed certificate for 127.0.0.1
+    global directory
+    if shutil.which("openssl") is None:
+        raise unittest.SkipTest("openssl is needed to make a test certificate")
+    directory = tempfile.mkdtemp()
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                    "-keyout", os.path.join(directory, "key.pem"), "-out", os.path.join(directory, "cert.pem"),
+                    "-days", "1", "-nodes", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+                   check=True, capture_output=True)
+
+
+def tearDownModule():
+    if directory is not None:
+        shutil.rmtree(directory)
+
+
+class TlsTests:
+    engine = None
+
+    def setUp(self):
+        self.server = WebSocketServer('127.0.0.1', 0, use_ssl=True, engine=self.engine,
+                                      certfile=os.path.join(directory, "cert.pem"),
+                                      keyfile=os.path.join(directory, "key.pem"))
+        threading.Thread(target=self.server.start, daemon=True).start()
+        self.server.listening.wait()
+        self.addCleanup(self.server.stop)
+        self.port = self.server.sock.getsockname()[1]
+        self.context = client_context(cafile=os.path.join(directory, "cert.pem"))
+        sessions.clear()
+
+    def connect(self):
+        client = WebSocketClient('127.0.0.1', self.port, use_ssl=True)
+        client.ssl_context = self.context
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        return client
+
+    def test_echo_over_tls_with_alpn(self):
+        client = self.connect()
+        self.assertEqual(client.sock.selected_alpn_protocol(), "http/1.1")
+        client.send_message("secret")
+        self.assertEqual(client.receive_message(), "Echo: secret")
+
+    def test_next_connection_resumes_the_session(self):
+        first = self.connect()
+        first.send_message("one")
+        self.assertEqual(first.receive_message(), "Echo: one")
+        self.assertFalse(first.sock.session_reused)
+        second = self.connect()
+        self.assertTrue(second.sock.session_reused)
+        second.send_message("two")
+        self.assertEqual(second.receive_message(), "Echo: two")
+
+    def test_stalled_client_does_not_hold_up_others(self):
+        # Connects and never starts its TLS handshake
+        stalled = socket.create_connection(('127.0.0.1', self.port))
+        self.addCleanup(stalled.close)
+        client = self.connect()
+        client.send_message("hello")
+        self.assertEqual(client.receive_message(), "Echo: hello")
+
+    def test_client_that_stops_reading_does_not_hold_up_others(self):
+        # Its echo is far larger than the socket buffers, and it never reads it
+        stalled = self.connect()
+        stalled.send_binary(b"x" * 8 * 1024 * 1024)
+        deadline = time.monotonic() + 5
+        while self.server.outbox_memory.used == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)  # Until the socket buffers are full
+        client = self.connect()
+        client.sock.settimeout(5)
+        client.send_message("hello")
+        self.assertEqual(client.receive_message(), "Echo: hello")
+
+
+class TestTlsThreaded(TlsTests, unittest.TestCase):
+    engine = "threaded"
+
+
+class TestTlsAsyncio(TlsTests, unittest.TestCase):
+    engine = "asyncio"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+import unittest
+
+from websocket_client import WebSocketClient
+from websocket_server import WebSocketServer
+from websocket_tracing import Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def test_ring_buffer_keeps_the_latest_spans(self):
+        tracer = Tracer(capacity=3, sample_every=1)
+        for i in range(5):
+            tracer.span("stage", float(i), float(i) + 0.5, index=i)
+        self.assertEqual([span["index"] for span in tracer.spans()], [2, 3, 4])
+        self.assertEqual(tracer.stats()["recorded"], 5)
+
+    def test_sampling_and_trace_ids(self):
+        tracer = Tracer(sample_every=4)
+        self.assertEqual([bool(tracer.sample()) for _ in range(8)], [False, False, False, True] * 2)
+        tracer.begin()
+        tracer.span("receive", 1.0, 2.0)
+        tracer.end()
+        tracer.span("other", 3.0, 4.0)
+        self.assertEqual([span["trace"] for span in tracer.spans()], [1, 0])
+
+    def test_chrome_format(self):
+        tracer = Tracer()
+        tracer.span("handler", 1.0, 1.25, size=3)
+        event = json.loads(tracer.to_chrome())["traceEvents"][0]
+        self.assertEqual((event["name"], event["ph"], event["ts"], event["dur"]), ("handler", "X", 1e6, 0.25e6))
+        self.assertEqual(event["args"], {"trace": 0, "size": 3})
+
+
+class TracingTests:
+    engine = None
+
+    def test_every_stage_of_a_sampled_message(self):
+        server = WebSocketServer('127.0.0.1', 0, engine=self.engine)
+        tracer = server.enable_tracing(sample_every=1)
+        threading.Thread(target=server.start, daemon=True).start()
+        server.listening.wait()
+        self.addCleanup(server.stop)
+
+        client = WebSocketClient('127.0.0.1', server.sock.getsockname()[1])
+        client.receive_messages = lambda: None
+        client.connect()
+        self.addCleanup(client.close)
+        client.send_message("hello")
+        self.assertEqual(client.receive_message(), "Echo: hello")
+
+        # The handler span is recorded once on_message returns, maybe after the reply arrived
+        deadline = time.monotonic() + 5
+        while "handler" not in [span["name"] for span in tracer.spans()] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        spans = tracer.spans()
+        names = [span["name"] for span in spans]
+        self.assertIn("handshake", names)
+        message = [span for span in spans if span["name"] in ("receive", "handler", "send")]
+        self.assertEqual([span["name"] for span in message], ["receive", "handler", "send"])
+        self.assertEqual(len({span["trace"] for span in message}), 1)
+        self.assertEqual(message[0]["size"], 5)
+        self.assertTrue(all(span["end"] >= span["start"] for span in spans))
+
+
+class TestTracingThreaded(TracingTests, unittest.TestCase):
+    engine = "threaded"
+
+
+class TestTracingAsyncio(TracingTests, unittest.TestCase):
+    engine = "asyncio"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from websocket_workers import ChannelHub, RecordReader, decode_record, encode_record
+
+# A pool of two workers: each connection is told the pid of its worker, and every message is published
+POOL_SCRIPT = '''
+import os
+import sys
+from websocket_server import WebSocketServer
+
+class PoolServer(WebSocketServer):
+    def on_open(self, client):
+        self.send_message(client, f"pid {os.getpid()}")
+
+    def on_message(self, client, message):
+        self.publish(message)
+
+server = PoolServer('127.0.0.1', 0, engine=sys.argv[1])
+server.heartbeat_interval = 3600
+print(server.sock.getsockname()[1], flush=True)
+server.serve(workers=2, shutdown_timeout=5)
+'''
+
+
+def read_frame(sock):
+    header = recv_exactly(sock, 2)
+    length = header[1] & 0x7F
+    if length == 126:
+        length = int.from_bytes(recv_exactly(sock, 2), 'big')
+    return header[0] & 0x0F, recv_exactly(sock, length)
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    sock.sendall(
+        b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    )
+    response = b""
+    while not response.endswith(b"\r\n\r\n"):
+        response += sock.recv(1)
+    opcode, payload = read_frame(sock)
+    return sock, int(payload.split()[1])
+
+
+def send_text(sock, text):
+    key = b'\x01\x02\x03\x04'
+    payload = text.encode()
+    masked = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    sock.sendall(bytes([0x81, 0x80 | len(payload)]) + key + masked)
+
+
+class TestRecords(unittest.TestCase):
+    def test_round_trip(self):
+        reader = RecordReader()
+        data = encode_record("héllo") + encode_record(b'\x00\x01')
+        records = reader.feed(data[:3]) + reader.feed(data[3:9]) + reader.feed(data[9:])
+        self.assertEqual([decode_record(record) for record in records], ["héllo", b'\x00\x01'])
+
+    def test_hub_relays_to_the_other_workers(self):
+        hub = ChannelHub()
+        pairs = [socket.socketpair() for _ in range(3)]
+        for supervisor_end, worker_end in pairs:
+            worker_end.settimeout(5)
+            hub.add(supervisor_end)
+        record = encode_record("hi")
+        pairs[0][1].sendall(record)
+        self.assertEqual(pairs[1][1].recv(100), record)
+        self.assertEqual(pairs[2][1].recv(100), record)
+        pairs[0][1].setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            pairs[0][1].recv(100)
+        for supervisor_end, worker_end in pairs:
+            hub.remove(supervisor_end)
+            worker_end.close()
+
+    def test_worker_that_stops_reading_does_not_hold_up_the_others(self):
+        hub = ChannelHub(max_buffered=256 * 1024)
+        pairs = [socket.socketpair() for _ in range(3)]
+        for supervisor_end, worker_end in pairs:
+            worker_end.settimeout(5)
+            hub.add(supervisor_end)
+            self.addCleanup(worker_end.close)
+            self.addCleanup(hub.remove, supervisor_end)
+        record = encode_record("x" * 1024)
+        count = 2000  # Far more than the socket buffer of the worker that never reads
+        received = bytearray()
+
+        def read():
+            while len(received) < count * len(record):
+                data = pairs[1][1].recv(65536)
+                if not data:
+                    return
+                received.extend(data)
+        reader = threading.Thread(target=read)
+        reader.start()
+        for _ in range(count):
+            pairs[0][1].sendall(record)
+        reader.join(10)
+        self.assertEqual(len(received), count * len(record))
+        self.assertEqual(hub.dropped, 1)
+        # The stalled worker's channel was closed after what it had already been sent
+        stalled = pairs[2][1]
+        while stalled.recv(65536):
+            pass
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"), "needs SO_REUSEPORT and fork")
+class TestWorkerPool(unittest.TestCase):
+    def run_pool(self, engine):
+        root = os.path.dirname(os.path.abspath(__file__))
+        pool = subprocess.Popen([sys.executable, "-c", POOL_SCRIPT, engine], cwd=root,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        self.addCleanup(pool.wait)
+        self.addCleanup(pool.kill)
+        port = int(pool.stdout.readline())
+        time.sleep(0.5)  # Let the workers bind
+
+        # Connect until both workers own at least one connection
+        connections = []
+        deadline = time.monotonic() + 10
+        while len({pid for sock, pid in connections}) < 2 and time.monotonic() < deadline:
+            connections.append(connect(port))
+        self.assertEqual(len({pid for sock, pid in connections}), 2)
+
+        # A message published on one worker reaches the clients of both
+        send_text(connections[0][0], "to everyone")
+        for sock, pid in connections:
+            self.assertEqual(read_frame(sock), (0x1, b"to everyone"))
+
+        # A killed worker is replaced
+        dead = connections[0][1]
+        os.kill(dead, signal.SIGKILL)
+        deadline = time.monotonic() + 10
+        pids = set()
+        while time.monotonic() < deadline:
+            try:
+                sock, pid = connect(port)
+            except ConnectionError:
+                continue  # Queued on the dead worker's socket before the kernel dropped it
+            sock.close()
+            pids.add(pid)
+            if len(pids - {dead}) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(pids - {dead}), 2)
+
+        # SIGTERM closes the remaining clients with 1001 and stops the pool
+        survivor = next(sock for sock, pid in connections if pid != dead)
+        pool.send_signal(signal.SIGTERM)
+        self.assertEqual(read_frame(survivor), (0x8, (1001).to_bytes(2, 'big')))
+        self.assertEqual(pool.wait(10), 0)
+        for sock, pid in connections:
+            sock.close()
+
+    def test_threaded_workers(self):
+        self.run_pool("threaded")
+
+    def test_asyncio_workers(self):
+        self.run_pool("asyncio")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import random
+import ssl
+import struct
+from collections import deque
+from contextlib import asynccontextmanager
+
+from websocket_client import WebSocketClient, check_handshake_response, handshake_request
+from websocket_frames import CLOSED, FrameParser, MessageAssembler, apply_mask, build_frame_header, iter_fragments, next_message
+from websocket_tls import default_client_context
+
+logger = logging.getLogger(__name__)
+
+# How long a connection sits unread (e.g. in a pool) before serve_idle() starts reading it
+IDLE_READ_DELAY = 0.05
+
+
+class AsyncWebSocketClient:
+    # asyncio counterpart of WebSocketClient: no threads, so a process can hold thousands of
+    # connections on one event loop. One task at a time may recv(); any task may send().
+    #
+    #     client = await AsyncWebSocketClient('localhost', 8765).connect()
+    #     await client.send("hello")
+    #     async for message in client:
+    #         ...
+    read_size = 65536
+    metrics = WebSocketClient.metrics  # The same counters as the threaded client
+    ssl_context = None  # None for the context shared by every client in the process
+
+    def __init__(self, host, port, use_ssl=False, compression=None, path="/", extra_headers=None,
+                 max_message_size=64 * 1024 * 1024, ping_interval=30, ping_timeout=10):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.compression = compression  # DeflateConfig to offer permessage-deflate
+        self.path = path
+        self.extra_headers = extra_headers or {}
+        self.max_message_size = max_message_size  # Reassembled message limit, None to disable
+        self.ping_interval = ping_interval  # Ping after this long without traffic, None to disable
+        self.ping_timeout = ping_timeout
+        self.deflate = None
+        self.reader = None
+        self.writer = None
+        self.parser = FrameParser(max_frame_size=max_message_size)
+        self.assembler = MessageAssembler(max_message_size)
+        self.closed = True
+        self.close_sent = False
+        self.last_activity = 0.0
+        self.reading_since = None  # When the pending read started, None while nothing reads
+        self.keepalive_task = None
+        self.idle_task = None  # Reads while nobody calls recv(), see serve_idle()
+        self.idle_timer = None
+        self.backlog = deque()  # Messages that arrived meanwhile, for the next recv()
+
+    async def connect(self):
+        # asyncio cannot resume TLS sessions, but the context at least is built once
+        context = (self.ssl_context or default_client_context()) if self.use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context, server_hostname=self.host if context else None
+        )
+        try:
+            request, key = handshake_request(self.host, self.port, self.path, self.compression, self.extra_headers)
+            self.writer.write(request)
+            # Anything the server sent after the response stays buffered in the reader
+            response = await self.reader.readuntil(b"\r\n\r\n")
+            self.deflate = check_handshake_response(response, key, self.compression)
+        except BaseException:
+            self.metrics.handshake_failures.inc()
+            self.writer.close()
+            raise
+        self.metrics.connections.inc()
+        self.assembler.deflate = self.deflate
+        self.closed = False
+        self.close_sent = False
+        loop = asyncio.get_running_loop()
+        self.last_activity = loop.time()
+        if self.ping_interval:
+            self.keepalive_task = loop.create_task(self.keepalive())
+        logger.debug(f"Connected to {self.host}:{self.port}")
+        return self
+
+    async def __aenter__(self):
+        if self.closed:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.recv()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def write_frame(self, opcode, payload, fin=True, rsv1=False):
+        # Client frames are always masked; header and payload go to the transport in one call
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        self.metrics.frame_sent(opcode, len(payload))
+        masking_key = random.getrandbits(32).to_bytes(4, 'big')
+        header = build_frame_header(opcode, len(payload), fin, masking_key, rsv1)
+        self.writer.writelines((header, apply_mask(payload, masking_key)))
+
+    async def send(self, message):
+        # str goes as a text message, bytes-like data as a binary one; waits while the transport
+        # buffer is over its high-water mark
+        if isinstance(message, str):
+            opcode, payload = 0x1, message.encode('utf-8')
+        else:
+            opcode, payload = 0x2, message.cast('B') if isinstance(message, memoryview) else message
+        if self.deflate is not None and self.deflate.should_compress(len(payload)):
+            self.write_frame(opcode, self.deflate.compress(payload), rsv1=True)
+        else:
+            self.write_frame(opcode, payload)
+        await self.writer.drain()
+
+    async def send_fragments(self, fragments, opcode=0x1):
+        # Send one message as a series of frames from any iterable of str or bytes chunks
+        rsv1 = self.deflate is not None  # Only the first frame carries the compression flag
+        for payload, fin in iter_fragments(fragments):
+            if self.deflate is not None:
+                payload = self.deflate.compress(payload, final=fin)
+            self.write_frame(opcode, payload, fin, rsv1)
+            await self.writer.drain()
+            opcode = 0x0  # Every frame after the first is a continuation
+            rsv1 = False
+
+    async def recv(self):
+        # The next message (str or bytes), or None once the connection is closed
+        if self.backlog:
+            return self.backlog.popleft()
+        return await self.read_message()
+
+    async def read_message(self):
+        while True:
+            result = next_message(self.parser.next_frame, self.assembler, self.control_frame, self.metrics)
+            if result is CLOSED:
+                return None
+            if result is not None:
+                return result[0]
+            if self.closed:
+                return None
+            loop = asyncio.get_running_loop()
+            self.reading_since = loop.time()
+            try:
+                data = await self.reader.read(self.read_size)
+            except ConnectionError:
+                data = b""
+            finally:
+                self.reading_since = None
+            if not data:
+                self.abort()
+                return None
+            self.parser.feed(data)
+            self.last_activity = loop.time()
+
+    def control_frame(self, frame):
+        opcode = frame.opcode
+        if opcode == 0x9:  # Ping
+            self.write_frame(0xA, bytes(frame.payload))
+        elif opcode == 0x8:  # Close
+            if not self.close_sent:
+                self.close_sent = True
+                self.write_frame(0x8, bytes(frame.payload[:2]))
+            self.abort()
+
+    def serve_idle(self):
+        # Keep reading while nobody calls recv(), as in a pool: pings are answered and pongs keep
+        # the keepalive satisfied. Call stop_idle() before the next recv(). Reading starts after
+        # IDLE_READ_DELAY, so a connection handed straight back out costs no task.
+        if self.idle_timer is None and self.idle_task is None and not self.closed:
+            self.idle_timer = asyncio.get_running_loop().call_later(IDLE_READ_DELAY, self.start_idle_read)
+
+    def start_idle_read(self):
+        self.idle_timer = None
+        if not self.closed:
+            self.idle_task = asyncio.get_running_loop().create_task(self.read_while_idle())
+
+    async def stop_idle(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        task, self.idle_task = self.idle_task, None
+        if task is not None:
+            # Cancelling a pending read loses nothing: the bytes stay in the reader
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def read_while_idle(self):
+        try:
+            while not self.closed:
+                message = await self.read_message()
+                if message is None:
+                    break
+                self.backlog.append(message)
+        except ValueError as e:
+            logger.warning(f"Protocol error from idle connection {self.host}:{self.port}: {e}")
+            self.abort()
+
+    async def ping(self, payload=b""):
+        self.write_frame(0x9, payload)
+        await self.writer.drain()
+
+    async def keepalive(self):
+        # Ping an idle connection; drop it if nothing at all arrives within ping_timeout. Only a
+        # read can see the pong, so a client nobody reads from (one that only sends) is not dropped.
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            idle = loop.time() - self.last_activity
+            if idle < self.ping_interval:
+                await asyncio.sleep(self.ping_interval - idle)
+                continue
+            sent = loop.time()
+            try:
+                await self.ping()
+            except ConnectionError:
+                break
+            await asyncio.sleep(self.ping_timeout)
+            if self.last_activity >= sent:
+                continue
+            if self.reading_since is not None and self.reading_since <= sent:
+                # A read has waited since before the ping and got nothing
+                logger.warning(f"Heartbeat timeout for {self.host}:{self.port}")
+                self.metrics.heartbeat_timeouts.inc()
+                self.abort()
+            else:
+                await asyncio.sleep(max(self.ping_interval - self.ping_timeout, 0))
+
+    def abort(self):
+        self.closed = True
+        current = asyncio.current_task()
+        for task in (self.keepalive_task, self.idle_task):
+            if task is not None and task is not current:
+                task.cancel()
+        self.keepalive_task = self.idle_task = None
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if self.writer is not None:
+            self.writer.close()
+
+    async def close(self, code=1000):
+        if not self.closed and not self.close_sent:
+            self.close_sent = True
+            try:
+                self.write_frame(0x8, struct.pack('!H', code))
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+        self.abort()
+        if self.writer is not None:
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+    def get_compression_stats(self):
+        # permessage-deflate statistics, None if compression is off
+        if self.deflate is None:
+            return None
+        return self.deflate.stats()
+
+
+class WebSocketPool:
+    # Keeps up to `size` connections to one server and lends them to tasks, most recently used
+    # first, so a burst of requests reuses warm connections instead of paying a handshake each.
+    #
+    #     async with pool.connection() as client:
+    #         await client.send(request)
+    #         reply = await client.recv()
+    #
+    # A connection is only returned to the pool if the block exits normally; after an exception
+    # its state is unknown, so it is closed. Idle connections keep reading (serve_idle()), so they
+    # answer pings and their keepalive does not time them out.
+    def __init__(self, host, port, size=10, **client_options):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.client_options = client_options
+        self.idle = deque()
+        self.opened = 0  # Connections open or being opened, idle or lent out
+        self.available = asyncio.Condition()
+        self.closed = False
+        self.created = 0
+        self.reused = 0
+
+    async def start(self, warm=None):
+        # Open `warm` connections (all of them by default) before the first acquire
+        count = self.size if warm is None else min(warm, self.size)
+        clients = await asyncio.gather(*(self.acquire() for _ in range(count)))
+        for client in clients:
+            await self.release(client)
+        return self
+
+    async def acquire(self):
+        async with self.available:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Pool is closed")
+                while self.idle:
+                    client = self.idle.pop()
+                    await client.stop_idle()
+                    if not client.closed:
+                        self.reused += 1
+                        return client
+                    self.opened -= 1
+                if self.opened < self.size:
+                    self.opened += 1
+                    break
+                await self.available.wait()
+        try:
+            client = AsyncWebSocketClient(self.host, self.port, **self.client_options)
+            await client.connect()
+        except BaseException:
+            async with self.available:
+                self.opened -= 1
+                self.available.notify()
+            raise
+        self.created += 1
+        return client
+
+    async def release(self, client, reuse=True):
+        if not reuse or self.closed or client.closed:
+            await client.close()
+            reuse = False
+        async with self.available:
+            if reuse:
+                client.serve_idle()
+                self.idle.append(client)
+            else:
+                self.opened -= 1
+            self.available.notify()
+
+    @asynccontextmanager
+    async def connection(self):
+        client = await self.acquire()
+        try:
+            yield client
+        except BaseException:
+            await self.release(client, reuse=False)
+            raise
+        await self.release(client)
+
+    async def close(self):
+        async with self.available:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+            self.opened -= len(idle)
+            self.available.notify_all()
+        for client in idle:
+            await client.close()
+
+    def stats(self):
+        return {"size": self.size, "open": self.opened, "idle": len(self.idle),
+                "in_use": self.opened - len(self.idle), "created": self.created, "reused": self.reused}
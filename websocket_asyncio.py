@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import struct
+
+from websocket_frames import CLOSED, next_message
+from websocket_handshake import HandshakeError, HeadReader, split_head
+from websocket_outbox import SlowConsumerError
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioConnection:
+    # Socket-like adapter so the server's framing helpers can write to an asyncio transport
+    def __init__(self, writer, address):
+        self.writer = writer
+        self.address = address
+        self.draining = False
+        self.flushed = None  # Future a paused reader waits on, resolved after each flush
+
+    def wake(self):
+        if self.flushed is not None:
+            if not self.flushed.done():
+                self.flushed.set_result(None)
+            self.flushed = None
+
+    def send(self, data, flags=0):
+        # Refuse like a full non-blocking socket once the transport buffer is over its
+        # high-water mark, so frames wait in the connection's bounded outbox instead
+        self.check_room()
+        self.writer.write(data)
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        # Hand every queued buffer to the transport at once, it writes them with one send
+        self.check_room()
+        self.writer.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def check_room(self):
+        transport = self.writer.transport
+        if transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+            raise BlockingIOError
+
+    def sendall(self, data):
+        self.writer.write(data)
+
+    def shutdown(self, how):
+        self.writer.transport.abort()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncioEngine:
+    read_size = 65536
+
+    def __init__(self, server):
+        if server.slow_consumer_policy == "block":
+            raise ValueError("The asyncio engine cannot block on slow consumers, use 'drop_oldest' or 'disconnect'")
+        self.server = server
+        self.ssl_context = server.ssl_context  # TLS handshakes run on the loop without blocking it
+        self.loop = None
+        self.listener = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        # Safe to call from any thread
+        self.call_soon(self.shutdown)
+
+    def call_soon(self, callback, *args):
+        # Run callback on the event loop, from any thread
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(callback, *args)
+            except RuntimeError:
+                pass  # The loop has already finished
+
+    def shutdown(self):
+        # Stop accepting, then tell every client the server is going away
+        if self.listener is not None:
+            self.listener.close()
+        for conn in list(self.server.clients):
+            try:
+                self.server.send_frame(conn, 0x8, struct.pack('!H', 1001))
+            except (OSError, SlowConsumerError):
+                pass
+            conn.close()  # Unlike shutdown(), lets the transport write the close frame first
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server.flusher = self
+        self.tick_heartbeats()
+        self.listener = await asyncio.start_server(
+            self.handle_connection, sock=self.server.sock, ssl=self.ssl_context, backlog=1024,
+            ssl_handshake_timeout=self.server.handshake_timeout if self.ssl_context is not None else None
+        )
+        logger.info(f"WebSocket server (asyncio) started on {self.server.host}:{self.server.port}")
+        try:
+            await self.listener.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def handle_connection(self, reader, writer):
+        server = self.server
+        address = writer.get_extra_info('peername')
+        conn = AsyncioConnection(writer, address)
+        logger.info(f"New connection established from {address}")
+        opened = False
+        tracer = server.tracer
+        try:
+            start = tracer.sample() if tracer is not None else 0.0
+            try:
+                # The same deadline the threaded engine sets, so a client that sends nothing
+                # does not hold a connection forever
+                data, leftover = await asyncio.wait_for(self.read_head(reader), server.handshake_timeout)
+                request = server.parse_request(data)
+                response, deflate = server.handshake_response(data, request)
+            except HandshakeError as e:
+                server.metrics.handshake_failures.inc()
+                writer.write(e.response())
+                raise
+            except Exception:
+                server.metrics.handshake_failures.inc()
+                raise
+            finally:
+                if start:
+                    tracer.begin()
+                    tracer.span("handshake", start, address=str(address))
+                    tracer.end()
+            writer.write(response)
+            server.metrics.connections.inc()
+            connection = server.add_client(conn, address, deflate, request)
+            if leftover:
+                # Frames the client sent right behind its request
+                connection.parser.feed(leftover)
+            server.heartbeats.add(conn, server.heartbeat_interval, server.heartbeat_timeout)
+            opened = True
+            server.on_open(conn)
+            while True:
+                message = await self.read_message(reader, conn)
+                if message is None:
+                    break
+                while not server.dispatch(conn, message, wait=False):
+                    # The offload pool is full. Another connection may take the room first, so
+                    # wait on another thread and try again; a blocking submit would stall the loop.
+                    offload = server.offload
+                    if offload is not None:
+                        await self.loop.run_in_executor(None, offload.wait_room)
+                await writer.drain()
+                outbox = connection.outbox
+                if outbox.above_high_water():
+                    # Replies are piling up: stop reading until they drain
+                    server.metrics.paused_reads.inc()
+                    await self.wait_drained(conn, outbox)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            logger.warning(f"Connection reset by {address}")
+        except asyncio.TimeoutError:
+            logger.warning(f"Connection timeout with {address}")
+        except HandshakeError as e:
+            logger.warning(f"Rejected handshake from {address}: {e}")
+        except Exception as e:
+            logger.error(f"Error handling client {address}: {e}", exc_info=True)
+        finally:
+            if opened:
+                server.on_close(conn)
+            server.remove_client(conn)
+            writer.close()
+            logger.info(f"Connection closed for {address}")
+
+    async def read_head(self, reader):
+        # The upgrade request head and any bytes after it, bounded by server.max_handshake_size
+        max_size = self.server.max_handshake_size
+        data = await reader.read(4096)
+        parts = split_head(data, max_size)
+        if parts is not None:
+            return parts
+        head = HeadReader(max_size)
+        while True:
+            if not data:
+                raise ConnectionResetError("Connection closed during the handshake")
+            if head.feed(data):
+                return head.head, head.leftover
+            data = await reader.read(4096)
+
+    def schedule(self, conn, outbox):
+        # Move queued frames into the transport each time it drains below its low-water mark
+        if not conn.draining:
+            conn.draining = True
+            asyncio.ensure_future(self.drain(conn, outbox))
+
+    def discard(self, conn):
+        pass  # Drain tasks stop on their own once the transport is closed
+
+    async def drain(self, conn, outbox):
+        try:
+            while True:
+                await conn.writer.drain()
+                done = outbox.flush(conn)
+                conn.wake()
+                if done:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            conn.draining = False
+            conn.wake()
+
+    async def wait_drained(self, conn, outbox):
+        # Until the outbox is back under its low-water mark or closed. The heartbeat is kept
+        # alive while frames are being written, as pongs are not read meanwhile.
+        while not outbox.closed and outbox.size > outbox.low_water:
+            if conn.writer.transport.is_closing():
+                raise ConnectionResetError("Connection lost with frames still queued")
+            if conn.flushed is None:
+                conn.flushed = self.loop.create_future()
+            flushed = conn.flushed
+            self.schedule(conn, outbox)
+            written = outbox.written
+            await flushed
+            if outbox.written != written:
+                self.server.heartbeats.touch(conn)
+
+    async def read_message(self, reader, conn):
+        server = self.server
+        connection = server.get_state(conn)
+        parser = connection.parser
+        assembler = connection.assembler
+        metrics = server.metrics
+
+        def control(frame):
+            # Control frames are answered inline; a close ends the read
+            server.control_frame(conn, frame)
+
+        while True:
+            result = next_message(parser.next_frame, assembler, control, metrics, server.message_started)
+            if result is CLOSED:
+                return None
+            if result is not None:
+                message, size, mark = result
+                # No await until dispatch, so a trace stays with this message
+                server.message_received(connection, size, mark)
+                return message
+            parser.release()  # An idle connection holds no receive buffer while it waits
+            data = await reader.read(self.read_size)
+            if not data:
+                return None
+            parser.feed(data)
+            # Traffic counts as a sign of life, so busy clients are not pinged
+            server.heartbeats.touch(conn)
+
+    def tick_heartbeats(self):
+        # The shared timer wheel is driven from the loop, so pings are written from the loop thread
+        self.server.heartbeats.advance()
+        self.loop.call_later(self.server.heartbeats.tick, self.tick_heartbeats)
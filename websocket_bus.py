@@ -0,0 +1,251 @@
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+from websocket_workers import RECORD_HEADER, RecordReader, decode_record, encode_record
+
+logger = logging.getLogger(__name__)
+
+# Every message crossing the bus is tagged with the node that published it and a sequence number
+ENVELOPE = struct.Struct('!8sQ')
+
+
+class MessageBus(ABC):
+    # Carries server.publish() (and ChatServer.broadcast) to the other nodes of a cluster.
+    # Subclasses implement publish(), and close() if they hold resources; what arrives from other nodes goes through receive(),
+    # which drops anything already delivered.
+    def __init__(self):
+        self.origin = os.urandom(8)  # Fresh on every start, so a restarted node is not mistaken for a duplicate
+        self.sequence = 0
+        self.deliver = None
+        self.seen = {}  # {origin: highest sequence delivered}
+        self.lock = threading.Lock()
+        # Held from numbering a message until it is queued: receive() only keeps the highest
+        # sequence per origin, so messages must leave in the order they were numbered
+        self.publish_lock = threading.Lock()
+        self.duplicates = 0
+
+    def attach(self, deliver):
+        # deliver(message) is called for every message published by another node
+        self.deliver = deliver
+
+    def next_envelope(self):
+        # Call with publish_lock held
+        self.sequence += 1
+        return self.origin, self.sequence
+
+    def receive(self, origin, sequence, message):
+        with self.lock:
+            if origin == self.origin or sequence <= self.seen.get(origin, 0):
+                self.duplicates += 1
+                return
+            self.seen[origin] = sequence
+        if self.deliver is not None:
+            self.deliver(message)
+
+    @abstractmethod
+    def publish(self, message):
+        # Send message to every other node
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemoryBus(MessageBus):
+    # Nodes in one process that share a group list; publishing delivers to the others right away.
+    # Meant for tests.
+    def __init__(self, group):
+        super().__init__()
+        self.group = group
+        group.append(self)
+
+    def publish(self, message):
+        with self.publish_lock:
+            origin, sequence = self.next_envelope()
+            for node in list(self.group):
+                if node is not self:
+                    node.receive(origin, sequence, message)
+
+    def close(self):
+        if self in self.group:
+            self.group.remove(self)
+
+
+class PeerLink:
+    # Outbound connection to one peer. Messages queue up while a batch is being written, and the
+    # next write takes all of them, so a burst costs one syscall per peer instead of one per message.
+    def __init__(self, address, max_pending=10000, max_batch=256 * 1024, linger=0.001):
+        self.address = address
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.linger = linger  # How long to wait for more messages before writing a batch
+        self.pending = deque()
+        self.ready = threading.Condition()
+        self.sock = None
+        self.closed = False
+        self.dropped = 0
+        self.batches = 0
+        self.messages = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, envelope):
+        with self.ready:
+            if len(self.pending) >= self.max_pending:
+                # The peer is down or slow; keep the newest messages
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(envelope)
+            self.ready.notify()
+
+    def take_batch(self):
+        with self.ready:
+            while not self.pending and not self.closed:
+                self.ready.wait()
+            if self.closed:
+                return None
+        if self.linger:
+            time.sleep(self.linger)
+        with self.ready:
+            parts = []
+            size = 0
+            while self.pending and (not parts or size + len(self.pending[0]) <= self.max_batch):
+                envelope = self.pending.popleft()
+                parts.append(envelope)
+                size += len(envelope)
+        body = b"".join(parts)
+        return RECORD_HEADER.pack(len(body)) + body, len(parts)
+
+    def run(self):
+        delay = 0.1
+        batch = None
+        while not self.closed:
+            if batch is None:
+                batch = self.take_batch()
+                if batch is None:
+                    return
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, timeout=5)
+                    self.sock.settimeout(None)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    logger.info(f"Bus connected to {self.address}")
+                    delay = 0.1
+                self.sock.sendall(batch[0])
+                self.batches += 1
+                self.messages += batch[1]
+                batch = None
+            except OSError as e:
+                # Keep the batch and send it again once reconnected; the peer drops what it already has
+                logger.warning(f"Bus link to {self.address} failed: {e}, retrying in {delay:.1f}s")
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        if self.sock is not None:
+            self.sock.close()
+
+
+class TcpMeshBus(MessageBus):
+    # Every node listens on its own address and keeps a connection to every peer, so a publish goes
+    # straight to each other node without a broker. Each node lists the others as peers.
+    def __init__(self, listen, peers, **link_options):
+        super().__init__()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(listen)
+        self.listener.listen(64)
+        self.address = self.listener.getsockname()
+        self.links = {}  # {peer address: PeerLink}
+        self.inbound = set()
+        self.closed = False
+        for peer in peers:
+            self.add_peer(peer, **link_options)
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+
+    def add_peer(self, address, **link_options):
+        address = tuple(address)
+        if address not in self.links:
+            self.links[address] = PeerLink(address, **link_options)
+
+    def publish(self, message):
+        record = encode_record(message)
+        with self.publish_lock:
+            envelope = ENVELOPE.pack(*self.next_envelope()) + record
+            for link in list(self.links.values()):
+                link.put(envelope)
+
+    def accept_peers(self):
+        while not self.closed:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                return
+            self.inbound.add(sock)
+            threading.Thread(target=self.read_peer, args=(sock, address), daemon=True).start()
+
+    def read_peer(self, sock, address):
+        reader = RecordReader()
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                for batch in reader.feed(data):
+                    self.read_batch(memoryview(batch)[RECORD_HEADER.size:])
+        except OSError as e:
+            logger.warning(f"Bus peer {address} failed: {e}")
+        finally:
+            self.inbound.discard(sock)
+            sock.close()
+
+    def read_batch(self, body):
+        position = 0
+        while position < len(body):
+            origin, sequence = ENVELOPE.unpack_from(body, position)
+            position += ENVELOPE.size
+            size = RECORD_HEADER.unpack_from(body, position)[0]
+            end = position + RECORD_HEADER.size + size
+            try:
+                self.receive(origin, sequence, decode_record(bytes(body[position:end])))
+            except Exception as e:
+                logger.error(f"Error delivering a message from the bus: {e}", exc_info=True)
+            position = end
+
+    def stats(self):
+        return {
+            "published": self.sequence,
+            "duplicates": self.duplicates,
+            "peers": {
+                f"{host}:{port}": {"batches": link.batches, "messages": link.messages, "dropped": link.dropped,
+                                   "pending": len(link.pending), "connected": link.sock is not None}
+                for (host, port), link in self.links.items()
+            },
+        }
+
+    def close(self):
+        self.closed = True
+        try:
+            # Wakes the accept thread; close() alone leaves the socket listening until accept returns
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        for link in self.links.values():
+            link.close()
+        for sock in list(self.inbound):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
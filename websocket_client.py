@@ -3,54 +3,115 @@ import threading
 import random
 import struct
 import base64
-import hashlib
-import ssl
 import logging
 import time
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='websocket_client.log',
-    filemode='a'
-)
+from websocket_frames import (CLOSED, FrameParser, MessageAssembler, apply_mask, build_frame_header, encode_fragments,
+                              next_data_frame, next_message, read_frame, stream_message)
+from websocket_handshake import accept_key, parse_head, read_head
+from websocket_heartbeat import HeartbeatScheduler
+from websocket_logging import configure_logging, frame_log
+from websocket_metrics import ConnectionMetrics
+from websocket_outbox import send_buffers
+from websocket_tls import cached_session, default_client_context, save_session
+
+# Handlers are set up by configure_logging() in __main__, never on import
 logger = logging.getLogger(__name__)
+frame_logger = frame_log(logger)  # Per-frame debug logging, off unless log_frames() is called
+
+def handshake_request(host, port, path="/", compression=None, extra_headers=None):
+    # Build an upgrade request; returns (request bytes, the Sec-WebSocket-Key it carries)
+    key = base64.b64encode(bytes([random.randint(0, 255) for _ in range(16)])).decode('utf-8')
+    extensions = ""
+    if compression is not None:
+        extensions = f"Sec-WebSocket-Extensions: {compression.offer()}\r\n"
+    if extra_headers:
+        extensions += "".join(f"{name}: {value}\r\n" for name, value in extra_headers.items())
+    request = (
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Key: {key}\r\n"
+        "Sec-WebSocket-Version: 13\r\n"
+        f"{extensions}\r\n"
+    )
+    return request.encode('utf-8'), key
+
+
+def check_handshake_response(response, key, compression=None):
+    # Validate the server's answer (the response head, as bytes) to handshake_request; returns
+    # the negotiated PerMessageDeflate, or None without compression
+    status_line, headers = parse_head(response)
+    if status_line.split(' ', 2)[1:2] != ["101"]:
+        raise Exception(f"Handshake failed: {status_line}")
+
+    server_key = headers.get('sec-websocket-accept')
+    accepted_extensions = headers.get('sec-websocket-extensions')
+
+    if not server_key:
+        raise Exception("Server did not send Sec-WebSocket-Accept")
+
+    expected_key = generate_accept_key(key)
+    if server_key != expected_key:
+        raise Exception("Server's Sec-WebSocket-Accept does not match")
+
+    if accepted_extensions:
+        if compression is None:
+            raise Exception("Server accepted an extension that was not offered")
+        return compression.confirm(accepted_extensions)
+    return None
+
+
+def generate_accept_key(key):
+    # Generate the expected Sec-WebSocket-Accept key
+    return accept_key(key).decode('ascii')
 
-# Add console logging
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
 
 class WebSocketClient:
-    def __init__(self, host, port, use_ssl=False):
+    heartbeats = None  # Timer wheel shared by every client in the process
+    metrics = ConnectionMetrics("websocket_client")  # Shared by every client in the process
+    ssl_context = None  # None for the context shared by every client in the process
+
+    def __init__(self, host, port, use_ssl=False, compression=None):
         # Initialize client properties
         self.host = host
         self.port = port
         self.use_ssl = use_ssl
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Wrap socket with SSL if enabled
-        if self.use_ssl:
-            context = ssl.create_default_context()
-            self.sock = context.wrap_socket(self.sock, server_hostname=self.host)
+        self.compression = compression  # DeflateConfig to offer permessage-deflate
+        self.deflate = None
+        self.path = "/"  # Request target of the upgrade, may carry a query string
+        self.extra_headers = {}  # More headers for the upgrade request
+        self.corked = 0
+        self.pending = []  # Frame buffers held back while corked
+        # Every socket write takes this, so a heartbeat ping never lands inside a data frame
+        self.send_lock = threading.RLock()
+        self.sock = self.create_socket()
 
         logger.info(f"WebSocket client initialized for {host}:{port} (SSL: {use_ssl})")
         self.last_pong = time.time()
         self.heartbeat_interval = 30
         self.heartbeat_timeout = 10
+        self.max_message_size = 64 * 1024 * 1024  # Reassembled message limit, None to disable
+        self.parser = FrameParser(max_frame_size=self.max_message_size)
+        self.assembler = MessageAssembler(self.max_message_size)
+
+    def create_socket(self):
+        # A plain socket; open() starts TLS on it once connected
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def start_tls(self):
+        # Resume the last session with this server when there is one, which skips the
+        # certificate exchange; OpenSSL falls back to a full handshake if the server declines
+        context = self.ssl_context or default_client_context()
+        session = cached_session(context, self.host, self.port)
+        self.sock = context.wrap_socket(self.sock, server_hostname=self.host, session=session)
+        logger.debug(f"TLS established with {self.host}:{self.port} (resumed: {self.sock.session_reused})")
 
     def connect(self):
         try:
-            # Connect to the server
-            self.sock.connect((self.host, self.port))
-            logger.debug(f"Socket connected to {self.host}:{self.port}")
-            self.handshake()
-            logger.info("Connected to WebSocket server")
-            # Start heartbeat and message receiving threads
-            threading.Thread(target=self.heartbeat).start()
+            self.open()
+            # Start the message receiving thread
             threading.Thread(target=self.receive_messages).start()
         except ConnectionRefusedError:
             logger.error("Connection refused. Is the server running?")
@@ -59,43 +120,48 @@ class WebSocketClient:
             logger.error(f"Error connecting to server: {e}", exc_info=True)
             raise
 
+    def open(self):
+        # Connect to the server
+        self.sock.connect((self.host, self.port))
+        logger.debug(f"Socket connected to {self.host}:{self.port}")
+        try:
+            if self.use_ssl:
+                self.start_tls()
+            self.handshake()
+        except Exception:
+            self.metrics.handshake_failures.inc()
+            raise
+        if self.use_ssl:
+            # TLS 1.3 tickets arrive after the handshake, so the session is taken once the
+            # server's first response has been read
+            save_session(self.sock, self.host, self.port)
+        self.metrics.connections.inc()
+        # A dead server is noticed by the read timeout even if the heartbeat misses it
+        self.sock.settimeout(self.heartbeat_interval + self.heartbeat_timeout)
+        logger.info("Connected to WebSocket server")
+        self.shared_heartbeats().add(self, self.heartbeat_interval, self.heartbeat_timeout)
+
     def handshake(self):
         # Perform the WebSocket handshake
         logger.debug("Starting handshake process")
-        key = base64.b64encode(bytes([random.randint(0, 255) for _ in range(16)])).decode('utf-8')
-        request = (
-            f"GET / HTTP/1.1\r\n"
-            f"Host: {self.host}:{self.port}\r\n"
-            "Upgrade: websocket\r\n"
-            "Connection: Upgrade\r\n"
-            f"Sec-WebSocket-Key: {key}\r\n"
-            "Sec-WebSocket-Version: 13\r\n\r\n"
-        )
-        self.sock.send(request.encode('utf-8'))
-        response = self.sock.recv(1024).decode('utf-8')
-        
-        if "101 Switching Protocols" not in response:
-            raise Exception("Handshake failed")
-
-        server_key = None
-        for line in response.split('\r\n'):
-            if line.startswith('Sec-WebSocket-Accept:'):
-                server_key = line.split(': ')[1].strip()
-                break
-
-        if not server_key:
-            raise Exception("Server did not send Sec-WebSocket-Accept")
-
-        expected_key = self.generate_accept_key(key)
-        if server_key != expected_key:
-            raise Exception("Server's Sec-WebSocket-Accept does not match")
+        request, key = handshake_request(self.host, self.port, self.path, self.compression, self.extra_headers)
+        self.sock.send(request)
+        response, leftover = read_head(self.sock)
+        self.deflate = check_handshake_response(response, key, self.compression)
+        self.assembler.deflate = self.deflate
+        if leftover:
+            # Frames the server sent right behind its response, e.g. from on_open
+            self.parser.feed(leftover)
         logger.debug("Handshake completed successfully")
 
+    def get_compression_stats(self):
+        # permessage-deflate statistics, None if compression is off
+        if self.deflate is None:
+            return None
+        return self.deflate.stats()
+
     def generate_accept_key(self, key):
-        # Generate the expected Sec-WebSocket-Accept key
-        GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-        sha1 = hashlib.sha1((key + GUID).encode('utf-8')).digest()
-        return base64.b64encode(sha1).decode('utf-8')
+        return generate_accept_key(key)
 
     def receive_messages(self):
         # Continuously receive messages from the server
@@ -103,116 +169,158 @@ class WebSocketClient:
         while True:
             try:
                 message = self.receive_message()
-                if message:
+                if message is not None:
                     logger.info(f"Received: {message}")
                 else:
-                    logger.debug("Received empty message, closing connection")
+                    logger.debug("Connection closed by server")
                     break
             except Exception as e:
                 logger.error(f"Error receiving message: {e}", exc_info=True)
                 break
         logger.debug("Message receiving loop ended")
 
+    def receive_frame(self):
+        # Return the next frame, only reading from the socket when none is buffered
+        heartbeats = WebSocketClient.heartbeats
+        # Traffic counts as a sign of life, so a busy connection is not pinged
+        frame = read_frame(self.parser, self.sock, heartbeats.touch if heartbeats is not None else None, self)
+        if frame is not None:
+            self.metrics.frame_received(frame.opcode, len(frame.payload))
+        return frame
+
+    def receive_data_frame(self):
+        # Return the next data frame, answering control frames on the way
+        return next_data_frame(self.receive_frame, self.send_pong, self.handle_pong)
+
     def receive_message(self):
-        try:
-            self.sock.settimeout(self.heartbeat_interval + self.heartbeat_timeout)
-            header = self.sock.recv(2)
-            if not header:
-                return None
-            
-            # Parse the header
-            opcode = header[0] & 0x0F
-            if opcode == 0x9:  # Ping
-                self.send_pong()
-                return None
-            elif opcode == 0xA:  # Pong
-                self.handle_pong()
-                return None
-            
-            mask = header[1] & 0x80
-            payload_length = header[1] & 0x7F
-
-            # Handle different payload lengths
-            if payload_length == 126:
-                payload_length = struct.unpack('>H', self.sock.recv(2))[0]
-            elif payload_length == 127:
-                payload_length = struct.unpack('>Q', self.sock.recv(8))[0]
-
-            # Handle masked and unmasked messages
-            if mask:
-                masking_key = self.sock.recv(4)
-                masked_data = self.sock.recv(payload_length)
-                data = bytes(b ^ masking_key[i % 4] for i, b in enumerate(masked_data))
+        # Return the next complete message, reassembling fragments
+        result = next_message(self.receive_frame, self.assembler, self.control_frame)
+        if result is None or result is CLOSED:
+            return None
+        message, size, mark = result
+        if frame_logger.enabled:
+            frame_logger("Received message of length %d", size)
+        return message
+
+    def control_frame(self, frame):
+        # Answer a ping or take a pong; a close frame ends the read in next_message()
+        if frame.opcode == 0x9:
+            self.send_pong()
+        elif frame.opcode == 0xA:
+            self.handle_pong()
+
+    def receive_stream(self):
+        # Yield the next message fragment by fragment instead of reassembling it
+        yield from stream_message(self.receive_data_frame, self.deflate, self.max_message_size)
+
+    def send_frame(self, opcode, payload, fin=True, rsv1=False):
+        # Client frames are always masked
+        masking_key = random.getrandbits(32).to_bytes(4, 'big')
+        header = build_frame_header(opcode, len(payload), fin, masking_key, rsv1)
+        masked_payload = apply_mask(payload, masking_key)
+        with self.send_lock:
+            self.metrics.frame_sent(opcode, len(payload))
+            if self.corked:
+                self.pending += (header, masked_payload)
             else:
-                data = self.sock.recv(payload_length)
+                send_buffers(self.sock, (header, masked_payload))
 
-            logger.debug(f"Received message of length {payload_length}")
-            return data.decode('utf-8')
-        except socket.timeout:
-            logger.warning("Connection timed out while receiving message")
-            raise TimeoutError("Connection timed out while receiving message")
-        finally:
-            self.sock.settimeout(None)  # Remove the timeout
+    def cork(self):
+        # Hold back frames until uncork, then write them all with as few sendmsg calls as possible
+        with self.send_lock:
+            self.corked += 1
+
+    def uncork(self):
+        with self.send_lock:
+            self.corked = max(self.corked - 1, 0)
+            if not self.corked and self.pending:
+                pending, self.pending = self.pending, []
+                send_buffers(self.sock, pending)
 
     def send_message(self, message):
         # Send a message to the server
-        logger.debug(f"Sending message: {message}")
         encoded_message = message.encode('utf-8')
-        header = struct.pack('!B', 0x81)  # Text frame
-        length = len(encoded_message)
+        self.send_data(0x1, encoded_message)
+        if frame_logger.enabled:
+            frame_logger("Sent message of length %d", len(encoded_message))
 
-        # Add appropriate length bytes to the header
-        if length <= 125:
-            header += struct.pack('!B', length | 0x80)
-        elif length <= 65535:
-            header += struct.pack('!BH', 126 | 0x80, length)
-        else:
-            header += struct.pack('!BQ', 127 | 0x80, length)
+    def send_binary(self, data):
+        # Send bytes, bytearray or memoryview data as a binary frame, without any encoding
+        if isinstance(data, memoryview):
+            data = data.cast('B')
+        self.send_data(0x2, data)
+        if frame_logger.enabled:
+            frame_logger("Sent binary message of length %d", len(data))
 
-        masking_key = bytes([random.randint(0, 255) for _ in range(4)])
-        header += masking_key
+    def send_data(self, opcode, payload):
+        # Send a whole message, compressing it when permessage-deflate was negotiated
+        if self.deflate is None:
+            self.send_frame(opcode, payload)
+            return
+        # The compression context must see messages in the order they are written
+        with self.send_lock:
+            if self.deflate.should_compress(len(payload)):
+                self.send_frame(opcode, self.deflate.compress(payload), rsv1=True)
+            else:
+                self.send_frame(opcode, payload)
 
-        masked_message = bytes(b ^ masking_key[i % 4] for i, b in enumerate(encoded_message))
-        self.sock.send(header + masked_message)
-        logger.debug(f"Message sent successfully, length: {length}")
+    def send_fragments(self, fragments, opcode=0x1):
+        # Send one message as a series of frames from any iterable of str or bytes chunks
+        for opcode, payload, fin, rsv1 in encode_fragments(fragments, opcode, self.deflate):
+            self.send_frame(opcode, payload, fin, rsv1)
 
     def close(self):
         logger.info("Closing WebSocket connection")
+        if WebSocketClient.heartbeats is not None:
+            WebSocketClient.heartbeats.remove(self)
         self.sock.close()
 
-    def heartbeat(self):
-        while True:
-            time.sleep(self.heartbeat_interval)
-            try:
-                self.send_ping()
-                start_time = time.time()
-                while time.time() - start_time < self.heartbeat_timeout:
-                    if time.time() - self.last_pong < self.heartbeat_timeout:
-                        break
-                    time.sleep(0.5)
-                else:
-                    logger.warning("Heartbeat timeout")
-                    self.close()
-                    break
-            except Exception as e:
-                logger.error(f"Error in heartbeat: {e}")
-                break
+    @staticmethod
+    def shared_heartbeats():
+        # One scheduler thread pings every client, however many connections the process holds
+        if WebSocketClient.heartbeats is None:
+            WebSocketClient.heartbeats = HeartbeatScheduler(
+                lambda client: client.send_ping(),
+                lambda client: client.heartbeat_expired(),
+            )
+            WebSocketClient.heartbeats.start()
+        return WebSocketClient.heartbeats
+
+    def heartbeat_expired(self):
+        logger.warning("Heartbeat timeout")
+        self.metrics.heartbeat_timeouts.inc()
+        # Shut down first so the receiving thread blocked in recv wakes up
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.close()
 
     def send_ping(self):
-        logger.debug("Sending ping")
+        if frame_logger.enabled:
+            frame_logger("Sending ping")
         frame = struct.pack('!BB', 0x89, 0)
-        self.sock.send(frame)
+        with self.send_lock:
+            self.metrics.frame_sent(0x9, 0)
+            self.sock.send(frame)
 
     def handle_pong(self):
         self.last_pong = time.time()
-        logger.debug("Received pong")
+        if WebSocketClient.heartbeats is not None:
+            WebSocketClient.heartbeats.touch(self)
+        if frame_logger.enabled:
+            frame_logger("Received pong")
 
     def send_pong(self):
-        logger.debug("Sending pong")
+        if frame_logger.enabled:
+            frame_logger("Sending pong")
         frame = struct.pack('!BB', 0x8A, 0)
-        self.sock.send(frame)
+        with self.send_lock:
+            self.metrics.frame_sent(0xA, 0)
+            self.sock.send(frame)
 
 if __name__ == "__main__":
+    configure_logging('websocket_client.log')
     logger.info("Starting WebSocket client")
     client = WebSocketClient('localhost', 8765, use_ssl=True)
     client.connect()
@@ -0,0 +1,63 @@
+import itertools
+import threading
+import time
+
+# Per-connection state. Slotted objects hold it in a fixed layout instead of a dict per
+# connection, which matters with tens of thousands of mostly idle clients. Servers that keep
+# their own data about a client subclass Connection with more slots and set connection_class
+# (see ChatServer), or put it in `data`.
+
+
+class Connection:
+    __slots__ = ("id", "sock", "address", "request", "connected_at", "last_pong", "parser", "assembler", "deflate",
+                 "outbox", "send_lock", "messages_received", "messages_sent", "data")
+
+    def __init__(self, sock, address, parser, assembler, outbox, deflate=None, request=None):
+        self.id = None  # Assigned by the registry
+        self.sock = sock
+        self.address = address
+        self.request = request  # (path, headers) of the upgrade request
+        self.connected_at = self.last_pong = time.time()
+        self.parser = parser
+        self.assembler = assembler
+        self.deflate = deflate  # PerMessageDeflate when negotiated
+        self.outbox = outbox
+        # With context takeover each compressed frame depends on the ones before it, so compressing
+        # and queueing a message must not interleave with another sender's
+        self.send_lock = threading.Lock() if deflate is not None else None
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.data = None  # Free for the application
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.id} {self.address}>"
+
+
+class ConnectionRegistry:
+    # Connections by integer id, and by socket for the paths that start from a socket. by_socket
+    # is the server's `clients` dict.
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.by_id = {}
+        self.by_socket = {}
+
+    def add(self, conn):
+        conn.id = next(self.ids)
+        self.by_id[conn.id] = conn
+        self.by_socket[conn.sock] = conn
+        return conn
+
+    def remove(self, sock):
+        conn = self.by_socket.pop(sock, None)
+        if conn is not None:
+            self.by_id.pop(conn.id, None)
+        return conn
+
+    def get(self, conn_id):
+        return self.by_id.get(conn_id)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(list(self.by_id.values()))
@@ -0,0 +1,213 @@
+import time
+import zlib
+
+from websocket_frames import MessageTooBigError
+
+EXTENSION_NAME = "permessage-deflate"
+# Every message compressed with a sync flush ends with these bytes, which RFC 7692 strips
+_TRAILER = b'\x00\x00\xff\xff'
+
+
+class DeflateConfig:
+    # What one endpoint is willing to negotiate for permessage-deflate.
+    # Window bits below 9 are not supported because zlib cannot compress with them.
+    def __init__(self, server_max_window_bits=15, client_max_window_bits=15,
+                 server_no_context_takeover=False, client_no_context_takeover=False,
+                 threshold=128, level=zlib.Z_DEFAULT_COMPRESSION):
+        for bits in (server_max_window_bits, client_max_window_bits):
+            if not 9 <= bits <= 15:
+                raise ValueError(f"Window bits must be between 9 and 15, got {bits}")
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.threshold = threshold  # Messages shorter than this are sent uncompressed
+        self.level = level
+
+    def offer(self):
+        # Sec-WebSocket-Extensions value a client sends
+        params = [EXTENSION_NAME, "client_max_window_bits"]
+        if self.client_max_window_bits < 15:
+            params[-1] += f"={self.client_max_window_bits}"
+        if self.server_max_window_bits < 15:
+            params.append(f"server_max_window_bits={self.server_max_window_bits}")
+        if self.server_no_context_takeover:
+            params.append("server_no_context_takeover")
+        if self.client_no_context_takeover:
+            params.append("client_no_context_takeover")
+        return "; ".join(params)
+
+    def accept(self, header):
+        # Server side: pick the first acceptable offer, returns (response value, PerMessageDeflate) or None
+        for name, params in parse_extensions(header):
+            if name != EXTENSION_NAME:
+                continue
+            try:
+                server_bits = _window_bits(params.get("server_max_window_bits") or "15")
+                client_bits = _window_bits(params.get("client_max_window_bits") or "15")
+            except ValueError:
+                continue
+            if server_bits < 9:
+                continue  # zlib cannot compress with an 8 bit window
+            server_bits = min(server_bits, self.server_max_window_bits)
+            server_nct = self.server_no_context_takeover or "server_no_context_takeover" in params
+            client_nct = self.client_no_context_takeover or "client_no_context_takeover" in params
+
+            response = [EXTENSION_NAME]
+            if server_nct:
+                response.append("server_no_context_takeover")
+            if client_nct:
+                response.append("client_no_context_takeover")
+            if server_bits < 15:
+                response.append(f"server_max_window_bits={server_bits}")
+            if "client_max_window_bits" in params:
+                # The client may only be limited if it said it supports the parameter
+                client_bits = min(client_bits, self.client_max_window_bits)
+                if client_bits < 15:
+                    response.append(f"client_max_window_bits={client_bits}")
+            else:
+                client_bits = 15
+
+            extension = PerMessageDeflate(
+                compress_window_bits=server_bits,
+                decompress_window_bits=client_bits,
+                compress_context_takeover=not server_nct,
+                decompress_context_takeover=not client_nct,
+                threshold=self.threshold,
+                level=self.level,
+            )
+            return "; ".join(response), extension
+        return None
+
+    def confirm(self, header):
+        # Client side: build the extension from the server's response value
+        extensions = parse_extensions(header)
+        if len(extensions) != 1 or extensions[0][0] != EXTENSION_NAME:
+            raise ValueError(f"Server accepted unsupported extensions: {header}")
+        params = extensions[0][1]
+        client_bits = _window_bits(params.get("client_max_window_bits") or "15")
+        server_bits = _window_bits(params.get("server_max_window_bits") or "15")
+        if client_bits < 9:
+            raise ValueError("Server asked for a client window zlib cannot compress with")
+        return PerMessageDeflate(
+            compress_window_bits=min(client_bits, self.client_max_window_bits),
+            decompress_window_bits=server_bits,
+            compress_context_takeover=not (self.client_no_context_takeover or "client_no_context_takeover" in params),
+            decompress_context_takeover="server_no_context_takeover" not in params,
+            threshold=self.threshold,
+            level=self.level,
+        )
+
+
+class PerMessageDeflate:
+    # Compression state for one connection. With context takeover the zlib objects
+    # live across messages, so repeated content compresses against earlier messages.
+    def __init__(self, compress_window_bits=15, decompress_window_bits=15,
+                 compress_context_takeover=True, decompress_context_takeover=True,
+                 threshold=128, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.compress_window_bits = compress_window_bits
+        self.decompress_window_bits = decompress_window_bits
+        self.compress_context_takeover = compress_context_takeover
+        self.decompress_context_takeover = decompress_context_takeover
+        self.threshold = threshold
+        self.level = level
+        self.compressor = self._new_compressor()
+        self.decompressor = zlib.decompressobj(-decompress_window_bits)
+
+        # Statistics
+        self.messages_compressed = 0
+        self.messages_skipped = 0
+        self.bytes_in = 0  # Uncompressed bytes handed to the compressor
+        self.bytes_out = 0  # Compressed bytes put on the wire
+        self.messages_inflated = 0
+        self.inflated_in = 0  # Compressed bytes received
+        self.inflated_out = 0  # Bytes they inflated to
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def _new_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.compress_window_bits)
+
+    def should_compress(self, length):
+        if length < self.threshold:
+            self.messages_skipped += 1
+            return False
+        return True
+
+    def compress(self, data, final=True):
+        # Compress a message, or one fragment of it when final is False
+        start = time.thread_time()
+        compressed = self.compressor.compress(data)
+        if final:
+            compressed += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressed.endswith(_TRAILER):
+                compressed = compressed[:-4]
+            if not compressed:
+                compressed = b'\x00'
+            if not self.compress_context_takeover:
+                self.compressor = self._new_compressor()
+            self.messages_compressed += 1
+        self.compress_time += time.thread_time() - start
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def decompress(self, data, final=True, max_size=None):
+        # Inflate a message, or one fragment of it when final is False
+        start = time.thread_time()
+        if final:
+            data = bytes(data) + _TRAILER
+        limit = 0 if max_size is None else max_size + 1
+        inflated = self.decompressor.decompress(data, limit)
+        if max_size is not None and (len(inflated) > max_size or self.decompressor.unconsumed_tail):
+            raise MessageTooBigError(f"Inflated message exceeds the {max_size} byte limit")
+        if final:
+            if not self.decompress_context_takeover:
+                self.decompressor = zlib.decompressobj(-self.decompress_window_bits)
+            self.messages_inflated += 1
+        self.decompress_time += time.thread_time() - start
+        self.inflated_in += len(data) - (4 if final else 0)
+        self.inflated_out += len(inflated)
+        return inflated
+
+    def stats(self):
+        return {
+            "messages_compressed": self.messages_compressed,
+            "messages_skipped": self.messages_skipped,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "compression_ratio": self.bytes_in / self.bytes_out if self.bytes_out else None,
+            "compress_cpu_seconds": self.compress_time,
+            "messages_inflated": self.messages_inflated,
+            "inflated_in": self.inflated_in,
+            "inflated_out": self.inflated_out,
+            "decompression_ratio": self.inflated_out / self.inflated_in if self.inflated_in else None,
+            "decompress_cpu_seconds": self.decompress_time,
+        }
+
+
+def parse_extensions(header):
+    # "a; x=1, b" -> [("a", {"x": "1"}), ("b", {})]; flag parameters map to None
+    extensions = []
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            if '=' in part:
+                key, value = part.split('=', 1)
+                params[key.strip().lower()] = value.strip().strip('"')
+            else:
+                params[part.lower()] = None
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+
+def _window_bits(value):
+    bits = int(value)
+    if not 8 <= bits <= 15:
+        raise ValueError(f"Invalid window bits {value}")
+    return bits
@@ -0,0 +1,360 @@
+import codecs
+import logging
+import socket
+import struct
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, the pure Python path is used without it
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Below this size the big-integer XOR beats the cost of building NumPy arrays
+NUMPY_MASK_THRESHOLD = 16 * 1024
+
+
+def apply_mask(data, masking_key):
+    # Mask or unmask a payload (XOR is its own inverse) a whole word at a time
+    length = len(data)
+    if not length:
+        return b''
+    if numpy is not None and length >= NUMPY_MASK_THRESHOLD:
+        return _apply_mask_numpy(data, masking_key, length)
+    # Repeat the 4-byte key over the payload and XOR both as one big integer
+    key = (bytes(masking_key) * (length // 4 + 1))[:length]
+    masked = int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')
+    return masked.to_bytes(length, 'big')
+
+
+def build_frame_header(opcode, length, fin=True, masking_key=None, rsv1=False):
+    # Frame header for a payload of the given length; the payload itself is never copied in
+    first = opcode | (0x80 if fin else 0) | (0x40 if rsv1 else 0)
+    mask_bit = 0x80 if masking_key else 0
+    if length <= 125:
+        header = struct.pack('!BB', first, length | mask_bit)
+    elif length <= 65535:
+        header = struct.pack('!BBH', first, 126 | mask_bit, length)
+    else:
+        header = struct.pack('!BBQ', first, 127 | mask_bit, length)
+    if masking_key:
+        header += masking_key
+    return header
+
+
+def _apply_mask_numpy(data, masking_key, length):
+    words = length // 4
+    out = bytearray(data)
+    view = numpy.frombuffer(out, dtype=numpy.uint32, count=words)
+    view ^= numpy.frombuffer(bytes(masking_key), dtype=numpy.uint32)[0]
+    # Leftover tail bytes line up with the start of the key
+    for i in range(words * 4, length):
+        out[i] ^= masking_key[i % 4]
+    return out
+
+
+class MessageTooBigError(ValueError):
+    pass
+
+
+# A parsed frame; payload is a memoryview into the parser's buffer
+Frame = namedtuple('Frame', ['fin', 'rsv1', 'opcode', 'payload'])
+
+
+class FrameParser:
+    # Incremental frame parser that owns a reusable receive buffer.
+    # Payload views stay valid only until the next recv_into() or feed() call.
+    __slots__ = ("buffer_size", "max_frame_size", "buffer", "start", "end", "needed", "reads", "frames")
+
+    def __init__(self, buffer_size=65536, max_frame_size=None):
+        self.buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+        # Allocated on the first read, so a connection that is only open costs no buffer
+        self.buffer = bytearray()
+        self.start = 0  # First byte not yet parsed
+        self.end = 0  # End of the received data
+        self.needed = 2  # Bytes the next frame needs before it can be parsed
+        self.reads = 0
+        self.frames = 0
+
+    def pending(self):
+        return self.end - self.start
+
+    def recv_into(self, sock):
+        # Fill the free tail of the buffer with a single read; returns 0 on EOF
+        if len(self.buffer) < self.buffer_size:
+            self._resize(self.buffer_size)
+        self._make_room(self.needed)
+        count = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.reads += 1
+        self.end += count
+        return count
+
+    def feed(self, data):
+        # Push-style input for engines that hand us bytes instead of a socket. After release() the
+        # buffer is only as large as the data needs.
+        size = len(data)
+        # Room for what is pending plus the new data, so the buffer grows (at most) once
+        self._make_room(max(self.needed, self.end - self.start + size))
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+
+    def release(self):
+        # Let go of the buffer when nothing is left to parse, so an idle connection holds none;
+        # payload views already handed out keep the old one alive
+        if self.start == self.end and self.buffer:
+            self.buffer = bytearray()
+            self.start = self.end = 0
+
+    def _make_room(self, needed):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size and needed <= self.buffer_size:
+                # Drop a buffer grown for one large frame; old views keep it alive if needed
+                self.buffer = bytearray(self.buffer_size)
+        pending = self.end - self.start
+        free = len(self.buffer) - self.end
+        if free >= needed - pending and (self.start == 0 or free >= self.buffer_size // 4):
+            return
+        if needed <= len(self.buffer):
+            # Slide the unparsed bytes to the front; same-size assignment keeps exports valid
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        else:
+            self._resize(max(needed, len(self.buffer) * 2))
+
+    def _resize(self, size):
+        pending = self.end - self.start
+        grown = bytearray(max(size, pending))
+        grown[0:pending] = self.buffer[self.start:self.end]
+        self.buffer = grown
+        self.start = 0
+        self.end = pending
+
+    def next_frame(self):
+        # Return the next complete frame, or None when more data is needed
+        buffer = self.buffer
+        pos = self.start
+        available = self.end - pos
+        if available < 2:
+            self.needed = 2
+            return None
+        first = buffer[pos]
+        second = buffer[pos + 1]
+        payload_length = second & 0x7F
+        header_length = 2
+        if payload_length == 126:
+            header_length = 4
+        elif payload_length == 127:
+            header_length = 10
+        if second & 0x80:
+            header_length += 4
+        if available < header_length:
+            self.needed = header_length
+            return None
+        if payload_length == 126:
+            payload_length = int.from_bytes(buffer[pos + 2:pos + 4], 'big')
+        elif payload_length == 127:
+            payload_length = int.from_bytes(buffer[pos + 2:pos + 10], 'big')
+        if self.max_frame_size is not None and payload_length > self.max_frame_size:
+            raise MessageTooBigError(f"Frame of {payload_length} bytes exceeds the {self.max_frame_size} byte limit")
+
+        total = header_length + payload_length
+        if available < total:
+            self.needed = total
+            return None
+
+        payload = memoryview(buffer)[pos + header_length:pos + total]
+        if second & 0x80:
+            masking_key = bytes(buffer[pos + header_length - 4:pos + header_length])
+            payload[:] = apply_mask(payload, masking_key)
+        self.start = pos + total
+        self.needed = 2
+        self.frames += 1
+        return Frame(bool(first & 0x80), bool(first & 0x40), first & 0x0F, payload)
+
+
+class MessageAssembler:
+    # Reassembles fragmented messages from data frames (opcodes 0x0, 0x1 and 0x2).
+    # When permessage-deflate was negotiated, deflate inflates messages flagged with RSV1.
+    __slots__ = ("max_message_size", "deflate", "opcode", "compressed", "buffer", "mark")
+
+    def __init__(self, max_message_size=None, deflate=None):
+        self.max_message_size = max_message_size
+        self.deflate = deflate
+        self.opcode = None
+        self.compressed = False
+        self.buffer = None
+        self.mark = None  # What next_message()'s started() returned for the message being assembled
+
+    def add(self, frame):
+        # Returns (opcode, payload) once the message is complete, otherwise None
+        if frame.opcode == 0x0:
+            if self.opcode is None:
+                raise ValueError("Continuation frame without a message to continue")
+        else:
+            if self.opcode is not None:
+                raise ValueError("New message started before the previous one was finished")
+            if frame.rsv1 and self.deflate is None:
+                raise ValueError("RSV1 set without a negotiated extension")
+            if frame.fin:
+                if frame.rsv1:
+                    return frame.opcode, self.deflate.decompress(frame.payload, max_size=self.max_message_size)
+                # Unfragmented messages are passed through without a copy
+                return frame.opcode, frame.payload
+            self.opcode = frame.opcode
+            self.compressed = frame.rsv1
+            self.buffer = bytearray()
+
+        size = len(self.buffer) + len(frame.payload)
+        if self.max_message_size is not None and size > self.max_message_size:
+            self.opcode = self.buffer = None
+            raise MessageTooBigError(f"Message exceeds the {self.max_message_size} byte limit")
+        self.buffer += frame.payload
+        if not frame.fin:
+            return None
+        opcode, data = self.opcode, self.buffer
+        self.opcode = self.buffer = None
+        if self.compressed:
+            data = self.deflate.decompress(data, max_size=self.max_message_size)
+        return opcode, data
+
+
+def read_frame(parser, sock, touch=None, key=None):
+    # The next frame, only reading from sock when none is buffered; None on EOF.
+    # touch(key) is called after each read, as traffic counts as a sign of life.
+    try:
+        frame = parser.next_frame()
+        while frame is None:
+            if not parser.recv_into(sock):
+                return None
+            if touch is not None:
+                touch(key)
+            frame = parser.next_frame()
+        return frame
+    except socket.timeout:
+        logger.warning("Connection timed out while receiving message")
+        raise TimeoutError("Connection timed out while receiving message")
+
+
+def next_data_frame(receive_frame, send_pong, handle_pong, *args):
+    # The next data frame from receive_frame(*args), answering control frames on the way;
+    # None once the connection is closed
+    while True:
+        frame = receive_frame(*args)
+        if frame is None:
+            return None
+        opcode = frame.opcode
+        if opcode == 0x9:  # Ping
+            send_pong(*args)
+        elif opcode == 0xA:  # Pong
+            handle_pong(*args)
+        elif opcode == 0x8:  # Close
+            return None
+        else:
+            return frame
+
+
+CLOSED = object()  # next_message() result for a close frame
+
+
+def next_message(next_frame, assembler, control, metrics=None, started=None):
+    # The next complete message from the frames next_frame() returns, as (message, size, mark):
+    # str for text, bytes for binary. None once next_frame() returns None, which is EOF for a
+    # blocking reader; a reader that fills its parser itself then reads more and calls again.
+    # Pings, pongs and close frames go to control(frame), and a close frame returns CLOSED.
+    # metrics.frame_received() counts every frame. started() is called at the first frame of a
+    # message and what it returns comes back as mark, kept on the assembler in between.
+    while True:
+        frame = next_frame()
+        if frame is None:
+            return None
+        opcode = frame.opcode
+        if metrics is not None:
+            metrics.frame_received(opcode, len(frame.payload))
+        if opcode & 0x8:
+            control(frame)
+            if opcode == 0x8:
+                return CLOSED
+            continue
+        if started is not None and assembler.opcode is None:
+            assembler.mark = started()
+        message = assembler.add(frame)
+        if message is not None:
+            opcode, data = message
+            if opcode == 0x2:
+                # Binary messages are handed over as bytes, without a decode
+                return bytes(data), len(data), assembler.mark
+            return str(data, 'utf-8'), len(data), assembler.mark
+
+
+def stream_message(receive_data_frame, deflate=None, max_message_size=None, *args):
+    # Yield the next message fragment by fragment instead of reassembling it: str chunks for
+    # text, bytes for binary, with data frames from receive_data_frame(*args)
+    decoder = None
+    compressed = False
+    started = False
+    size = 0
+    while True:
+        frame = receive_data_frame(*args)
+        if frame is None:
+            if started:
+                raise ConnectionError("Connection closed in the middle of a message")
+            return
+        if not started:
+            if frame.opcode == 0x0:
+                raise ValueError("Continuation frame without a message to continue")
+            if frame.rsv1 and deflate is None:
+                raise ValueError("RSV1 set without a negotiated extension")
+            if frame.opcode == 0x1:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            compressed = frame.rsv1
+            started = True
+        elif frame.opcode != 0x0:
+            raise ValueError("New message started before the previous one was finished")
+
+        payload = frame.payload
+        if compressed:
+            payload = deflate.decompress(payload, final=frame.fin)
+        size += len(payload)
+        if max_message_size is not None and size > max_message_size:
+            raise MessageTooBigError(f"Message exceeds the {max_message_size} byte limit")
+        if decoder is not None:
+            yield decoder.decode(payload, final=frame.fin)
+        else:
+            yield bytes(payload)
+        if frame.fin:
+            return
+
+
+def encode_fragments(fragments, opcode=0x1, deflate=None):
+    # Yield (opcode, payload, fin, rsv1) for each frame of one message sent from an iterable of
+    # str or bytes chunks, compressed when deflate is given
+    rsv1 = deflate is not None  # Only the first frame carries the compression flag
+    for payload, fin in iter_fragments(fragments):
+        if deflate is not None:
+            payload = deflate.compress(payload, final=fin)
+        yield opcode, payload, fin, rsv1
+        opcode = 0x0  # Every frame after the first is a continuation
+        rsv1 = False
+
+
+_END = object()
+
+
+def iter_fragments(fragments):
+    # Yield (payload, fin) pairs, looking one fragment ahead to know which one is last
+    iterator = iter(fragments)
+    current = next(iterator, _END)
+    if current is _END:
+        yield b'', True
+        return
+    while current is not _END:
+        following = next(iterator, _END)
+        if isinstance(current, str):
+            current = current.encode('utf-8')
+        yield current, following is _END
+        current = following
+
@@ -0,0 +1,152 @@
+import base64
+import hashlib
+
+# The opening handshake (RFC 6455 section 4), shared by the server engines and the clients
+
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+MAX_HEAD_SIZE = 8192  # Largest request or response head accepted, terminator included
+
+REASONS = {400: "Bad Request", 426: "Upgrade Required", 431: "Request Header Fields Too Large"}
+
+# The 101 response is the same for every client apart from the accept key, so only the key is
+# spliced in: RESPONSE_HEAD + key + a tail ending the headers, one tail per extension answer
+RESPONSE_HEAD = b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: "
+response_tails = {None: b"\r\n\r\n"}
+MAX_TAILS = 256  # Extension answers come from a few configurations; cap the cache all the same
+
+
+class HandshakeError(ValueError):
+    # A request the server refuses; response() is the HTTP error to answer it with
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+    def response(self):
+        extra = "Sec-WebSocket-Version: 13\r\n" if self.status == 426 else ""
+        return (f"HTTP/1.1 {self.status} {REASONS.get(self.status, 'Bad Request')}\r\n"
+                f"{extra}Connection: close\r\nContent-Length: 0\r\n\r\n").encode('ascii')
+
+
+class HeadReader:
+    # Collects an HTTP head from chunks as they arrive. feed() returns True once the blank line
+    # was seen; `head` then holds the head and `leftover` whatever followed it (frames the peer
+    # sent without waiting for the handshake to finish).
+    def __init__(self, max_size=MAX_HEAD_SIZE):
+        self.max_size = max_size
+        self.buffer = b""
+        self.head = None
+        self.leftover = b""
+
+    def feed(self, data):
+        # Only the new bytes and the three before them can complete the terminator
+        start = max(len(self.buffer) - 3, 0)
+        buffer = self.buffer + data if self.buffer else data
+        end = buffer.find(b"\r\n\r\n", start)
+        if end < 0 or end + 4 > self.max_size:
+            if len(buffer) >= self.max_size:
+                raise HandshakeError(f"Handshake head is larger than {self.max_size} bytes", 431)
+            self.buffer = bytes(buffer)
+            return False
+        self.head = bytes(buffer[:end + 4])
+        self.leftover = bytes(buffer[end + 4:])
+        self.buffer = b""
+        return True
+
+
+def split_head(data, max_size=MAX_HEAD_SIZE):
+    # (head, leftover) when the first read holds a whole head, as it nearly always does; None
+    # sends the caller to a HeadReader
+    end = data.find(b"\r\n\r\n")
+    if 0 <= end and end + 4 <= max_size:
+        return data[:end + 4], data[end + 4:]
+    return None
+
+
+def read_head(sock, max_size=MAX_HEAD_SIZE, read_size=4096):
+    # Read from a blocking socket up to the end of an HTTP head; returns (head, leftover bytes)
+    data = sock.recv(read_size)
+    parts = split_head(data, max_size)
+    if parts is not None:
+        return parts
+    reader = HeadReader(max_size)
+    while True:
+        if not data:
+            raise ConnectionError("Connection closed during the handshake")
+        if reader.feed(data):
+            return reader.head, reader.leftover
+        data = sock.recv(read_size)
+
+
+def parse_head(data):
+    # Split an HTTP head into (start line, {lower-cased name: value}); matching names in any
+    # case is then a lookup of the lower-cased name. Repeated headers are joined with commas.
+    try:
+        lines = data.decode('utf-8').split('\r\n')
+    except UnicodeDecodeError:
+        raise HandshakeError("Handshake head is not valid UTF-8")
+    fields = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise HandshakeError(f"Malformed header line {line[:64]!r}")
+        # No space is allowed between a field name and its colon, so only the value is stripped
+        name = name.lower()
+        value = value.strip()
+        if name in fields:
+            value = fields[name] + ", " + value
+        fields[name] = value
+    return lines[0], fields
+
+
+def has_token(value, token):
+    # Whether a comma separated header value lists `token` (lower case), in any case
+    if value is None:
+        return False
+    value = value.lower()
+    return value == token or token in [part.strip() for part in value.split(',')]
+
+
+def parse_upgrade_request(data):
+    # Parse and validate a client's upgrade request; returns (path, headers)
+    start_line, headers = parse_head(data)
+    get = headers.get
+    parts = start_line.split(' ')
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HandshakeError(f"Malformed request line {start_line[:64]!r}")
+    method, path, version = parts
+    if method != "GET" or version != "HTTP/1.1":
+        raise HandshakeError(f"An upgrade needs GET over HTTP/1.1, got {method} {version}")
+    # Try the spelling every client uses before splitting token lists
+    upgrade = get("upgrade")
+    if upgrade != "websocket" and not has_token(upgrade, "websocket"):
+        raise HandshakeError("Upgrade: websocket header missing", 426)
+    connection = get("connection")
+    if connection != "Upgrade" and not has_token(connection, "upgrade"):
+        raise HandshakeError("Connection: Upgrade header missing")
+    version = get("sec-websocket-version")
+    if version != "13":
+        raise HandshakeError(f"Unsupported Sec-WebSocket-Version {version}", 426)
+    key = get("sec-websocket-key")
+    if key is None:
+        raise HandshakeError("Sec-WebSocket-Key not found in headers")
+    if len(key) != 24:  # A base64 encoded 16 byte nonce
+        raise HandshakeError("Malformed Sec-WebSocket-Key")
+    return path, headers
+
+
+def accept_key(key):
+    # Sec-WebSocket-Accept for a Sec-WebSocket-Key, as bytes
+    return base64.b64encode(hashlib.sha1(key.encode('utf-8') + GUID).digest())
+
+
+def upgrade_response(key, extensions=None):
+    # The 101 response for a Sec-WebSocket-Key, with an optional Sec-WebSocket-Extensions answer
+    tail = response_tails.get(extensions)
+    if tail is None:
+        tail = f"\r\nSec-WebSocket-Extensions: {extensions}\r\n\r\n".encode('utf-8')
+        if len(response_tails) < MAX_TAILS:
+            response_tails[extensions] = tail
+    return RESPONSE_HEAD + accept_key(key) + tail
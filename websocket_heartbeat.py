@@ -0,0 +1,111 @@
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatScheduler:
+    # Hashed timer wheel shared by every connection. Each tick only visits the slot
+    # that is due, so the cost per tick does not grow with the number of idle
+    # connections. Connections with recent traffic are not pinged at all.
+    def __init__(self, ping, expire, interval=30, timeout=10, tick=0.5, clock=time.monotonic):
+        self.ping = ping  # Called with a key when it needs a ping
+        self.expire = expire  # Called with a key that did not answer its ping in time
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.clock = clock
+        self.slots = [{} for _ in range(int(math.ceil(max(interval, timeout) / tick)) + 1)]
+        self.entries = {}  # {key: [due tick, ping sent at or None, interval, timeout]}
+        self.activity = {}  # {key: time of the last traffic}
+        self.current = int(self.clock() / tick)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        # Tick on a background thread; event loop engines call advance() themselves instead
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+    def add(self, key, interval=None, timeout=None):
+        now = self.clock()
+        entry = [0, None, interval or self.interval, timeout or self.timeout]
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.activity[key] = now
+            self._schedule(key, entry, now + entry[2])
+
+    def touch(self, key):
+        # Record traffic on a connection; a pong counts as traffic too
+        if key in self.entries:
+            self.activity[key] = self.clock()
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        self.activity.pop(key, None)
+        if entry is not None:
+            self.slots[entry[0] % len(self.slots)].pop(key, None)
+
+    def _schedule(self, key, entry, when):
+        due = max(int(math.ceil(when / self.tick)), self.current + 1)
+        entry[0] = due
+        self.slots[due % len(self.slots)][key] = entry
+
+    def advance(self, now=None):
+        # Process every tick up to now; callbacks run after the lock is released
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        pings = []
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                # Entries more than one revolution away share the slot but are not due yet
+                due = [(key, entry) for key, entry in slot.items() if entry[0] <= self.current]
+                for key, entry in due:
+                    del slot[key]
+                    last = self.activity.get(key, 0)
+                    ping_sent, interval, timeout = entry[1], entry[2], entry[3]
+                    if ping_sent is None:
+                        if now - last < interval:
+                            self._schedule(key, entry, last + interval)
+                        else:
+                            entry[1] = now
+                            pings.append(key)
+                            self._schedule(key, entry, now + timeout)
+                    elif last >= ping_sent:
+                        entry[1] = None
+                        self._schedule(key, entry, last + interval)
+                    else:
+                        del self.entries[key]
+                        self.activity.pop(key, None)
+                        expired.append(key)
+
+        for key in pings:
+            try:
+                self.ping(key)
+            except Exception as e:
+                logger.error(f"Error sending heartbeat ping: {e}")
+        for key in expired:
+            try:
+                self.expire(key)
+            except Exception as e:
+                logger.error(f"Error expiring connection: {e}")
@@ -0,0 +1,89 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class FrameLog:
+    # Debug logging for per-frame and per-message events. Call sites check `enabled` first, so
+    # while it is off (the default) a frame costs one attribute lookup and nothing is formatted:
+    #
+    #     if frame_log.enabled:
+    #         frame_log("Received message of length %d", len(data))
+    #
+    # Arguments are only formatted by the handlers that keep the record, and with every=N only
+    # one call in N is logged.
+    def __init__(self, logger):
+        self.logger = logger
+        self.enabled = False
+        self.every = 1
+        self.calls = 0  # Racy between threads, which only shifts the sample
+
+    def __call__(self, message, *args):
+        self.calls += 1
+        if self.calls % self.every == 0:
+            self.logger.debug(message, *args)
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the whole record in the logging thread. Only the message
+    # is merged here, since its arguments may change once the call returns; timestamps and
+    # tracebacks are formatted by the listener's thread.
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    def stop(self):
+        # May be called again at exit
+        if self._thread is not None:
+            super().stop()
+
+
+frame_logs = []
+
+
+def frame_log(logger):
+    # The FrameLog for a module's logger, switched on and off by log_frames()
+    log = FrameLog(logger)
+    frame_logs.append(log)
+    return log
+
+
+def log_frames(enabled=True, every=1):
+    # Turn per-frame debug logging on or off everywhere, logging one frame in `every`; the
+    # records still need the loggers to be at DEBUG to be written
+    for log in frame_logs:
+        log.enabled = enabled
+        log.every = every
+
+
+def configure_logging(filename=None, level=logging.DEBUG, console_level=logging.INFO, frames=False, every=1):
+    # Log to the console and optionally to a file. File writes go through a queue, so the thread
+    # that logs only enqueues the record and a background QueueListener formats and writes it.
+    # Returns the listener (stopped, and the queue flushed, at exit), or None without a file.
+    formatter = logging.Formatter(FORMAT)
+    root = logging.getLogger()
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(formatter)
+    root.addHandler(console)
+    listener = None
+    if filename is not None:
+        file_handler = logging.FileHandler(filename, mode='a')
+        file_handler.setLevel(level)
+        file_handler.setFormatter(formatter)
+        records = queue.SimpleQueue()
+        background = BackgroundHandler(records)
+        background.setLevel(level)
+        root.addHandler(background)
+        listener = BackgroundListener(records, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    root.setLevel(min(level, console_level) if filename is not None else console_level)
+    log_frames(frames, every)
+    return listener
@@ -0,0 +1,281 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Each metric keeps one cell per recording thread. A thread only ever adds to its own cell, so
+# recording needs no lock and loses no updates; reads add the cells up. Thread identifiers are
+# reused by the OS, so the number of cells follows the number of live threads, not of past ones.
+get_ident = threading.get_ident
+
+OPCODES = {0x0: "continuation", 0x1: "text", 0x2: "binary", 0x8: "close", 0x9: "ping", 0xA: "pong"}
+
+# Seconds; suits both socket writes and handler calls
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.cells = {}  # {thread id: [value]}
+
+    def inc(self, amount=1):
+        try:
+            self.cells[get_ident()][0] += amount
+        except KeyError:
+            self.cells.setdefault(get_ident(), [0])[0] += amount
+
+    def value(self):
+        return sum(cell[0] for cell in list(self.cells.values()))
+
+
+class CellCounter:
+    # A counter kept in slot `index` of cells shared with other counters, so that one lookup
+    # records several of them at once (see ConnectionMetrics)
+    kind = "counter"
+
+    def __init__(self, cells, index):
+        self.cells = cells
+        self.index = index
+
+    def value(self):
+        return sum(cell[self.index] for cell in list(self.cells.values()))
+
+
+class Gauge:
+    # Set directly, or computed by `function` when read so the hot path pays nothing
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception as e:
+                logger.debug(f"Gauge function failed: {e}")
+                return 0
+        return self.current
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.cells = {}  # {thread id: [count per bucket..., count above the last, sum]}
+
+    def observe(self, value):
+        try:
+            cell = self.cells[get_ident()]
+        except KeyError:
+            cell = self.cells.setdefault(get_ident(), [0] * (len(self.buckets) + 1) + [0.0])
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for cell in list(self.cells.values()):
+            for i in range(len(counts)):
+                counts[i] += cell[i]
+            total += cell[-1]
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative[bound] = running
+        return {"count": running + counts[-1], "sum": total, "buckets": cumulative}
+
+
+class Family:
+    # A metric with labels; labels(...) returns the child for one combination of values.
+    # Hot paths look children up once and keep them.
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind.kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}  # {label values: metric}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self.children.setdefault(values, self.factory())
+        return child
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.families = {}  # {name: Family}
+
+    def add(self, name, help, kind, labelnames=(), factory=None):
+        if name in self.families:
+            raise ValueError(f"Metric {name} already registered")
+        family = Family(name, help, kind, labelnames, factory or kind)
+        self.families[name] = family
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(name, help, Counter, labelnames)
+
+    def gauge(self, name, help, function=None):
+        return self.add(name, help, Gauge, factory=lambda: Gauge(function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        return self.add(name, help, Histogram, labelnames, lambda: Histogram(buckets))
+
+    def snapshot(self):
+        # {name: value} for plain metrics, {name: {"label=value,...": value}} for labelled ones
+        result = {}
+        for name, family in list(self.families.items()):
+            if not family.labelnames:
+                result[name] = family.labels().value()
+                continue
+            result[name] = {
+                ",".join(f"{label}={value}" for label, value in zip(family.labelnames, values)): child.value()
+                for values, child in list(family.children.items())
+            }
+        return result
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for name, family in list(self.families.items()):
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for values, child in list(family.children.items()):
+                labels = [f'{label}="{value}"' for label, value in zip(family.labelnames, values)]
+                value = child.value()
+                if family.kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                for bound, count in list(value["buckets"].items()) + [("+Inf", value["count"])]:
+                    bucket = format_labels(labels + ['le="%s"' % bound])
+                    lines.append(f"{name}_bucket{bucket} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class ConnectionMetrics:
+    # The standard set of metrics for one side of the protocol, named "<prefix>_..."
+    def __init__(self, prefix, registry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        add = self.registry
+        self.connections = add.counter(f"{prefix}_connections_total", "Connections opened")
+        self.handshake_failures = add.counter(f"{prefix}_handshake_failures_total", "Handshakes that failed")
+        # Frames and payload bytes per opcode and direction share one cell per thread:
+        # [frames received by opcode, bytes received, frames sent, bytes sent], 16 slots each
+        self.frame_cells = {}
+        for offset, name, help in ((0, "frames_received_total", "Frames received"),
+                                   (16, "payload_bytes_received_total", "Payload bytes received"),
+                                   (32, "frames_sent_total", "Frames sent"),
+                                   (48, "payload_bytes_sent_total", "Payload bytes sent")):
+            family = add.add(f"{prefix}_{name}", help, CellCounter, ["opcode"], lambda: None)
+            for opcode, label in OPCODES.items():
+                family.children[(label,)] = CellCounter(self.frame_cells, offset + opcode)
+        self.heartbeat_timeouts = add.counter(f"{prefix}_heartbeat_timeouts_total", "Peers that missed a pong")
+
+    def frame_received(self, opcode, size):
+        try:
+            cell = self.frame_cells[get_ident()]
+        except KeyError:
+            cell = self.frame_cells.setdefault(get_ident(), [0] * 64)
+        cell[opcode] += 1
+        cell[16 + opcode] += size
+
+    def frame_sent(self, opcode, size, count=1):
+        try:
+            cell = self.frame_cells[get_ident()]
+        except KeyError:
+            cell = self.frame_cells.setdefault(get_ident(), [0] * 64)
+        cell[32 + opcode] += count
+        cell[48 + opcode] += size * count
+
+    def snapshot(self):
+        return self.registry.snapshot()
+
+    def render(self):
+        return self.registry.render()
+
+
+class ServerMetrics(ConnectionMetrics):
+    def __init__(self, server, registry=None):
+        super().__init__("websocket_server", registry)
+        add = self.registry
+        add.gauge("websocket_server_connections", "Open connections", lambda: len(server.clients))
+        add.gauge("websocket_server_outbox_frames", "Frames queued in outboxes",
+                  lambda: sum(len(conn.outbox) for conn in server.connections))
+        add.gauge("websocket_server_outbox_frames_max", "Frames queued in the fullest outbox",
+                  lambda: max((len(conn.outbox) for conn in server.connections), default=0))
+        add.gauge("websocket_server_outbox_bytes", "Bytes queued in outboxes", lambda: server.outbox_memory.used)
+        self.slow_consumers = add.counter("websocket_server_slow_consumers_total", "Clients dropped for not reading")
+        self.paused_reads = add.counter("websocket_server_paused_reads_total",
+                                        "Times a client was not read from until its outbox drained")
+        # Reading the clock twice costs more than counting, so only one message (and one socket
+        # write) in sample_every is timed. The counters below only need to be roughly right,
+        # so they are plain attributes, shared by every thread.
+        self.sample_every = 8
+        self.messages = 0
+        self.receives = 0
+        self.flushes = 0
+        self.receive_seconds = add.histogram("websocket_server_receive_seconds",
+                                             "Time from a message's first frame to the decoded message (sampled)")
+        self.send_seconds = add.histogram("websocket_server_send_seconds",
+                                          "Time writing queued frames to a socket (sampled)")
+        self.handler_seconds = add.histogram("websocket_server_handler_seconds",
+                                             "Time in on_message per message (sampled)")
+
+    def start_receive(self):
+        # At the first frame of a message: the time to pass to end_receive(), 0.0 if this one is
+        # not timed
+        self.receives += 1
+        return 0.0 if self.receives % self.sample_every else time.perf_counter()
+
+    def end_receive(self, start):
+        if start:
+            self.receive_seconds.observe(time.perf_counter() - start)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+def start_metrics_server(registry, port, host="127.0.0.1"):
+    # Serve GET /metrics over plain HTTP from a daemon thread; returns the HTTP server
+    # (its server_address has the port, and shutdown() stops it)
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logger.info(f"Metrics served on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
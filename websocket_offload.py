@@ -0,0 +1,94 @@
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Runs message handlers on a pool instead of the connection's I/O thread (or the event loop).
+# The handler is a plain function of the message, handler(message) -> reply or None. With
+# processes it runs outside the GIL, so it must be picklable (defined at module level), and so
+# must the messages and replies.
+#
+# Messages of one connection may be handled at the same time on different workers, but their
+# replies are delivered in the order the messages arrived.
+
+
+class Offload:
+    POOLS = ("thread", "process")
+
+    def __init__(self, handler, pool="thread", workers=None, max_pending=1024, executor=None):
+        if pool not in self.POOLS:
+            raise ValueError(f"Unknown pool {pool!r}, expected one of {self.POOLS}")
+        self.handler = handler
+        self.pool = pool
+        if executor is None:
+            if pool == "thread":
+                executor = ThreadPoolExecutor(workers, "offload")
+            else:
+                # Forking a process that runs I/O threads copies their locks mid-use; spawned
+                # workers start clean and import the handler by name
+                executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self.executor = executor
+        self.max_pending = max_pending  # Messages submitted and not delivered yet, for all connections
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.queues = {}  # {client: deque of futures, in the order their messages arrived}
+        self.delivering = set()  # Clients whose results are being delivered by some thread
+        self.deliver = None  # deliver(client, future), set by the server
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def wait_room(self):
+        # Block until a message can be submitted without waiting
+        with self.lock:
+            self.room.wait_for(lambda: self.pending < self.max_pending)
+
+    def submit(self, client, message, wait=True):
+        # Hand a message to the pool, blocking while max_pending messages are already queued so
+        # the reader stops reading instead of the queue growing. With wait=False a full pool
+        # returns False instead, for the event loop, which must never block.
+        with self.lock:
+            if not wait and self.pending >= self.max_pending:
+                return False
+            self.room.wait_for(lambda: self.pending < self.max_pending)
+            future = self.executor.submit(self.handler, message)
+            self.pending += 1
+            queue = self.queues.get(client)
+            if queue is None:
+                queue = self.queues[client] = deque()
+            queue.append(future)
+        future.add_done_callback(lambda future: self.completed(client))
+        return True
+
+    def completed(self, client):
+        # Deliver every finished result at the head of the client's queue. One thread delivers
+        # for a client at a time, so replies cannot overtake each other.
+        with self.lock:
+            if client in self.delivering:
+                return  # That thread picks this result up too
+            self.delivering.add(client)
+        while True:
+            with self.lock:
+                queue = self.queues.get(client)
+                ready = []
+                while queue and queue[0].done():
+                    ready.append(queue.popleft())
+                if not ready:
+                    self.delivering.discard(client)
+                    if queue is not None and not queue:
+                        del self.queues[client]
+                    return
+                self.pending -= len(ready)
+                self.room.notify(len(ready))
+            for future in ready:
+                if not future.cancelled():
+                    self.deliver(client, future)
+
+    def shutdown(self):
+        # Drop queued messages; the ones running finish, but are not delivered any more
+        self.deliver = lambda client, future: None
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,332 @@
+import logging
+import selectors
+import socket
+import ssl
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Lets a send return early instead of waiting for room in the socket buffer
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Most buffers handed to one sendmsg call (IOV_MAX on Linux)
+MAX_BUFFERS = 1024
+
+# Below this size the buffers of a frame are joined when the socket cannot gather them
+COALESCE_LIMIT = 65536
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+# What a non-blocking socket raises when a write has to wait; an SSL socket may also need to read
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError)
+
+
+def send_flags(sock):
+    # SSL sockets refuse send flags; the server makes them non-blocking instead
+    if isinstance(sock, ssl.SSLSocket):
+        return 0
+    return MSG_DONTWAIT
+
+
+def vectored(sock):
+    # Whether sock can write several buffers with one sendmsg call. SSL sockets
+    # define sendmsg but refuse it.
+    return hasattr(type(sock), "sendmsg") and not isinstance(sock, ssl.SSLSocket)
+
+
+def send_buffers(sock, buffers):
+    # Blocking write of consecutive buffers in as few syscalls as the socket allows
+    if not vectored(sock):
+        if sum(len(buffer) for buffer in buffers) <= COALESCE_LIMIT:
+            sock.sendall(b"".join(buffers))
+        else:
+            for buffer in buffers:
+                sock.sendall(buffer)
+        return
+    buffers = list(buffers)
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + MAX_BUFFERS])
+        # Skip what was written; a partly written buffer is resumed from a view
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        if sent:
+            buffers[index] = memoryview(buffers[index])[sent:]
+
+
+class MemoryBudget:
+    # Bytes queued in every outbox of a server, held against one cap (None for no cap)
+    __slots__ = ("limit", "used", "lock")
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.used += size
+
+    def exceeded(self):
+        return self.limit is not None and self.used > self.limit
+
+
+class Outbox:
+    # Bounded queue of encoded frames waiting to be written to one connection.
+    # Each frame is a tuple of buffers written back to back, so a shared frame
+    # (or a large payload) is never copied behind its header.
+    POLICIES = ("drop_oldest", "disconnect", "block")
+    __slots__ = ("max_frames", "policy", "block_timeout", "high_water", "low_water", "budget", "frames", "part",
+                 "offset", "retry", "size", "written", "lock", "not_full", "drained", "dropped", "corked", "closed")
+
+    def __init__(self, max_frames=1024, policy="drop_oldest", block_timeout=None, high_water=None, low_water=None,
+                 budget=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy!r}, expected one of {self.POLICIES}")
+        self.max_frames = max_frames
+        self.policy = policy
+        self.block_timeout = block_timeout
+        # Queued bytes above which the connection stops being read, and below which it resumes
+        self.high_water = high_water
+        if low_water is None:
+            low_water = high_water // 4 if high_water is not None else 0
+        self.low_water = low_water
+        self.budget = budget  # Shared by the outboxes of a server
+        self.frames = deque()
+        self.part = 0  # Index of the buffer being written in frames[0]
+        self.offset = 0  # Bytes of that buffer already written
+        # An SSL write of frames[0] could not finish and must be retried with the same bytes
+        self.retry = False
+        self.size = 0  # Bytes queued and not written yet
+        self.written = 0  # Bytes written since the start, to tell a slow reader from a stopped one
+        self.lock = threading.Lock()
+        # Conditions on the lock, made by the first thread that waits: most outboxes never need them
+        self.not_full = None
+        self.drained = None  # Notified once size is down to low_water
+        self.dropped = 0
+        self.corked = 0  # While above zero, queued frames wait for uncork instead of an eager flush
+        self.closed = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, wait=True):
+        # wait=False makes the "block" policy refuse a frame when it would have to wait
+        size = sum(len(part) for part in frame)
+        with self.lock:
+            while len(self.frames) >= self.max_frames or self.over_budget():
+                if self.policy == "drop_oldest":
+                    # Never drop a frame that is partly written, it would corrupt the stream
+                    index = 1 if self.part or self.offset or self.retry else 0
+                    if index >= len(self.frames):
+                        break
+                    self._release(sum(len(part) for part in self.frames[index]))
+                    del self.frames[index]
+                    self.dropped += 1
+                elif self.policy == "disconnect":
+                    if self.over_budget():
+                        raise SlowConsumerError(f"Server outbound memory cap reached ({self.budget.limit} bytes)")
+                    raise SlowConsumerError(f"Outbound queue full ({self.max_frames} frames)")
+                elif self.closed:
+                    raise SlowConsumerError("Connection closed")
+                elif not wait:
+                    raise SlowConsumerError(f"Outbound queue full ({self.max_frames} frames)")
+                elif not self._waiter("not_full").wait(self.block_timeout):
+                    raise SlowConsumerError(f"Outbound queue still full after {self.block_timeout}s")
+            self.frames.append(frame)
+            self.size += size
+            if self.budget is not None:
+                self.budget.add(size)
+
+    def over_budget(self):
+        # The server-wide cap only counts against connections holding more than their low-water
+        # mark, so a well-behaved client is never punished for someone else's backlog
+        return self.size > self.low_water and self.budget is not None and self.budget.exceeded()
+
+    def above_high_water(self):
+        return self.high_water is not None and self.size > self.high_water
+
+    def wait_drained(self, timeout=None):
+        # Block until no more than low_water bytes are queued, or the outbox is closed; False on timeout
+        with self.lock:
+            return self._waiter("drained").wait_for(lambda: self.closed or self.size <= self.low_water, timeout)
+
+    def close(self):
+        # Forget what is queued for a connection that is going away, and wake whoever waits on it
+        with self.lock:
+            self.closed = True
+            self._release(self.size)
+            self.frames.clear()
+            self.part = self.offset = 0
+            self.retry = False
+            self._notify("not_full", every=True)
+            self._notify("drained", every=True)
+
+    def _waiter(self, name):
+        # Called with the lock held
+        condition = getattr(self, name)
+        if condition is None:
+            condition = threading.Condition(self.lock)
+            setattr(self, name, condition)
+        return condition
+
+    def _notify(self, name, every=False):
+        condition = getattr(self, name)
+        if condition is not None:
+            if every:
+                condition.notify_all()
+            else:
+                condition.notify()
+
+    def _release(self, size):
+        self.size -= size
+        if self.budget is not None:
+            self.budget.add(-size)
+
+    def flush(self, sock, flags=0):
+        # Write as much as the socket takes without blocking; True once the queue is empty
+        with self.lock:
+            queued = self.size
+            try:
+                if vectored(sock):
+                    return self._flush_vectored(sock, flags)
+                while self.frames:
+                    parts = self.frames[0]
+                    while self.part < len(parts):
+                        part = parts[self.part]
+                        try:
+                            sent = sock.send(memoryview(part)[self.offset:], flags)
+                        except WOULD_BLOCK:
+                            self.retry = True
+                            raise
+                        self.retry = False
+                        self.offset += sent
+                        self.size -= sent
+                        if self.offset < len(part):
+                            return False
+                        self.part += 1
+                        self.offset = 0
+                    self.frames.popleft()
+                    self.part = 0
+                    self._notify("not_full")
+            except WOULD_BLOCK:
+                return False
+            finally:
+                self._wrote(queued - self.size)
+            return True
+
+    def _wrote(self, count):
+        if not count:
+            return
+        self.written += count
+        if self.budget is not None:
+            self.budget.add(-count)
+        if self.size <= self.low_water:
+            self._notify("drained", every=True)
+
+    def _flush_vectored(self, sock, flags):
+        # Gather the buffers of as many queued frames as fit into one sendmsg call
+        while self.frames:
+            buffers = []
+            for index, parts in enumerate(self.frames):
+                buffers.extend(parts[self.part:] if index == 0 else parts)
+                if len(buffers) >= MAX_BUFFERS:
+                    del buffers[MAX_BUFFERS:]
+                    break
+            if self.offset:
+                buffers[0] = memoryview(buffers[0])[self.offset:]
+            sent = sock.sendmsg(buffers, (), flags)
+            complete = sent == sum(len(buffer) for buffer in buffers)
+            self._advance(sent)
+            if not complete:
+                return False
+        return True
+
+    def _advance(self, sent):
+        # Mark sent bytes as written, across as many frames as they cover
+        self.size -= sent
+        while self.frames:
+            parts = self.frames[0]
+            remaining = len(parts[self.part]) - self.offset
+            if sent < remaining:
+                self.offset += sent
+                return
+            sent -= remaining
+            self.part += 1
+            self.offset = 0
+            if self.part == len(parts):
+                self.frames.popleft()
+                self.part = 0
+                self._notify("not_full")
+
+class OutboxWriter:
+    # One thread that finishes the writes the threaded engine could not complete
+    # immediately, for every connection, as their sockets become writable
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = {}  # {socket: outbox to register, or None to forget the socket}
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, sock, outbox):
+        with self.lock:
+            self.pending[sock] = outbox
+        self.wakeup()
+
+    def discard(self, sock):
+        with self.lock:
+            self.pending[sock] = None
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass  # A wakeup is already pending
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.wakeup_recv:
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                sock = key.fileobj
+                try:
+                    done = key.data.flush(sock, send_flags(sock))
+                except OSError as e:
+                    logger.warning(f"Dropping queued frames for a failed socket: {e}")
+                    done = True
+                if done:
+                    self._unregister(sock)
+
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for sock, outbox in pending.items():
+                if outbox is None:
+                    self._unregister(sock)
+                    continue
+                try:
+                    self.selector.register(sock, selectors.EVENT_WRITE, outbox)
+                except KeyError:
+                    pass  # Already waiting to be written
+                except (ValueError, OSError):
+                    pass  # Closed in the meantime
+
+    def _unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
@@ -0,0 +1,167 @@
+import logging
+import random
+import socket
+import threading
+from collections import deque
+
+from websocket_client import WebSocketClient
+from websocket_frames import FrameParser, MessageAssembler
+
+logger = logging.getLogger(__name__)
+
+
+class ReconnectingClient(WebSocketClient):
+    # A client that keeps itself connected. connect() returns at once and a background thread
+    # connects, receives, and reconnects after any failure, waiting a random delay between
+    # min_delay and an exponentially growing cap (max_delay at most) so that clients dropped by
+    # the same server restart do not all come back at the same moment.
+    #
+    # Messages sent while disconnected wait in a queue of max_queue messages (the oldest are
+    # dropped) and go out, in order, once the next connection is up and on_connected() has run.
+    def __init__(self, host, port, use_ssl=False, compression=None, min_delay=0.5, max_delay=30, max_queue=1000):
+        super().__init__(host, port, use_ssl, compression)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.queue = deque()  # (opcode, payload) waiting for a connection
+        self.lock = threading.RLock()
+        self.connected = False
+        self.closed = threading.Event()
+        self.ready = threading.Event()  # Set while connected
+        self.thread = None
+        self.failures = 0  # Failed attempts since the last successful connection
+        self.connections = 0
+        self.dropped = 0
+
+    def connect(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def wait_connected(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def on_connected(self):
+        # Hook called after each successful handshake, before queued messages are flushed;
+        # messages sent from here go out first (e.g. to log in or resubscribe)
+        pass
+
+    def on_disconnected(self):
+        # Hook called when a connection is lost, before waiting to reconnect
+        pass
+
+    def next_delay(self):
+        # "Full jitter" backoff: uniform between min_delay and the exponential cap. A lost connection
+        # (no failures yet) counts as the first, so that retry is spread out too.
+        cap = min(self.max_delay, self.min_delay * 2 ** min(max(self.failures, 1), 32))
+        return random.uniform(self.min_delay, max(cap, self.min_delay))
+
+    def run(self):
+        while not self.closed.is_set():
+            try:
+                self.reset()
+                self.open()
+            except Exception as e:
+                self.failures += 1
+                delay = self.next_delay()
+                logger.warning(f"Connecting to {self.host}:{self.port} failed: {e}, retrying in {delay:.1f}s")
+                self.sock.close()
+                self.closed.wait(delay)
+                continue
+            self.failures = 0
+            self.connections += 1
+            self.flush_queue()
+            self.receive_messages()
+            with self.lock:
+                self.connected = False
+                self.ready.clear()
+            self.drop_connection()
+            if self.closed.is_set():
+                break
+            logger.warning(f"Connection to {self.host}:{self.port} lost")
+            try:
+                self.on_disconnected()
+            except Exception as e:
+                logger.error(f"Error in on_disconnected: {e}", exc_info=True)
+            # Even the first retry waits, so a restarted server is not hit by every client at once
+            self.closed.wait(self.next_delay())
+
+    def reset(self):
+        # Fresh socket and framing state; compression is negotiated again by the handshake
+        self.sock = self.create_socket()
+        self.deflate = None
+        self.parser = FrameParser(max_frame_size=self.max_message_size)
+        self.assembler = MessageAssembler(self.max_message_size)
+        self.pending = []
+        self.corked = 0
+
+    def flush_queue(self):
+        with self.lock:
+            self.connected = True
+            try:
+                self.on_connected()
+            except Exception as e:
+                logger.error(f"Error in on_connected: {e}", exc_info=True)
+            if self.queue and self.connected:
+                # One burst of writes for everything sent while disconnected
+                self.cork()
+                for opcode, payload in self.queue:
+                    super().send_data(opcode, payload)
+                try:
+                    self.uncork()
+                    self.queue.clear()
+                except OSError as e:
+                    # The queue is kept and sent again on the next connection, so a message
+                    # that was partly written before the failure may arrive twice
+                    logger.warning(f"Flushing queued messages failed: {e}")
+                    self.connected = False
+                    self.shutdown()
+            if self.connected:
+                self.ready.set()
+
+    def send_data(self, opcode, payload):
+        with self.lock:
+            if self.connected:
+                try:
+                    super().send_data(opcode, payload)
+                    return
+                except OSError as e:
+                    # The receiving thread notices the dead socket and reconnects
+                    logger.warning(f"Send failed, queueing until reconnected: {e}")
+                    self.connected = False
+                    self.ready.clear()
+                    self.shutdown()
+            if len(self.queue) >= self.max_queue:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((opcode, bytes(payload)))
+
+    def shutdown(self):
+        # Wake the receiving thread blocked in recv
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def drop_connection(self):
+        if WebSocketClient.heartbeats is not None:
+            WebSocketClient.heartbeats.remove(self)
+        self.sock.close()
+
+    def heartbeat_expired(self):
+        # Only drop this connection; run() reconnects
+        logger.warning("Heartbeat timeout")
+        self.metrics.heartbeat_timeouts.inc()
+        self.shutdown()
+
+    def stats(self):
+        return {"connected": self.connected, "connections": self.connections, "failures": self.failures,
+                "queued": len(self.queue), "dropped": self.dropped}
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.connected = False
+            self.ready.clear()
+        self.shutdown()
+        super().close()
@@ -0,0 +1,257 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from websocket_client import WebSocketClient
+from websocket_server import WebSocketServer
+
+logger = logging.getLogger(__name__)
+
+# Requests and replies are JSON text messages tagged with the caller's correlation id:
+#   {"id": 7, "method": "add", "params": [1, 2]}
+#   {"id": 7, "result": 3}
+#   {"id": 7, "error": {"type": "ValueError", "message": "..."}}
+# Replies may come back in any order, so one connection carries many calls at once.
+
+
+class RpcError(Exception):
+    # A call that failed on the server; type is the name of the server-side exception
+    def __init__(self, message, type="Error"):
+        super().__init__(message)
+        self.type = type
+
+
+def encode_request(call_id, method, params):
+    return json.dumps({"id": call_id, "method": method, "params": params}, separators=(',', ':'))
+
+
+def encode_reply(call_id, result=None, error=None):
+    if error is not None:
+        return json.dumps({"id": call_id, "error": error}, separators=(',', ':'))
+    return json.dumps({"id": call_id, "result": result}, separators=(',', ':'))
+
+
+def fail(future, error):
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass  # Settled by another thread in the meantime
+
+
+class RpcServer(WebSocketServer):
+    # Dispatches requests to registered handlers on a pool of worker threads, so a slow call does
+    # not hold up the other calls of its connection. Handlers get the params (spread when they
+    # are a list or dict) and return a JSON-serialisable result:
+    #
+    #     server = RpcServer('localhost', 8765)
+    #     server.register("add", lambda a, b: a + b)
+    #
+    # inline=True runs a cheap handler on the connection's own thread (or the event loop) instead.
+    def __init__(self, host, port, max_workers=32, executor=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.handlers = {}  # {method: (handler, inline)}
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers, "rpc")
+
+    def register(self, method, handler=None, inline=False):
+        # Also usable as a decorator: @server.register("add")
+        if handler is None:
+            return lambda handler: self.register(method, handler, inline) or handler
+        self.handlers[method] = (handler, inline)
+
+    def on_message(self, client, message):
+        try:
+            request = json.loads(message)
+            call_id = request.get("id")
+            method = request["method"]
+            params = request.get("params")
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.on_invalid_message(client, message)
+            return
+        entry = self.handlers.get(method)
+        if entry is None:
+            self.reply(client, call_id, error={"type": "MethodNotFound", "message": f"Unknown method {method!r}"})
+            return
+        handler, inline = entry
+        if inline:
+            self.run_handler(client, call_id, handler, params, False)
+        else:
+            self.executor.submit(self.run_handler, client, call_id, handler, params, True)
+
+    def on_invalid_message(self, client, message):
+        # Hook for messages that are not RPC requests
+        self.reply(client, None, error={"type": "InvalidRequest", "message": "Expected a JSON request"})
+
+    def run_handler(self, client, call_id, handler, params, offloaded):
+        try:
+            if isinstance(params, dict):
+                result = handler(**params)
+            elif isinstance(params, list):
+                result = handler(*params)
+            elif params is None:
+                result = handler()
+            else:
+                result = handler(params)
+        except Exception as e:
+            logger.debug(f"RPC call {call_id} failed: {e}")
+            self.reply(client, call_id, error={"type": type(e).__name__, "message": str(e)}, offloaded=offloaded)
+            return
+        self.reply(client, call_id, result, offloaded=offloaded)
+
+    def reply(self, client, call_id, result=None, error=None, offloaded=False):
+        if call_id is None and error is None:
+            return  # A notification, nobody waits for the result
+        try:
+            message = encode_reply(call_id, result, error)
+        except (TypeError, ValueError) as e:
+            message = encode_reply(call_id, error={"type": type(e).__name__, "message": str(e)})
+        if offloaded and self.asyncio_engine is not None:
+            # Writes to asyncio connections only happen on the loop
+            self.asyncio_engine.call_soon(self.send_reply, client, message)
+        else:
+            self.send_reply(client, message)
+
+    def send_reply(self, client, message):
+        conn = self.clients.get(client)
+        if conn is None:
+            return  # Disconnected while the call ran
+        try:
+            self.send_message(client, message)
+        except Exception as e:
+            logger.warning(f"Could not send RPC reply to {conn.address}: {e}")
+
+    def stop(self):
+        super().stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RpcClient(WebSocketClient):
+    # call() returns a concurrent.futures.Future right away, so any number of calls can be in
+    # flight on one connection:
+    #
+    #     futures = [client.call("add", [i, 1]) for i in range(100)]
+    #     results = [future.result() for future in futures]
+    #
+    # A call not answered within its timeout fails with TimeoutError; one that failed on the
+    # server raises RpcError. Messages that are not replies go to on_message().
+    def __init__(self, host, port, default_timeout=30, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.default_timeout = default_timeout
+        self.ids = itertools.count(1)
+        self.calls = {}  # {id: Future}
+        self.deadlines = []  # Heap of (deadline, id); answered calls leave theirs until skipped
+        self.calls_lock = threading.Condition()  # Guards calls and deadlines; notified on a new deadline
+        self.timer = None
+
+    def call(self, method, params=None, timeout=None):
+        # timeout=None uses default_timeout; 0 waits forever
+        if timeout is None:
+            timeout = self.default_timeout
+        call_id = next(self.ids)
+        future = Future()
+        with self.calls_lock:
+            self.calls[call_id] = future
+            if timeout:
+                self.add_deadline(call_id, time.monotonic() + timeout)
+        try:
+            self.send_message(encode_request(call_id, method, params))
+        except Exception as e:
+            with self.calls_lock:
+                self.calls.pop(call_id, None)
+            fail(future, e)
+        return future
+
+    def request(self, method, params=None, timeout=None):
+        # Blocking call()
+        return self.call(method, params, timeout).result()
+
+    def notify(self, method, params=None):
+        # A request without an id: the server runs it and sends nothing back
+        self.send_message(json.dumps({"method": method, "params": params}, separators=(',', ':')))
+
+    def add_deadline(self, call_id, deadline):
+        # Called with calls_lock held
+        if len(self.deadlines) > 2 * len(self.calls) + 64:
+            # Mostly deadlines of answered calls: drop them, so the heap follows the calls in
+            # flight rather than call rate times timeout
+            self.deadlines = [entry for entry in self.deadlines if entry[1] in self.calls]
+            heapq.heapify(self.deadlines)
+        heapq.heappush(self.deadlines, (deadline, call_id))
+        self.calls_lock.notify()
+        if self.timer is None:
+            # One thread per client expires calls. It runs while some call has a deadline, so a
+            # closed client leaves no thread behind.
+            self.timer = threading.Thread(target=self.expire_calls, daemon=True)
+            self.timer.start()
+
+    def expire_calls(self):
+        while True:
+            with self.calls_lock:
+                while self.deadlines and self.deadlines[0][1] not in self.calls:
+                    heapq.heappop(self.deadlines)  # Answered already
+                if not self.deadlines:
+                    self.timer = None
+                    return
+                deadline, call_id = self.deadlines[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.calls_lock.wait(delay)
+                    continue
+                heapq.heappop(self.deadlines)
+                future = self.calls.pop(call_id)
+            fail(future, TimeoutError(f"RPC call {call_id} timed out"))
+
+    def fail_calls(self, error):
+        # Fail every call in flight; their deadlines go too, which lets the timer thread exit
+        with self.calls_lock:
+            calls, self.calls = self.calls, {}
+            self.deadlines = []
+            self.calls_lock.notify()
+        for future in calls.values():
+            fail(future, error)
+
+    def receive_messages(self):
+        try:
+            while True:
+                message = self.receive_message()
+                if message is None:
+                    break
+                self.handle_reply(message)
+        except Exception as e:
+            logger.error(f"Error receiving RPC replies: {e}", exc_info=True)
+        finally:
+            # Nothing more will be answered on this connection
+            self.fail_calls(ConnectionError("Connection closed before the reply arrived"))
+
+    def handle_reply(self, message):
+        try:
+            reply = json.loads(message)
+            call_id = reply["id"]
+        except (ValueError, TypeError, KeyError):
+            self.on_message(message)
+            return
+        with self.calls_lock:
+            future = self.calls.pop(call_id, None)
+        if future is None:
+            if reply.get("error") and call_id is None:
+                logger.warning(f"Server rejected a request: {reply['error'].get('message')}")
+            return  # Timed out already
+        try:
+            if "error" in reply:
+                error = reply["error"] or {}
+                future.set_exception(RpcError(error.get("message", ""), error.get("type", "Error")))
+            else:
+                future.set_result(reply.get("result"))
+        except InvalidStateError:
+            pass  # Timed out at the same moment
+
+    def on_message(self, message):
+        # Hook for messages that are not replies
+        logger.info(f"Received: {message}")
+
+    def close(self):
+        super().close()
+        self.fail_calls(ConnectionError("Client closed before the reply arrived"))
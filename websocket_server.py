@@ -1,235 +1,757 @@
 import socket
 import threading
-import hashlib
-import base64
 import struct
 import ssl
 import logging
 import time
+from contextlib import contextmanager
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='websocket_server.log',
-    filemode='a'
-)
-logger = logging.getLogger(__name__)
+from websocket_connection import Connection, ConnectionRegistry
+from websocket_frames import (CLOSED, FrameParser, MessageAssembler, build_frame_header, encode_fragments, next_data_frame,
+                              next_message, read_frame, stream_message)
+from websocket_handshake import MAX_HEAD_SIZE, HandshakeError, accept_key, parse_upgrade_request, read_head, upgrade_response
+from websocket_heartbeat import HeartbeatScheduler
+from websocket_logging import configure_logging, frame_log
+from websocket_metrics import ServerMetrics, start_metrics_server
+from websocket_offload import Offload
+from websocket_outbox import MemoryBudget, Outbox, OutboxWriter, SlowConsumerError, send_flags, vectored
+from websocket_tls import server_context, wait_ready
+from websocket_tracing import Tracer
 
-# Add console logging
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+# Handlers are set up by configure_logging() in __main__, never on import
+logger = logging.getLogger(__name__)
+frame_logger = frame_log(logger)  # Per-frame debug logging, off unless log_frames() is called
 
 class WebSocketServer:
-    def __init__(self, host, port, use_ssl=False, certfile=None, keyfile=None):
+    ENGINES = ("threaded", "asyncio")
+    connection_class = Connection  # A Connection subclass with more slots for a server's own data
+
+    def __init__(self, host, port, use_ssl=False, certfile=None, keyfile=None, engine="threaded", compression=None,
+                 ssl_context=None):
         # Initialize server properties
         self.host = host
         self.port = port
-        self.use_ssl = use_ssl
+        self.use_ssl = use_ssl or ssl_context is not None
         self.certfile = certfile
         self.keyfile = keyfile
+        # One context for every connection, built before the first one arrives
+        if ssl_context is None and use_ssl:
+            ssl_context = server_context(certfile, keyfile)
+        self.ssl_context = ssl_context
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {self.ENGINES}")
+        self.engine = engine
+        self.compression = compression  # DeflateConfig to accept permessage-deflate offers
         
-        # Create a TCP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
-
-        # Wrap socket with SSL if enabled
-        if self.use_ssl:
-            self.sock = ssl.wrap_socket(
-                self.sock,
-                server_side=True,
-                certfile=self.certfile,
-                keyfile=self.keyfile,
-                ssl_version=ssl.PROTOCOL_TLS
-            )
-
-        logger.info(f"WebSocket server initialized on {host}:{port} (SSL: {use_ssl})")
+        self.sock = self.create_socket()
+
+        logger.info(f"WebSocket server initialized on {host}:{port} (SSL: {self.use_ssl}, engine: {engine})")
 
         # Store client connections and set heartbeat parameters
-        self.clients = {}
+        self.connections = ConnectionRegistry()
+        self.clients = self.connections.by_socket  # {client socket: Connection}
         self.heartbeat_interval = 30  # Send ping every 30 seconds
         self.heartbeat_timeout = 10  # Wait 10 seconds for pong response
+        self.max_message_size = 64 * 1024 * 1024  # Reassembled message limit, None to disable
+        self.max_handshake_size = MAX_HEAD_SIZE  # Largest upgrade request head accepted
+        self.handshake_timeout = 10  # Seconds a client gets for the TLS and upgrade handshakes
+
+        # Outbound queues: frames per client and what to do when a client stops reading
+        self.outbox_size = 1024
+        self.slow_consumer_policy = "drop_oldest"  # Or "disconnect", or "block"
+        self.slow_consumer_timeout = None  # How long "block" waits before disconnecting
+        # Flow control: a client with more than outbox_high_water bytes queued is not read from
+        # until it is back under outbox_low_water, and all outboxes together stay under the cap
+        self.outbox_high_water = 1024 * 1024
+        self.outbox_low_water = 256 * 1024
+        self.outbox_memory = MemoryBudget(256 * 1024 * 1024)  # Change .limit for another cap
+        self.flusher = None  # Finishes writes that did not complete immediately
+        self.listening = threading.Event()  # Set once start() accepts connections
+
+        # One timer wheel pings every client; the engine decides what drives its ticks
+        self.heartbeats = HeartbeatScheduler(self.send_ping, self.expire_client)
+        self.metrics = ServerMetrics(self)  # Counters and histograms, see get_metrics()
+        self.tracer = None  # Per-stage timings of sampled messages, see enable_tracing()
+        self.offload = None  # Runs a handler on a thread or process pool, see enable_offload()
+
+        self.asyncio_engine = None
+        self.stopping = False
+        self.worker_id = None  # Index of this worker process under serve(workers=N)
+        self.channel = None  # Relays publish() to other worker processes or nodes
+
+    def create_socket(self, reuse_port=False):
+        # Create the listening TCP socket; reuse_port lets several worker processes bind the same port
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        # The listening socket stays plain: TLS is set up on each connection once accepted,
+        # so a slow client never holds up accept() for the others
+        return sock
+
+    def serve(self, workers=1, broadcast=True, shutdown_timeout=10):
+        # Run in this process, or fork `workers` processes that share the port through SO_REUSEPORT.
+        # With broadcast, publish() reaches the clients of every worker.
+        if workers <= 1:
+            self.start()
+            return
+        if self.channel is not None:
+            # Bus threads do not survive fork(); run one node per process instead
+            raise ValueError("A server with a message bus cannot fork workers")
+        from websocket_workers import WorkerPool
+        WorkerPool(self, workers, broadcast, shutdown_timeout).run()
 
     def start(self):
         # Start listening for connections
         self.sock.listen(5)
+        self.listening.set()
+        if self.engine == "asyncio":
+            # Multiplex every connection on a single event loop
+            from websocket_asyncio import AsyncioEngine
+            self.asyncio_engine = AsyncioEngine(self)
+            self.asyncio_engine.run()
+            return
+
         logger.info(f"WebSocket server started on {self.host}:{self.port}")
-        while True:
-            client, address = self.sock.accept()
+        self.heartbeats.start()
+        while not self.stopping:
+            try:
+                client, address = self.sock.accept()
+            except OSError:
+                if self.stopping:
+                    break
+                raise
             logger.debug(f"New connection attempt from {address}")
+            accepted = time.perf_counter() if self.tracer is not None else None
             # Start a new thread to handle each client
-            threading.Thread(target=self.handle_client, args=(client, address)).start()
+            threading.Thread(target=self.handle_client, args=(client, address, accepted)).start()
+
+    def stop(self):
+        # Stop accepting connections and close every client with 1001 (going away); start() returns.
+        # Safe to call from a signal handler or another thread.
+        self.stopping = True
+        if self.offload is not None:
+            self.offload.shutdown()
+        if self.asyncio_engine is not None:
+            self.asyncio_engine.stop()
+            return
+        try:
+            # Wakes a thread blocked in accept(), which close() alone does not do
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for client in list(self.clients):
+            self.close_client(client, 1001)
 
-    def handle_client(self, client, address):
+    def handle_client(self, client, address, accepted=None):
+        # accepted: perf_counter() time accept() returned, when tracing
         logger.info(f"New connection established from {address}")
+        opened = False
+        tracer = self.tracer
         try:
-            self.handshake(client)
+            start = tracer.sample() if tracer is not None else 0.0
+            try:
+                client.settimeout(self.handshake_timeout)
+                if self.ssl_context is not None:
+                    # The TLS handshake runs here, on the connection's own thread
+                    client = self.ssl_context.wrap_socket(client, server_side=True)
+                deflate, request, leftover = self.handshake(client)
+                if isinstance(client, ssl.SSLSocket):
+                    # SSL sockets refuse MSG_DONTWAIT, so they are made non-blocking for writes that
+                    # never wait on a client that stopped reading; receive_frame waits for reads
+                    client.setblocking(False)
+                else:
+                    client.settimeout(None)
+            except Exception:
+                self.metrics.handshake_failures.inc()
+                raise
+            finally:
+                if start:
+                    tracer.begin()
+                    if accepted is not None:
+                        tracer.span("accept", accepted, start, address=str(address))
+                    tracer.span("handshake", start, address=str(address))
+                    tracer.end()
             logger.debug(f"Handshake successful for {address}")
-            self.clients[client] = {"address": address, "last_pong": time.time()}
-            # Start heartbeat thread for this client
-            threading.Thread(target=self.heartbeat, args=(client,)).start()
+            self.metrics.connections.inc()
+            conn = self.add_client(client, address, deflate, request)
+            if leftover:
+                # Frames the client sent right behind its request
+                conn.parser.feed(leftover)
+            self.heartbeats.add(client, self.heartbeat_interval, self.heartbeat_timeout)
+            opened = True
+            self.on_open(client)
             self.handle_messages(client)
         except ConnectionResetError:
             logger.warning(f"Connection reset by {address}")
         except TimeoutError:
             logger.warning(f"Connection timeout with {address}")
+        except HandshakeError as e:
+            logger.warning(f"Rejected handshake from {address}: {e}")
+        except ssl.SSLError as e:
+            logger.warning(f"TLS error with {address}: {e}")
         except Exception as e:
             logger.error(f"Error handling client {address}: {e}", exc_info=True)
         finally:
+            if opened:
+                self.on_close(client)
             self.remove_client(client)
             client.close()
             logger.info(f"Connection closed for {address}")
 
+    def on_open(self, client):
+        # Hook called once the handshake is done and the client is registered
+        pass
+
+    def on_message(self, client, message):
+        # Hook called for every complete message (str for text, bytes for binary);
+        # the default behaviour is to echo it back
+        if isinstance(message, bytes):
+            self.send_binary(client, message)
+            return
+        self.send_message(client, f"Echo: {message}")
+
+    def on_close(self, client):
+        # Hook called before an opened client is removed
+        pass
+
+    def attach_bus(self, bus):
+        # Carry publish() (and ChatServer.broadcast) to other server nodes through a MessageBus
+        self.channel = bus
+        bus.attach(self.receive_channel_message)
+
+    def publish(self, message):
+        # Send a message to every client, including those held by other worker processes
+        self.broadcast_to(list(self.clients), message)
+        if self.channel is not None:
+            self.channel.publish(message)
+
+    def on_channel_message(self, message):
+        # Hook called with what another worker published; runs where writes to clients are safe
+        self.broadcast_to(list(self.clients), message)
+
+    def receive_channel_message(self, message):
+        # Called from the channel's reader thread
+        if self.asyncio_engine is not None:
+            self.asyncio_engine.call_soon(self.on_channel_message, message)
+        else:
+            self.on_channel_message(message)
+
     def remove_client(self, client):
-        # Remove client from the clients dictionary
-        if client in self.clients:
-            del self.clients[client]
+        # Unregister the client, releasing what was still queued for it
+        conn = self.connections.remove(client)
+        if conn is not None:
+            conn.outbox.close()
+        self.heartbeats.remove(client)
+        if self.flusher is not None:
+            self.flusher.discard(client)
 
-    def heartbeat(self, client):
-        while client in self.clients:
-            time.sleep(self.heartbeat_interval)
-            try:
-                self.send_ping(client)
-                start_time = time.time()
-                while time.time() - start_time < self.heartbeat_timeout:
-                    if time.time() - self.clients[client]["last_pong"] < self.heartbeat_timeout:
-                        break
-                    time.sleep(0.5)
-                else:
-                    # Close connection if no pong received within timeout
-                    logger.warning(f"Heartbeat timeout for {self.clients[client]['address']}")
-                    client.close()
-                    break
-            except Exception as e:
-                logger.error(f"Error in heartbeat for {self.clients[client]['address']}: {e}")
-                break
+    def disconnect(self, client):
+        # Shut the socket down so whoever is reading it notices and cleans up
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn = self.clients.get(client)
+        if conn is not None:
+            conn.outbox.close()  # Nothing queued can be written any more; wakes paused readers
+
+    def close_client(self, client, code=1000, reason=""):
+        # Send a close frame, then shut the connection down
+        try:
+            self.send_frame(client, 0x8, struct.pack('!H', code) + reason.encode('utf-8'))
+        except (OSError, SlowConsumerError):
+            pass
+        self.disconnect(client)
+
+    def expire_client(self, client):
+        # Close connection if no pong (or other traffic) arrived within the timeout
+        conn = self.clients.get(client)
+        logger.warning(f"Heartbeat timeout for {conn.address if conn else client}")
+        self.metrics.heartbeat_timeouts.inc()
+        self.disconnect(client)
 
     def send_ping(self, client):
-        # Send a ping frame to the client
-        logger.debug(f"Sending ping to {self.clients[client]['address']}")
+        # Send a ping frame to the client. This runs on the heartbeat thread shared by every
+        # connection, so it never waits for room in a full outbox.
+        if frame_logger.enabled:
+            frame_logger("Sending ping to %s", self.clients[client].address)
         frame = struct.pack('!BB', 0x89, 0)
-        client.send(frame)
+        self.metrics.frame_sent(0x9, 0)
+        try:
+            self.write_frame(client, frame, wait=False)
+        except SlowConsumerError as e:
+            # A client that lets its queue fill up would not answer the ping in time either
+            conn = self.clients.get(client)
+            logger.warning(f"Disconnecting slow consumer {conn.address if conn else client}: {e}")
+            self.disconnect(client)
 
     def handle_pong(self, client):
         # Update last_pong time when a pong is received
-        self.clients[client]["last_pong"] = time.time()
-        logger.debug(f"Received pong from {self.clients[client]['address']}")
+        conn = self.clients[client]
+        conn.last_pong = time.time()
+        self.heartbeats.touch(client)
+        if frame_logger.enabled:
+            frame_logger("Received pong from %s", conn.address)
 
     def handle_messages(self, client):
+        conn = self.get_state(client)
+        outbox = conn.outbox
         while True:
             try:
                 message = self.receive_message(client)
-                if message:
-                    logger.debug(f"Received message: {message}")
-                    self.send_message(client, f"Echo: {message}")
-                    logger.debug(f"Sent echo response: Echo: {message}")
+                if message is not None:
+                    self.dispatch(client, message)
+                    if outbox.above_high_water():
+                        self.pause_reading(client, outbox)
                 else:
-                    logger.debug("Received empty message, closing connection")
+                    logger.debug("Connection closed by client")
                     break
+            except SlowConsumerError as e:
+                logger.warning(f"Disconnecting slow consumer {conn.address}: {e}")
+                self.metrics.slow_consumers.inc()
+                break
             except Exception as e:
                 logger.error(f"Error handling message: {e}", exc_info=True)
                 break
 
+    def pause_reading(self, client, outbox):
+        # Stop reading from a client whose replies are not draining until its outbox is back under
+        # the low-water mark; TCP flow control then holds the client back in turn. A client that
+        # takes nothing for a whole heartbeat timeout is dropped.
+        self.metrics.paused_reads.inc()
+        written = outbox.written
+        while not outbox.wait_drained(self.heartbeat_timeout):
+            if outbox.written == written:
+                raise SlowConsumerError(f"Nothing read for {self.heartbeat_timeout}s with {outbox.size} bytes queued")
+            written = outbox.written
+            self.heartbeats.touch(client)  # Pongs are not read meanwhile, but the client is alive
+
+    def drain(self, client, timeout=None):
+        # Wait until the client's outbox is back under its low-water mark, so a producer sending to
+        # it goes no faster than the client reads. False on timeout, ConnectionError once the
+        # client is gone. Blocks the calling thread: on the asyncio engine, coroutines await
+        # drain_async() instead.
+        conn = self.clients.get(client)
+        if conn is None:
+            raise ConnectionError("Not a connected client")
+        outbox = conn.outbox
+        if not outbox.wait_drained(timeout):
+            return False
+        if outbox.closed:
+            raise ConnectionError("Connection closed")
+        return True
+
+    async def drain_async(self, client):
+        # drain() for coroutines on the asyncio engine's loop
+        conn = self.clients.get(client)
+        if conn is None:
+            raise ConnectionError("Not a connected client")
+        outbox = conn.outbox
+        await self.asyncio_engine.wait_drained(client, outbox)
+        if outbox.closed:
+            raise ConnectionError("Connection closed")
+
+    def dispatch(self, client, message, wait=True):
+        # Run on_message, timing one call in metrics.sample_every. With an offload pool and
+        # wait=False, returns False instead of blocking while the pool is full.
+        metrics = self.metrics
+        tracer = self.tracer
+        offload = self.offload
+        if offload is not None:
+            # The handler runs on the pool and its reply comes back through receive_result()
+            start = time.perf_counter() if tracer is not None and tracer.tracing() else 0.0
+            if not offload.submit(client, message, wait):
+                return False
+            metrics.messages += 1
+            if start:
+                tracer.span("submit", start)
+                tracer.end()
+            return True
+        metrics.messages += 1
+        if tracer is not None and tracer.tracing():
+            start = time.perf_counter()
+            try:
+                self.on_message(client, message)
+            finally:
+                tracer.span("handler", start)
+                tracer.end()
+        elif metrics.messages % metrics.sample_every:
+            self.on_message(client, message)
+        else:
+            start = time.perf_counter()
+            self.on_message(client, message)
+            metrics.handler_seconds.observe(time.perf_counter() - start)
+        return True
+
+    def enable_offload(self, handler, pool="thread", workers=None, max_pending=1024, executor=None):
+        # Run handler(message) on a pool of threads or processes instead of on_message, so CPU-heavy
+        # work leaves the I/O thread (or event loop) free. Its return value goes to on_result().
+        # Returns the Offload.
+        offload = Offload(handler, pool, workers, max_pending, executor)
+        offload.deliver = self.receive_result
+        self.offload = offload
+        return offload
+
+    def disable_offload(self):
+        # Back to on_message; messages already submitted are dropped
+        offload, self.offload = self.offload, None
+        if offload is not None:
+            offload.shutdown()
+        return offload
+
+    def receive_result(self, client, future):
+        # Called from the pool with a finished handler call, in message order for each client
+        if self.asyncio_engine is not None:
+            # Writes to asyncio connections only happen on the loop
+            self.asyncio_engine.call_soon(self.complete_result, client, future)
+        else:
+            self.complete_result(client, future)
+
+    def complete_result(self, client, future):
+        conn = self.clients.get(client)
+        if conn is None:
+            return  # Disconnected while the handler ran
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Offloaded handler failed for {conn.address}: {e}", exc_info=e)
+            return
+        try:
+            self.on_result(client, result)
+        except SlowConsumerError as e:
+            logger.warning(f"Disconnecting slow consumer {conn.address}: {e}")
+            self.disconnect(client)
+        except OSError as e:
+            logger.warning(f"Could not deliver a result to {conn.address}: {e}")
+
+    def on_result(self, client, result):
+        # Hook called with what the offloaded handler returned for each message, in the order the
+        # client sent them; the default sends it back (str as text, bytes as binary, None not at all)
+        if result is None:
+            return
+        if isinstance(result, str):
+            self.send_message(client, result)
+        else:
+            self.send_binary(client, result)
+
+    def get_state(self, client):
+        # The client's Connection; each keeps its own receive buffer across calls
+        conn = self.clients.get(client)
+        if conn is None:
+            conn = self.add_client(client, None)
+        return conn
+
+    def get_parser(self, client):
+        return self.get_state(client).parser
+
+    def get_connection(self, conn_id):
+        # The Connection with this id, None once it is gone
+        return self.connections.get(conn_id)
+
+    def add_client(self, client, address, deflate=None, request=None):
+        # Register a connection that finished its handshake; returns its Connection
+        return self.connections.add(self.new_connection(client, address, deflate, request))
+
+    def new_connection(self, client, address, deflate=None, request=None):
+        return self.connection_class(
+            client, address,
+            FrameParser(max_frame_size=self.max_message_size),
+            MessageAssembler(self.max_message_size, deflate),
+            Outbox(self.outbox_size, self.slow_consumer_policy, self.slow_consumer_timeout,
+                   self.outbox_high_water, self.outbox_low_water, self.outbox_memory),
+            deflate, request,
+        )
+
+    def get_request(self, client):
+        # (path, headers) of the upgrade request a client connected with, None if unknown
+        conn = self.clients.get(client)
+        return conn.request if conn is not None else None
+
+    def get_metrics(self):
+        # Snapshot of every metric, as served by start_metrics_server()
+        return self.metrics.snapshot()
+
+    def enable_tracing(self, sample_every=100, capacity=65536):
+        # Record the stages of one message in sample_every; returns the Tracer, whose
+        # to_json()/to_chrome()/export() give the spans
+        self.tracer = Tracer(capacity, sample_every)
+        return self.tracer
+
+    def disable_tracing(self):
+        tracer, self.tracer = self.tracer, None
+        return tracer
+
+    def start_metrics_server(self, port=9100, host="127.0.0.1"):
+        # Serve GET /metrics in the Prometheus text format on a side port; returns the HTTP server
+        return start_metrics_server(self.metrics.registry, port, host)
+
+    def get_compression_stats(self, client):
+        # permessage-deflate statistics for a client, None if compression is off
+        conn = self.clients.get(client)
+        if conn is None or conn.deflate is None:
+            return None
+        return conn.deflate.stats()
+
+    def receive_frame(self, client):
+        # Return the next frame, only reading from the socket when none is buffered
+        parser = self.get_parser(client)
+        while True:
+            try:
+                # Traffic counts as a sign of life, so busy clients are not pinged
+                frame = read_frame(parser, client, self.heartbeats.touch, client)
+                break
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError) as e:
+                # A TLS socket is non-blocking (see handle_client): wait until the record can go on
+                wait_ready(client, e)
+        if frame is not None:
+            self.metrics.frame_received(frame.opcode, len(frame.payload))
+        return frame
+
+    def receive_data_frame(self, client):
+        # Return the next data frame, answering control frames on the way
+        return next_data_frame(self.receive_frame, self.send_pong, self.handle_pong, client)
+
     def receive_message(self, client):
+        # Return the next complete message, reassembling fragments
+        conn = self.get_state(client)
+        result = next_message(lambda: self.receive_frame(client), conn.assembler,
+                              lambda frame: self.control_frame(client, frame), None, self.message_started)
+        if result is None or result is CLOSED:
+            return None
+        message, size, mark = result
+        self.message_received(conn, size, mark)
+        return message
+
+    def control_frame(self, client, frame):
+        # Answer a ping or take a pong; a close frame ends the read in next_message()
+        if frame.opcode == 0x9:
+            self.send_pong(client)
+        elif frame.opcode == 0xA:
+            self.handle_pong(client)
+
+    def message_started(self):
+        # At the first frame of a message, from either engine: start what times it
+        tracer = self.tracer
+        return self.metrics.start_receive(), tracer.sample() if tracer is not None else None
+
+    def message_received(self, conn, size, mark):
+        # Once a message is complete, from either engine
+        conn.messages_received += 1
+        if frame_logger.enabled:
+            frame_logger("Received message of length %d", size)
+        timed, start = mark
+        self.metrics.end_receive(timed)
+        if start:
+            tracer = self.tracer
+            tracer.begin()
+            tracer.span("receive", start, size=size)
+
+    def receive_stream(self, client):
+        # Yield the next message fragment by fragment instead of reassembling it
+        deflate = self.get_state(client).deflate
+        yield from stream_message(self.receive_data_frame, deflate, self.max_message_size, client)
+
+    def send_frame(self, client, opcode, payload, fin=True, rsv1=False):
+        self.metrics.frame_sent(opcode, len(payload))
+        header = build_frame_header(opcode, len(payload), fin, rsv1=rsv1)
+        if len(payload) > 65535 or vectored(client):
+            # Keep the payload apart from the header instead of copying it; sendmsg
+            # gathers both, and large payloads are worth a second write otherwise
+            self.write_frame(client, header, payload)
+        else:
+            self.write_frame(client, header + payload)
+
+    def write_frame(self, client, *parts, wait=True):
+        # Queue one encoded frame (given as consecutive buffers) and write what the socket takes now.
+        # wait=False raises SlowConsumerError instead of waiting under the "block" policy.
+        conn = self.clients.get(client)
+        if conn is None:
+            # Gone already, e.g. a broadcast that raced a disconnect: there is no outbox to queue
+            # on, and its socket may be closed or non-blocking, so the frame is dropped
+            if frame_logger.enabled:
+                frame_logger("Dropped a frame for unregistered client %s", client)
+            return
+        outbox = conn.outbox
+        try:
+            outbox.put(parts, wait)
+        except SlowConsumerError:
+            self.metrics.slow_consumers.inc()
+            raise
+        if not outbox.corked:
+            self.flush_outbox(client, outbox)
+
+    def cork(self, client):
+        # Hold back writes to a client so a burst of frames goes out in as few sendmsg calls as possible
+        conn = self.clients.get(client)
+        if conn is not None:
+            with conn.outbox.lock:
+                conn.outbox.corked += 1
+
+    def uncork(self, client):
+        conn = self.clients.get(client)
+        if conn is None:
+            return
+        outbox = conn.outbox
+        with outbox.lock:
+            outbox.corked = max(outbox.corked - 1, 0)
+            ready = not outbox.corked and len(outbox.frames) > 0
+        if ready:
+            self.flush_outbox(client, outbox)
+
+    @contextmanager
+    def corked(self, client):
+        self.cork(client)
         try:
-            client.settimeout(self.heartbeat_interval + self.heartbeat_timeout)
-            header = client.recv(2)
-            if not header:
-                return None
-            
-            # Parse the header
-            opcode = header[0] & 0x0F
-            if opcode == 0x9:  # Ping
-                self.send_pong(client)
-                return None
-            elif opcode == 0xA:  # Pong
-                self.handle_pong(client)
-                return None
-            
-            mask = header[1] & 0x80
-            payload_length = header[1] & 0x7F
-
-            # Handle different payload lengths
-            if payload_length == 126:
-                payload_length = struct.unpack('>H', client.recv(2))[0]
-            elif payload_length == 127:
-                payload_length = struct.unpack('>Q', client.recv(8))[0]
-
-            # Handle masked and unmasked messages
-            if mask:
-                masking_key = client.recv(4)
-                masked_data = client.recv(payload_length)
-                data = bytes(b ^ masking_key[i % 4] for i, b in enumerate(masked_data))
-            else:
-                data = client.recv(payload_length)
-
-            logger.debug(f"Received message of length {payload_length}")
-            return data.decode('utf-8')
-        except socket.timeout:
-            logger.warning("Connection timed out while receiving message")
-            raise TimeoutError("Connection timed out while receiving message")
+            yield
         finally:
-            client.settimeout(None)  # Remove the timeout
+            self.uncork(client)
+
+    def flush_outbox(self, client, outbox):
+        metrics = self.metrics
+        metrics.flushes += 1
+        if metrics.flushes % metrics.sample_every:
+            done = outbox.flush(client, send_flags(client))
+        else:
+            start = time.perf_counter()
+            done = outbox.flush(client, send_flags(client))
+            metrics.send_seconds.observe(time.perf_counter() - start)
+        if not done:
+            # The rest is written by the engine once the socket is writable again
+            if self.flusher is None:
+                self.flusher = OutboxWriter()
+            self.flusher.schedule(client, outbox)
+
+    def prepare_frame(self, message):
+        # Encode a message into frame buffers once, so they can be shared by many clients
+        if isinstance(message, str):
+            opcode, payload = 0x1, message.encode('utf-8')
+        else:
+            opcode, payload = 0x2, message
+        return opcode, payload, (build_frame_header(opcode, len(payload)), payload)
+
+    def broadcast_to(self, clients, message):
+        # Send one message to many clients, encoding the frame only once
+        opcode, payload, frame = self.prepare_frame(message)
+        shared = 0
+        for client in clients:
+            conn = self.clients.get(client)
+            try:
+                if conn is not None and conn.deflate is not None:
+                    # Compression state is per connection, so these get their own frame
+                    self.send_data(client, opcode, payload)
+                    continue
+                shared += 1
+                if conn is not None:
+                    conn.messages_sent += 1
+                self.write_frame(client, *frame)
+            except SlowConsumerError as e:
+                logger.warning(f"Disconnecting slow consumer {conn.address if conn else client}: {e}")
+                self.disconnect(client)
+            except Exception as e:
+                logger.error(f"Error sending message to client: {e}", exc_info=True)
+        self.metrics.frame_sent(opcode, len(payload), shared)
 
     def send_message(self, client, message):
         # Send a message to the client
-        logger.debug(f"Sending message: {message}")
         encoded_message = message.encode('utf-8')
-        header = struct.pack('!B', 0x81)  # Text frame
-        length = len(encoded_message)
-
-        # Add appropriate length bytes to the header
-        if length <= 125:
-            header += struct.pack('!B', length)
-        elif length <= 65535:
-            header += struct.pack('!BH', 126, length)
+        self.send_data(client, 0x1, encoded_message)
+        if frame_logger.enabled:
+            frame_logger("Sent message of length %d", len(encoded_message))
+
+    def send_binary(self, client, data):
+        # Send bytes, bytearray or memoryview data as a binary frame, without any encoding
+        if isinstance(data, memoryview):
+            data = data.cast('B')
+        self.send_data(client, 0x2, data)
+        if frame_logger.enabled:
+            frame_logger("Sent binary message of length %d", len(data))
+
+    def send_data(self, client, opcode, payload):
+        # Send a whole message, compressing it when permessage-deflate was negotiated
+        conn = self.clients.get(client)
+        deflate = conn.deflate if conn is not None else None
+        tracer = self.tracer
+        start = time.perf_counter() if tracer is not None and tracer.tracing() else 0.0
+        if conn is not None:
+            conn.messages_sent += 1  # Counted once queued, before the client can see it
+        if deflate is not None and deflate.should_compress(len(payload)):
+            with conn.send_lock:
+                self.send_frame(client, opcode, deflate.compress(payload), rsv1=True)
         else:
-            header += struct.pack('!BQ', 127, length)
+            self.send_frame(client, opcode, payload)
+        if start:
+            # Frames still queued show whether the reply had to wait for the socket
+            tracer.span("send", start, size=len(payload), queued=len(conn.outbox) if conn else 0)
 
-        client.send(header + encoded_message)
-        logger.debug(f"Message sent successfully, length: {length}")
+    def send_fragments(self, client, fragments, opcode=0x1):
+        # Send one message as a series of frames from any iterable of str or bytes chunks
+        conn = self.clients.get(client)
+        if conn is None or conn.deflate is None:
+            for opcode, payload, fin, rsv1 in encode_fragments(fragments, opcode):
+                self.send_frame(client, opcode, payload, fin, rsv1)
+            return
+        with conn.send_lock:
+            for opcode, payload, fin, rsv1 in encode_fragments(fragments, opcode, conn.deflate):
+                self.send_frame(client, opcode, payload, fin, rsv1)
 
     def send_pong(self, client):
         # Send a pong frame to the client
-        logger.debug(f"Sending pong to {self.clients[client]['address']}")
+        if frame_logger.enabled:
+            frame_logger("Sending pong to %s", self.clients[client].address)
         frame = struct.pack('!BB', 0x8A, 0)
-        client.send(frame)
+        self.metrics.frame_sent(0xA, 0)
+        self.write_frame(client, frame)
 
     def handshake(self, client):
-        # Perform the WebSocket handshake
+        # Perform the WebSocket handshake; returns (PerMessageDeflate or None, (path, headers),
+        # bytes received after the request)
         logger.debug("Starting handshake process")
-        data = client.recv(1024).decode('utf-8')
-        headers = {}
-        for line in data.split('\r\n')[1:]:
-            if ':' in line:
-                key, value = line.split(':', 1)
-                headers[key.strip()] = value.strip()
-
-        if 'Sec-WebSocket-Key' not in headers:
-            raise ValueError("Sec-WebSocket-Key not found in headers")
-
-        key = headers['Sec-WebSocket-Key']
-        response_key = self.generate_accept_key(key)
-        response = (
-            "HTTP/1.1 101 Switching Protocols\r\n"
-            "Upgrade: websocket\r\n"
-            "Connection: Upgrade\r\n"
-            f"Sec-WebSocket-Accept: {response_key}\r\n\r\n"
-        )
-        client.send(response.encode('utf-8'))
+        try:
+            data, leftover = read_head(client, self.max_handshake_size)
+            request = self.parse_request(data)
+            response, deflate = self.handshake_response(data, request)
+        except HandshakeError as e:
+            try:
+                client.sendall(e.response())
+            except OSError:
+                pass
+            raise
+        client.sendall(response)
         logger.debug("Handshake completed successfully")
+        return deflate, request, leftover
+
+    def parse_request(self, data):
+        # Parse and validate a raw upgrade request head into (path, headers); the path keeps its
+        # query string and header names are lower-cased
+        return parse_upgrade_request(data)
+
+    def handshake_response(self, data, request=None):
+        # Build the 101 response for a raw upgrade request, negotiating permessage-deflate
+        # when it is enabled; returns (response bytes, PerMessageDeflate or None)
+        path, headers = request if request is not None else self.parse_request(data)
+
+        key = headers.get('sec-websocket-key')
+        if key is None:
+            raise HandshakeError("Sec-WebSocket-Key not found in headers")
+
+        extensions = None
+        deflate = None
+        offer = headers.get('sec-websocket-extensions')
+        if self.compression is not None and offer:
+            accepted = self.compression.accept(offer)
+            if accepted is not None:
+                extensions, deflate = accepted
+        return upgrade_response(key, extensions), deflate
 
     def generate_accept_key(self, key):
         # Generate the Sec-WebSocket-Accept key
-        GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-        sha1 = hashlib.sha1((key + GUID).encode('utf-8')).digest()
-        return base64.b64encode(sha1).decode('utf-8')
+        return accept_key(key).decode('ascii')
 
 if __name__ == "__main__":
+    configure_logging('websocket_server.log')
     logger.info("Starting WebSocket server")
     server = WebSocketServer('localhost', 8765, use_ssl=True, certfile='path/to/cert.pem', keyfile='path/to/key.pem')
     server.start()
\ No newline at end of file
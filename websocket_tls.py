@@ -0,0 +1,67 @@
+import select
+import ssl
+import threading
+
+# TLS set up once per process: building an SSLContext loads certificates and CA stores, far more
+# work than a handshake, so servers keep one context and clients share one.
+# WebSocket over TLS is HTTP/1.1 until the upgrade, so that is the protocol offered over ALPN.
+ALPN_PROTOCOLS = ["http/1.1"]
+
+
+def server_context(certfile, keyfile=None):
+    # One context for every connection of a server. Session tickets (and the session id cache
+    # for TLS 1.2) are on, so a returning client skips the certificate exchange.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+
+def wait_ready(sock, error, timeout=None):
+    # Wait on a non-blocking SSL socket until the operation that raised SSLWantReadError or
+    # SSLWantWriteError can be retried; False on timeout
+    poller = select.poll()
+    poller.register(sock, select.POLLIN if isinstance(error, ssl.SSLWantReadError) else select.POLLOUT)
+    return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+
+def client_context(cafile=None):
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+    return context
+
+
+shared_context = None
+lock = threading.Lock()
+
+
+def default_client_context():
+    # The context clients use unless given their own, created on first use
+    global shared_context
+    if shared_context is None:
+        with lock:
+            if shared_context is None:
+                shared_context = client_context()
+    return shared_context
+
+
+# The last session with each server, {(host, port): (context, session)}. A session can only be
+# resumed through the context it was made with, so the context is kept alongside.
+sessions = {}
+
+
+def cached_session(context, host, port):
+    entry = sessions.get((host, port))
+    if entry is not None and entry[0] is context:
+        return entry[1]
+    return None
+
+
+def save_session(sock, host, port):
+    # Remember the session of an established TLS socket so the next connection can resume it
+    session = sock.session
+    if session is not None:
+        sessions[(host, port)] = (sock.context, session)
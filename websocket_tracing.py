@@ -0,0 +1,94 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+perf_counter = time.perf_counter
+
+
+class Tracer:
+    # Records the stages of one message (or connection) in `sample_every` as spans of monotonic
+    # time.perf_counter() timestamps, in a ring buffer that keeps the last `capacity` spans.
+    #
+    # A sampled message gets a trace id once it is complete; the id stays with the thread
+    # handling it, so the handler and any send it makes are recorded under the same id:
+    #   accept     accept() returned until the connection's thread started (threaded engine)
+    #   handshake  the upgrade request read, parsed and answered
+    #   receive    first frame parsed until the message was reassembled and decoded
+    #   handler    on_message()
+    #   send       framing a reply and handing it to the socket or the outbox
+    #
+    # Servers have no tracer unless enable_tracing() is called, so tracing costs a None check
+    # until then; after that an unsampled message costs a counter step and two thread-local reads.
+    def __init__(self, capacity=65536, sample_every=100):
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self.buffer = [None] * capacity  # (name, trace id, thread id, start, end, args)
+        self.slots = itertools.count()  # next() on a count is atomic, so threads never share a slot
+        self.recorded = 0
+        self.samples = itertools.count(1)
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+
+    def sample(self):
+        # The start time for one call in sample_every, 0.0 for the others
+        if next(self.samples) % self.sample_every:
+            return 0.0
+        return perf_counter()
+
+    def begin(self):
+        # Give this thread a new trace id, for the spans recorded until end()
+        self.local.trace = next(self.ids)
+
+    def tracing(self):
+        # Id of the trace this thread is working on, 0 if none
+        return getattr(self.local, "trace", 0)
+
+    def end(self):
+        self.local.trace = 0
+
+    def span(self, name, start, end=None, **args):
+        if end is None:
+            end = perf_counter()
+        slot = next(self.slots)
+        self.buffer[slot % self.capacity] = (name, self.tracing(), threading.get_ident(), start, end, args)
+        self.recorded = slot + 1
+
+    def spans(self):
+        # Spans still in the buffer, oldest first
+        spans = [span for span in list(self.buffer) if span is not None]
+        spans.sort(key=lambda span: span[3])
+        return [{"name": name, "trace": trace, "thread": thread, "start": start, "end": end,
+                 "duration": end - start, **args}
+                for name, trace, thread, start, end, args in spans]
+
+    def stats(self):
+        return {"recorded": self.recorded, "kept": min(self.recorded, self.capacity),
+                "capacity": self.capacity, "sample_every": self.sample_every}
+
+    def clear(self):
+        self.buffer = [None] * self.capacity
+        self.slots = itertools.count()
+        self.recorded = 0
+
+    def to_json(self):
+        return json.dumps({"stats": self.stats(), "spans": self.spans()})
+
+    def to_chrome(self):
+        # Chrome trace event format: open in chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        events = []
+        for span in self.spans():
+            args = {key: value for key, value in span.items()
+                    if key not in ("name", "thread", "start", "end", "duration")}
+            events.append({"name": span["name"], "cat": "websocket", "ph": "X", "pid": pid, "tid": span["thread"],
+                           "ts": span["start"] * 1e6, "dur": span["duration"] * 1e6, "args": args})
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+    def export(self, filename, format="chrome"):
+        # Write the spans to a file as "json" or "chrome" trace events
+        if format not in ("json", "chrome"):
+            raise ValueError(f"Unknown trace format {format!r}")
+        with open(filename, "w") as f:
+            f.write(self.to_chrome() if format == "chrome" else self.to_json())
@@ -0,0 +1,325 @@
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('!I')
+TEXT, BINARY = b'\x01', b'\x02'
+
+
+class RecordReader:
+    # Splits a byte stream into length-prefixed records
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        records = []
+        while len(self.buffer) >= RECORD_HEADER.size:
+            size = RECORD_HEADER.unpack_from(self.buffer)[0]
+            end = RECORD_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            records.append(bytes(self.buffer[:end]))
+            del self.buffer[:end]
+        return records
+
+
+def encode_record(message):
+    if isinstance(message, str):
+        kind, payload = TEXT, message.encode('utf-8')
+    else:
+        kind, payload = BINARY, bytes(message)
+    return RECORD_HEADER.pack(len(payload) + 1) + kind + payload
+
+
+def decode_record(record):
+    kind, payload = record[RECORD_HEADER.size:RECORD_HEADER.size + 1], record[RECORD_HEADER.size + 1:]
+    return payload.decode('utf-8') if kind == TEXT else payload
+
+
+class WorkerChannel:
+    # A worker's end of the broadcast channel: publishes go to the supervisor, which relays
+    # them to every other worker; what the others publish is handed to the server
+    def __init__(self, sock, server):
+        self.sock = sock
+        self.server = server
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def publish(self, message):
+        record = encode_record(message)
+        try:
+            with self.lock:
+                self.sock.sendall(record)
+        except OSError as e:
+            # The supervisor cut this worker off (or is gone): only its own clients get the message
+            logger.warning(f"Could not publish to the other workers: {e}")
+
+    def run(self):
+        reader = RecordReader()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                logger.warning("Broadcast channel to the supervisor closed")
+                return
+            for record in reader.feed(data):
+                try:
+                    self.server.receive_channel_message(decode_record(record))
+                except Exception as e:
+                    logger.error(f"Error delivering a broadcast from another worker: {e}", exc_info=True)
+
+
+class ChannelHub:
+    # Runs in the supervisor and relays every record a worker publishes to all the other workers.
+    # Writes never block: what a worker's socket does not take waits in that worker's buffer, and
+    # a worker that lets more than max_buffered bytes pile up is cut off, so one worker that stops
+    # reading cannot hold up the broadcasts of the others.
+    def __init__(self, max_buffered=16 * 1024 * 1024):
+        self.max_buffered = max_buffered
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.readers = {}  # {worker socket: RecordReader}
+        self.pending = {}  # {worker socket: bytearray its socket did not take yet}
+        self.dropped = 0  # Workers cut off for not reading
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, sock):
+        sock.setblocking(False)
+        with self.lock:
+            self.readers[sock] = RecordReader()
+            self.pending[sock] = bytearray()
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def remove(self, sock):
+        with self.lock:
+            self.readers.pop(sock, None)
+            self.pending.pop(sock, None)
+            try:
+                self.selector.unregister(sock)
+            except KeyError:
+                pass  # Already dropped when the worker hung up
+        sock.close()
+
+    def sockets(self):
+        with self.lock:
+            return list(self.readers)
+
+    def close(self):
+        self.selector.close()
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select():
+                sock = key.fileobj
+                if events & selectors.EVENT_WRITE:
+                    self.flush(sock)
+                if events & selectors.EVENT_READ:
+                    self.read(sock)
+
+    def read(self, sock):
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        with self.lock:
+            reader = self.readers.get(sock)
+            if not data and reader is not None:
+                # Stop relaying to a worker that hung up; the supervisor closes it once reaped
+                self.drop(sock)
+        if reader is None or not data:
+            return
+        for record in reader.feed(data):
+            for other in self.sockets():
+                if other is not sock:
+                    self.relay(other, record)
+
+    def relay(self, sock, record):
+        with self.lock:
+            buffer = self.pending.get(sock)
+            if buffer is None:
+                return  # Dropped meanwhile
+            if not buffer:
+                try:
+                    sent = sock.send(record)
+                except BlockingIOError:
+                    sent = 0
+                except OSError as e:
+                    logger.warning(f"Could not relay a broadcast to a worker: {e}")
+                    return
+                if sent == len(record):
+                    return
+                record = memoryview(record)[sent:]
+                self.selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            buffer += record
+            if len(buffer) > self.max_buffered:
+                logger.error(f"A worker stopped reading broadcasts with {len(buffer)} bytes queued; "
+                             f"disconnecting its channel")
+                self.dropped += 1
+                self.drop(sock)
+
+    def flush(self, sock):
+        with self.lock:
+            buffer = self.pending.get(sock)
+            if not buffer:
+                return
+            try:
+                sent = sock.send(buffer)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.warning(f"Could not relay a broadcast to a worker: {e}")
+                self.drop(sock)
+                return
+            del buffer[:sent]
+            if not buffer:
+                self.selector.modify(sock, selectors.EVENT_READ)
+
+    def drop(self, sock):
+        # Called with the lock held. The worker sees its channel close; the socket itself is
+        # closed by remove() once the supervisor reaps the worker.
+        self.readers.pop(sock, None)
+        self.pending.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except KeyError:
+            pass
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class WorkerPool:
+    # Forks worker processes that each accept on the same port (the kernel spreads connections
+    # through SO_REUSEPORT), restarts the ones that die, and shuts them all down on SIGTERM/SIGINT
+    min_restart_delay = 0.5
+    max_restart_delay = 30
+
+    def __init__(self, server, workers, broadcast=True, shutdown_timeout=10):
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Worker processes need fork() and SO_REUSEPORT")
+        self.server = server
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.hub = ChannelHub() if broadcast else None
+        self.pids = {}  # {pid: (worker index, channel socket, start time)}
+        self.restart_delay = self.min_restart_delay
+        self.stopping = False
+        self.reserved = None
+
+    def run(self):
+        server = self.server
+        # Keep the port while workers come and go; this socket never listens, so it gets no connections
+        server.port = server.sock.getsockname()[1]
+        server.sock.close()
+        self.reserved = server.create_socket(reuse_port=True)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        logger.info(f"Starting {self.workers} workers on {server.host}:{server.port}")
+        for index in range(self.workers):
+            self.spawn(index)
+
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            if pid not in self.pids:
+                continue
+            index, channel, started = self.pids.pop(pid)
+            if channel is not None:
+                self.hub.remove(channel)
+            if self.stopping:
+                continue
+            logger.warning(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            # Back off while workers die right after starting, so a crash loop does not spin
+            if time.monotonic() - started < self.max_restart_delay:
+                time.sleep(self.restart_delay)
+                self.restart_delay = min(self.restart_delay * 2, self.max_restart_delay)
+            else:
+                self.restart_delay = self.min_restart_delay
+            if not self.stopping:
+                self.spawn(index)
+        self.reserved.close()
+        logger.info("All workers stopped")
+
+    def spawn(self, index):
+        parent_end = child_end = None
+        if self.hub is not None:
+            parent_end, child_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            if parent_end is not None:
+                parent_end.close()
+            self.run_worker(index, child_end)
+        if child_end is not None:
+            child_end.close()
+            self.hub.add(parent_end)
+        self.pids[pid] = (index, parent_end, time.monotonic())
+
+    def run_worker(self, index, channel):
+        # Child side of spawn(); never returns
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor turns Ctrl+C into SIGTERM
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.server.stop())
+            # Drop what was inherited from the supervisor. The hub's thread did not survive the
+            # fork, so its lock is not taken here.
+            for other_index, other_channel, started in self.pids.values():
+                if other_channel is not None:
+                    other_channel.close()
+            if self.hub is not None:
+                self.hub.close()
+            self.reserved.close()
+            server = self.server
+            server.worker_id = index
+            server.sock = server.create_socket(reuse_port=True)
+            if channel is not None:
+                server.channel = WorkerChannel(channel, server)
+            logger.info(f"Worker {index} (pid {os.getpid()}) accepting on {server.host}:{server.port}")
+            server.start()
+            # Give connection threads a moment to finish closing their clients
+            deadline = time.monotonic() + self.shutdown_timeout
+            for thread in threading.enumerate():
+                if thread is not threading.current_thread() and not thread.daemon:
+                    thread.join(max(deadline - time.monotonic(), 0))
+        except BaseException as e:
+            logger.error(f"Worker {index} failed: {e}", exc_info=True)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def handle_signal(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Stopping workers")
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        timer = threading.Timer(self.shutdown_timeout, self.kill_workers)
+        timer.daemon = True
+        timer.start()
+
+    def kill_workers(self):
+        for pid in list(self.pids):
+            logger.warning(f"Worker pid {pid} did not stop in time, killing it")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass